@@ -1,23 +1,32 @@
 # app.py
 # -*- coding: utf-8 -*-
 import io
-import re
+import os
+import threading
 import json
+import time
 import base64
-import zipfile
+import importlib.util
+import shutil
+import tempfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import streamlit as st
 from lxml import etree
-import cairosvg
 
-# barcode generation via python-barcode (SVGWriter)
-import barcode
-from barcode.writer import SVGWriter
-
-# utils must expose mm_to_px
 import utils
-from PIL import Image as PILImage
+import render_cache
+import shard_export
+import download_server
+import text_outline
+# everything that does not need Streamlit lives in pipeline.py (also imported by export workers)
+from pipeline import (RENDER_CACHE, RENDER_VERSION, RASTER_FORMATS, _decode_bytes, _svg_size_mm,
+                      apply_mapping_to_svg, barcode_columns, bleed_box_svg, build_sheet_svg, bundle_zip,
+                      cached_sanitize_for_preview, cached_svg_to_pdf_bytes, check_barcode_columns,
+                      export_raster_tiled, find_placeholders, normalize_mapping, png_to_rgba, record_file_stem,
+                      render_layer_patch, render_svg_draft_png, render_svg_to_png, split_template_layers,
+                      svg_to_pdf_bytes, text_fit_problems)
 
 # ---------- App config ----------
 APP_TITLE = "Cuda Automation Layout"
@@ -74,6 +83,44 @@ custom_css += """
 custom_css += "</style>"
 st.markdown(custom_css, unsafe_allow_html=True)
 
+# ---------- Background preview renders ----------
+# full-quality previews render on a shared pool; each session keeps at most one job and
+# cancels it when the previewed row/mapping changes, so the queue never backs up
+@st.cache_resource
+def _preview_executor():
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 2), thread_name_prefix="preview")
+
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+# ---------- Downloads ----------
+# archives built on disk go to download_server.py when it is configured (DOWNLOAD_PORT and
+# DOWNLOAD_BASE_URL); otherwise the button is fed the open file rather than a bytes copy
+@st.cache_resource
+def _download_server():
+    server = download_server.DownloadServer.from_env()
+    try:
+        return server.start() if server is not None else None
+    except OSError:
+        return None
+
+def offer_download(payload, file_name: str, discard_dir=None):
+    """Download control for bytes or a file on disk; `discard_dir` is removed once the file has been handed over."""
+    if not isinstance(payload, Path):
+        st.download_button("Download ZIP", payload, file_name=file_name)
+        return
+    server = _download_server()
+    try:
+        if server is None:
+            # the button consumes the handle while it is built, so the folder can go right after
+            with open(payload, "rb") as fh:
+                st.download_button("Download ZIP", fh, file_name=file_name, mime="application/zip")
+            return
+        st.link_button("Download ZIP", server.url_for(server.publish(payload, file_name)))
+        st.caption(f"Streamed from disk; the link expires in {server.retention_s / 60:.0f} min.")
+    finally:
+        if discard_dir is not None:
+            shutil.rmtree(discard_dir, ignore_errors=True)
+
 # ---------- Simple auth ----------
 USERS = {"Emdaduljs": "123", "Test1": "1234", "Test2": "12345", "Test3": "123456"}
 
@@ -89,405 +136,173 @@ with st.sidebar:
     role = "Editor" if username == "Emdaduljs" else "User"
     st.success(f"✅ {role} ({username})")
 
-# ---------- Helpers & sanitization ----------
-SVG_NS = "http://www.w3.org/2000/svg"
-
-def _decode_bytes(b: bytes) -> str:
-    for enc in ("utf-8", "utf-8-sig", "latin-1", "cp1252"):
+# ---------- columnar data readers ----------
+# Parquet / Arrow IPC / XLSX uploads are read in two steps: the column list comes from the
+# file's schema or header row, then only the columns the mapping needs are loaded.
+COLUMNAR_EXTS = (".parquet", ".pq", ".arrow", ".feather", ".ipc", ".xlsx")
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_data_columns(name: str, data: bytes) -> list:
+    lname = name.lower()
+    if lname.endswith((".parquet", ".pq")):
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(io.BytesIO(data)).names)
+    if lname.endswith((".arrow", ".feather", ".ipc")):
+        import pyarrow as pa
         try:
-            return b.decode(enc)
-        except Exception:
-            pass
-    return b.decode("utf-8", errors="ignore")
-
-def sanitize_for_preview(svg_bytes: bytes) -> str:
-    if not svg_bytes:
-        raise ValueError("Empty SVG input")
-    raw = _decode_bytes(svg_bytes)
-    raw = raw.lstrip("\ufeff")
-    raw = re.sub(r"<!DOCTYPE[^>[]*(\[[^\]]*\])?>", "", raw, flags=re.IGNORECASE | re.DOTALL)
-    raw = re.sub(r"<!ENTITY[^>]*>", "", raw, flags=re.IGNORECASE | re.DOTALL)
-    raw = re.sub(r'(<\/?)([A-Za-z0-9_]+):([A-Za-z0-9_\-]+)', lambda m: f"{m.group(1)}{m.group(2)}_{m.group(3)}", raw)
-    raw = re.sub(r'(\s)([A-Za-z0-9_]+):([A-Za-z0-9_\-]+)=', lambda m: f"{m.group(1)}{m.group(2)}_{m.group(3)}=", raw)
-    raw = re.sub(r'\s+xmlns:[a-zA-Z0-9_]+="[^"]+"', '', raw)
-    raw = re.sub(r"&([A-Za-z0-9_]+);", lambda m: f"&{m.group(1)};" if m.group(1) in ("lt","gt","amp","quot","apos") else "", raw)
-
-    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
-    try:
-        root = etree.fromstring(raw.encode("utf-8"), parser=parser)
-    except Exception:
-        m = re.search(r"(<svg\b[^>]*>.*?</svg>)", raw, flags=re.DOTALL | re.IGNORECASE)
-        if m:
-            frag = m.group(1)
-            root = etree.fromstring(frag.encode("utf-8"), parser=parser)
-        else:
-            raise
+            return list(pa.ipc.open_file(pa.BufferReader(data)).schema.names)
+        except pa.ArrowInvalid:
+            return list(pa.ipc.open_stream(pa.BufferReader(data)).schema.names)
+    if lname.endswith(".xlsx"):
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            header = next(wb.worksheets[0].iter_rows(min_row=1, max_row=1, values_only=True), ())
+        finally:
+            wb.close()
+        return [str(h) for h in header if h is not None]
+    raise ValueError(f"Unsupported columnar file: {name}")
 
-    if not (isinstance(root.tag, str) and root.tag.lower().endswith("svg")):
-        cand = root.find(".//{http://www.w3.org/2000/svg}svg") or root.find(".//svg")
-        if cand is not None:
-            root = cand
-        else:
-            found = None
-            for el in root.iter():
-                if isinstance(el.tag, str) and el.tag.lower().endswith("svg"):
-                    found = el
-                    break
-            if found is None:
-                raise ValueError("No <svg> element found")
-            root = found
-
-    if not root.get("xmlns"):
-        root.set("xmlns", SVG_NS)
-    if "version" not in root.attrib:
-        root.set("version", "1.1")
-
-    if "viewBox" not in root.attrib:
-        w = root.get("width"); h = root.get("height")
-        if w and h:
-            try:
-                wn = float(re.match(r"^\s*([0-9.+-eE]+)", w).group(1))
-                hn = float(re.match(r"^\s*([0-9.+-eE]+)", h).group(1))
-                root.set("viewBox", f"0 0 {wn} {hn}")
-            except Exception:
-                pass
-
-    for el in root.iter():
-        style = el.get("style")
-        if style:
-            parts = [p.strip() for p in style.split(";") if p.strip()]
-            seen = {}
-            for p in parts:
-                if ":" in p:
-                    k, v = p.split(":", 1)
-                    seen[k.strip()] = v.strip()
-            el.set("style", "; ".join(f"{k}: {v}" for k, v in seen.items()))
-
-    out = etree.tostring(root, encoding="utf-8", xml_declaration=True, pretty_print=False).decode("utf-8")
-    return out
-
-def ensure_svg_size(svg_text: str) -> str:
-    if "width=" in svg_text and "height=" in svg_text:
-        return svg_text
-    m = re.search(r'viewBox="\s*([\d.\-]+)\s+([\d.\-]+)\s+([\d.\-]+)\s+([\d.\-]+)\s*"', svg_text)
-    if m:
-        w, h = m.group(3), m.group(4)
-        return re.sub(r"<svg", f"<svg width='{w}' height='{h}'", svg_text, count=1)
-    return re.sub(r"<svg", "<svg width='1000' height='1000'", svg_text, count=1)
-
-def render_svg_to_png(svg_text: str, scale: float = 1.0) -> bytes:
-    svg_text = ensure_svg_size(svg_text)
-    internal_scale = max(1.0, scale * 2.0)
-    return cairosvg.svg2png(bytestring=svg_text.encode("utf-8"), scale=internal_scale)
-
-def svg_to_pdf_bytes(svg_text: str) -> bytes:
-    svg_text = ensure_svg_size(svg_text)
-    return cairosvg.svg2pdf(bytestring=svg_text.encode("utf-8"))
-
-# ---------- parse svg dims ----------
-def _parse_svg_dimensions(svg_text: str):
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+def _xlsx_part(zf, path: str):
     try:
-        parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
-        root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
-        vb = root.get("viewBox")
-        if vb:
-            parts = [float(p) for p in vb.strip().split()]
-            if len(parts) == 4:
-                return parts[2], parts[3]
-        w_attr = root.get("width")
-        h_attr = root.get("height")
-        def _attr_to_px(v):
-            if not v:
-                return None
-            v = str(v).strip()
-            if v.endswith("mm"):
-                return utils.mm_to_px(float(v[:-2]))
-            if v.endswith("px"):
-                try:
-                    return float(v[:-2])
-                except Exception:
-                    return None
-            if v.endswith("pt"):
-                try:
-                    return float(v[:-2]) * 1.3333333
-                except Exception:
-                    return None
-            try:
-                return float(re.match(r"^([0-9.+-eE]+)", v).group(1))
-            except Exception:
+        return etree.fromstring(zf.read(path))
+    except KeyError:
+        return None
+
+def _read_xlsx_columns(data: bytes, columns: list) -> pd.DataFrame:
+    # openpyxl converts every cell of the sheet even with usecols; this walks the first sheet's XML
+    # once and only converts cells in the wanted columns. Headers are matched as text, the way
+    # read_data_columns reports them (a 2024 header is "2024").
+    import zipfile
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+    from openpyxl.utils.cell import column_index_from_string
+    from openpyxl.utils.datetime import from_excel
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        book = _xlsx_part(zf, "xl/workbook.xml")
+        rels = _xlsx_part(zf, "xl/_rels/workbook.xml.rels")
+        rel_id = book.find(f"{_XLSX_NS}sheets/{_XLSX_NS}sheet").get(_XLSX_REL)
+        target = next(r.get("Target") for r in rels if r.get("Id") == rel_id)
+        sheet_path = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+        shared = []
+        strings = _xlsx_part(zf, "xl/sharedStrings.xml")
+        if strings is not None:
+            for si in strings.iter(f"{_XLSX_NS}si"):
+                shared.append("".join(t.text or "" for t in si.iter(f"{_XLSX_NS}t")
+                                      if t.getparent().tag != f"{_XLSX_NS}rPh"))
+        date_styles = set()
+        styles = _xlsx_part(zf, "xl/styles.xml")
+        if styles is not None:
+            formats = dict(BUILTIN_FORMATS)
+            formats.update({int(f.get("numFmtId")): f.get("formatCode") for f in styles.iter(f"{_XLSX_NS}numFmt")})
+            xfs = styles.find(f"{_XLSX_NS}cellXfs")
+            for i, xf in enumerate(xfs if xfs is not None else ()):
+                if is_date_format(formats.get(int(xf.get("numFmtId", 0)), "General")):
+                    date_styles.add(str(i))
+
+        def _value(c):
+            kind, v = c.get("t", "n"), c.findtext(f"{_XLSX_NS}v")
+            if kind == "inlineStr":
+                return "".join(t.text or "" for t in c.iter(f"{_XLSX_NS}t"))
+            if v is None:
                 return None
-        wpx = _attr_to_px(w_attr)
-        hpx = _attr_to_px(h_attr)
-        if wpx and hpx:
-            return wpx, hpx
-    except Exception:
-        pass
-    return 1000.0, 1000.0
-
-# ---------- reliable EAN-13 SVG generator ----------
-def render_ean13_svg_text(ean: str) -> str:
-    ean_clean = ''.join(filter(str.isdigit, str(ean)))
-    if len(ean_clean) not in (12, 13):
-        raise ValueError("EAN must be 12 or 13 digits")
-    EAN = barcode.get_barcode_class('ean13')
-    writer = SVGWriter()
-    obj = EAN(ean_clean, writer=writer)
-    buf = io.BytesIO()
-    options = {"write_text": True}
-    obj.write(buf, options)
-    buf.seek(0)
+            if kind == "s":
+                return shared[int(v)]
+            if kind == "b":
+                return v == "1"
+            if kind in ("str", "e"):
+                return v
+            if kind == "d":
+                return pd.Timestamp(v).to_pydatetime()
+            num = float(v) if any(ch in v for ch in ".eE") else int(v)
+            return from_excel(num) if c.get("s") in date_styles else num
+
+        header, positions, out, last_filled = None, None, [], 0
+        with zf.open(sheet_path) as fh:
+            for _, row in etree.iterparse(fh, tag=f"{_XLSX_NS}row"):
+                row_no = int(row.get("r", (len(out) + 2) if header is not None else 1))
+                cells, col_no = {}, 0
+                for c in row.iter(f"{_XLSX_NS}c"):
+                    ref = c.get("r")
+                    col_no = column_index_from_string(ref.rstrip("0123456789")) - 1 if ref else col_no + 1
+                    if header is None or col_no in positions:
+                        cells[col_no] = _value(c)
+                    elif c.find(f"{_XLSX_NS}v") is not None:
+                        cells.setdefault(-1, True)  # row has data outside the projection
+                row.clear()
+                while row.getprevious() is not None:
+                    del row.getparent()[0]
+                if header is None:
+                    if row_no != 1:
+                        cells = {}
+                    width = max(cells, default=-1) + 1
+                    header = [str(cells[i]) if cells.get(i) is not None else None for i in range(width)]
+                    missing = [c for c in columns if c not in header]
+                    if missing:
+                        raise KeyError(f"columns not in header row: {missing}")
+                    positions = {header.index(c): j for j, c in enumerate(columns)}
+                    if row_no == 1:
+                        continue
+                # rows the file leaves out are blank rows
+                while len(out) < row_no - 2:
+                    out.append([None] * len(columns))
+                values = [None] * len(columns)
+                for col_no, v in cells.items():
+                    if col_no in positions:
+                        values[positions[col_no]] = v
+                out.append(values)
+                if any(v is not None for v in cells.values()):
+                    last_filled = len(out)
+    # trailing blank rows are dropped, as pd.read_excel does
+    return pd.DataFrame.from_records(out[:last_filled], columns=columns)
+
+def _read_full_table(name: str, data: bytes, columns: list) -> pd.DataFrame:
+    lname = name.lower()
+    if lname.endswith((".parquet", ".pq")):
+        full = pd.read_parquet(io.BytesIO(data))
+    elif lname.endswith((".arrow", ".feather", ".ipc")):
+        import pyarrow as pa
+        try:
+            full = pa.ipc.open_file(pa.BufferReader(data)).read_all().to_pandas()
+        except pa.ArrowInvalid:
+            full = pa.ipc.open_stream(pa.BufferReader(data)).read_all().to_pandas()
+    else:
+        full = pd.read_excel(io.BytesIO(data), engine="openpyxl")
+    full.columns = [str(c) for c in full.columns]
+    return full[[c for c in columns if c in full.columns]]
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_projected_table(name: str, data: bytes, columns: tuple) -> pd.DataFrame:
+    lname = name.lower()
+    columns = list(columns)
+    if not lname.endswith(COLUMNAR_EXTS):
+        raise ValueError(f"Unsupported columnar file: {name}")
     try:
-        svg_text = buf.getvalue().decode("utf-8")
-    except Exception:
-        svg_text = buf.getvalue().decode("latin-1")
-    return svg_text
-
-# ---------- conservative white rect remover ----------
-def _remove_white_background_rects(frag_root):
-    to_remove = []
-    for el in list(frag_root.iter()):
-        tag = el.tag
-        if not isinstance(tag, str):
-            continue
-        if tag.lower().endswith("rect"):
-            fill = (el.get("fill") or "").strip().lower()
-            style = (el.get("style") or "").lower()
-            if fill in ("#fff", "#ffffff", "white", "rgb(255,255,255)"):
-                to_remove.append(el)
-                continue
-            if "fill:#fff" in style or "fill:#ffffff" in style or "fill:white" in style:
-                to_remove.append(el)
-                continue
-            try:
-                w = float(el.get("width") or 0)
-                h = float(el.get("height") or 0)
-                if w > 500 or h > 500:
-                    to_remove.append(el)
-            except Exception:
-                pass
-    for r in to_remove:
-        parent = r.getparent()
-        if parent is not None:
-            parent.remove(r)
-
-# ---------- placeholders ----------
-def find_placeholders(svg_text: str):
-    return sorted(set(re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", svg_text)))
-
-def apply_mapping_to_svg(svg_text: str, mapping: dict, record: dict) -> str:
-    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
-    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
-
-    text_nodes = list(root.findall(".//{http://www.w3.org/2000/svg}text")) + list(root.findall(".//text"))
-
-    for text_elem in text_nodes:
-        content = "".join(text_elem.itertext()) or ""
-        matches = re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", content)
-        if not matches:
-            continue
-
-        barcode_placeholders = [ph for ph in matches if mapping.get(ph, {}).get("type", "Text") == "Barcode EAN13"]
-        if barcode_placeholders and len(matches) == 1:
-            ph = barcode_placeholders[0]
-            cfg = mapping.get(ph, {"col": ph, "align": "Left"})
-            col = cfg.get("col", ph)
-            val = record.get(col, "")
-            if val is None or str(val).strip() == "":
-                for child in list(text_elem):
-                    text_elem.remove(child)
-                text_elem.text = ""
-                continue
-
-            # Read cfg values
-            height_mm = float(cfg.get("height_mm", 0.0) or 0.0)
-            width_mm = float(cfg.get("width_mm", 0.0) or 0.0)
-            ratio_mode = cfg.get("ratio_mode", "Exact")  # "Exact" or "Maintain"
-
-            # If ratio_mode == Maintain, attempt to compute missing side using stored ratio
-            ratio = cfg.get("ratio", None)
-            # if user provided both >0 and ratio_mode == Maintain -> compute/store fresh ratio
-            if ratio_mode == "Maintain":
-                if width_mm > 0 and height_mm > 0:
-                    # update stored ratio (width/height)
-                    try:
-                        cfg["ratio"] = float(width_mm) / float(height_mm)
-                        ratio = cfg["ratio"]
-                    except Exception:
-                        ratio = cfg.get("ratio", None)
-                else:
-                    # one side only set -> fill missing based on stored ratio (if possible)
-                    if ratio and width_mm == 0 and height_mm > 0:
-                        try:
-                            width_mm = float(height_mm) * float(ratio)
-                            cfg["width_mm"] = float(width_mm)
-                        except Exception:
-                            pass
-                    elif ratio and height_mm == 0 and width_mm > 0:
-                        try:
-                            height_mm = float(width_mm) / float(ratio)
-                            cfg["height_mm"] = float(height_mm)
-                        except Exception:
-                            pass
-                    # if ratio not present and both not >0, nothing to infer
-
-            # px targets (None means auto)
-            try:
-                desired_h_px = utils.mm_to_px(height_mm) if height_mm > 0 else None
-            except Exception:
-                desired_h_px = int(round((height_mm / 25.4) * 300)) if height_mm > 0 else None
-            try:
-                desired_w_px = utils.mm_to_px(width_mm) if width_mm > 0 else None
-            except Exception:
-                desired_w_px = int(round((width_mm / 25.4) * 300)) if width_mm > 0 else None
-
-            # text element position
-            x_val = text_elem.get("x") or text_elem.get("dx") or "0"
-            y_val = text_elem.get("y") or text_elem.get("dy") or "0"
-            try:
-                xf = float(x_val)
-            except Exception:
-                xf = 0.0
-            try:
-                yf = float(y_val)
-            except Exception:
-                yf = 0.0
-
-            # mapping adjustments
-            try:
-                cfg_dx = float(cfg.get("dx", 0) or 0)
-            except Exception:
-                cfg_dx = 0.0
-            try:
-                cfg_dy = float(cfg.get("dy", 0) or 0)
-            except Exception:
-                cfg_dy = 0.0
-            try:
-                cfg_scale = float(cfg.get("scale", 1.0) or 1.0)
-            except Exception:
-                cfg_scale = 1.0
-
-            # generate vector barcode svg
-            try:
-                svg_bar = render_ean13_svg_text(val)
-            except Exception as e:
-                for child in list(text_elem):
-                    text_elem.remove(child)
-                text_elem.text = f"[barcode generate error: {e}]"
-                continue
-
-            # parse frag
-            try:
-                parser2 = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
-                frag = etree.fromstring(svg_bar.encode("utf-8"), parser=parser2)
-            except Exception as e:
-                for child in list(text_elem):
-                    text_elem.remove(child)
-                text_elem.text = f"[barcode svg parse error: {e}]"
-                continue
-
-            # strip white background rects
+        if lname.endswith((".parquet", ".pq")):
+            return pd.read_parquet(io.BytesIO(data), columns=columns)
+        if lname.endswith((".arrow", ".feather", ".ipc")):
+            import pyarrow as pa
+            import pyarrow.feather as feather
             try:
-                _remove_white_background_rects(frag)
-            except Exception:
-                pass
-
-            # compute original dims
-            orig_w, orig_h = _parse_svg_dimensions(svg_bar)
-
-            # Decide scaling:
-            # - If desired_w_px and desired_h_px both None -> no size change (scale=cfg_scale)
-            # - If both specified -> non-uniform scale to match both exactly (scale_x, scale_y)
-            # - If only one specified -> uniform scale to match that side (other computed by orig ratio)
-            if desired_w_px is None and desired_h_px is None:
-                scale_x = cfg_scale
-                scale_y = cfg_scale
-            elif desired_w_px is not None and desired_h_px is not None:
-                # both specified --> non-uniform exact match, then multiply by cfg_scale
-                sx = (float(desired_w_px) / float(orig_w)) if orig_w != 0 else 1.0
-                sy = (float(desired_h_px) / float(orig_h)) if orig_h != 0 else 1.0
-                scale_x = sx * cfg_scale
-                scale_y = sy * cfg_scale
-            elif desired_w_px is not None:
-                # width only -> uniform scale by width
-                if orig_w == 0:
-                    u = cfg_scale
-                else:
-                    u = (float(desired_w_px) / float(orig_w)) * cfg_scale
-                scale_x = u
-                scale_y = u
-            else:
-                # height only -> uniform scale by height
-                if orig_h == 0:
-                    u = cfg_scale
-                else:
-                    u = (float(desired_h_px) / float(orig_h)) * cfg_scale
-                scale_x = u
-                scale_y = u
-
-            total_tx = xf + cfg_dx
-            total_ty = yf + cfg_dy
-
-            # build group and import children - note: scale can be non-uniform
-            g = etree.Element("{http://www.w3.org/2000/svg}g")
-            g.set("transform", f"translate({total_tx},{total_ty}) scale({scale_x},{scale_y})")
-            for child in list(frag):
-                frag.remove(child)
-                g.append(child)
-
-            parent = text_elem.getparent()
-            if parent is None:
-                text_elem.text = ""
-                root.append(g)
-            else:
-                parent.replace(text_elem, g)
-            continue
+                table = feather.read_table(pa.BufferReader(data), columns=columns)
+            except pa.ArrowInvalid:
+                # IPC stream format has no footer, so projection happens after reading the batches
+                table = pa.ipc.open_stream(pa.BufferReader(data)).read_all().select(columns)
+            return table.to_pandas()
+        return _read_xlsx_columns(data, columns)
+    except ImportError:
+        raise
+    except Exception:
+        # projection is only an optimisation: on any mismatch read everything and select afterwards
+        return _read_full_table(name, data, columns)
 
-        # fallback textual substitution
-        new_text = content
-        for ph in matches:
-            cfg = mapping.get(ph, {"col": ph, "align": "Left"})
-            col = cfg.get("col", ph)
-            val = record.get(col, "")
-            if val is None:
-                val = ""
-            new_text = re.sub(r"\{\{\s*%s\s*\}\}" % re.escape(ph), str(val), new_text)
-
-        # remove child tspans and re-split lines preserving line structure
-        for child in list(text_elem):
-            text_elem.remove(child)
-        lines = str(new_text).splitlines() or [""]
-        text_elem.text = lines[0]
-        for ln in lines[1:]:
-            tspan = etree.Element("{http://www.w3.org/2000/svg}tspan")
-            if text_elem.get("x"):
-                tspan.set("x", text_elem.get("x"))
-            tspan.set("dy", "1em")
-            tspan.text = ln
-            text_elem.append(tspan)
-
-        align_map = {"Left": "start", "Center": "middle", "Right": "end", "Justify": "start"}
-        cfg0 = mapping.get(matches[0], {})
-        text_elem.set("text-anchor", align_map.get(cfg0.get("align", "Left"), "start"))
-        # transform support (dx,dy,scale) on text
-        try:
-            dx = float(cfg0.get("dx", 0))
-            dy = float(cfg0.get("dy", 0))
-            scale_val = float(cfg0.get("scale", 1.0))
-            old = text_elem.get("transform", "")
-            tf = f" translate({dx},{dy}) scale({scale_val})"
-            text_elem.set("transform", (old + tf).strip())
-        except Exception:
-            pass
-
-    return etree.tostring(root, encoding="utf-8").decode("utf-8")
-
-# ---------- bundle helper ----------
-def bundle_zip(named_files: list[tuple[str, bytes]]) -> bytes:
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for fname, data in named_files:
-            zf.writestr(fname, data)
-    return buf.getvalue()
+# the barcode pre-pass copies and scans whole columns; cache it so slider ticks and
+# other reruns reuse the result until the data or the mapped barcode columns change
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_check_barcode_columns(df: pd.DataFrame, barcode_cols: tuple):
+    return check_barcode_columns(df, barcode_cols)
 
 # ---------- UI: upload template & data ----------
 col_tpl, col_data = st.columns([2,5])
@@ -497,7 +312,7 @@ with col_tpl:
     svg_file = st.file_uploader("SVG Template (.svg)", type=["svg"])
 with col_data:
     st.subheader("2) Upload Data")
-    data_file = st.file_uploader("CSV or XML", type=["csv", "xml"])
+    data_file = st.file_uploader("CSV, XML, Parquet, Arrow or XLSX", type=["csv", "xml", "parquet", "pq", "arrow", "feather", "ipc", "xlsx"])
     st.caption("Template & Data are shown below (left: mapping, right: preview).")
 
 if "preview_scale" not in st.session_state:
@@ -519,13 +334,67 @@ with st.sidebar:
     pin_width_vw = st.slider("Pinned preview width (vw)", 15, 60, 30)
     st.markdown("---")
     st.header("Export")
-    export_mode = st.radio("Export Mode", ["One per record (ZIP)", "Single combined PDF"], index=0)
+    export_mode = st.radio("Export Mode", ["One per record (ZIP)", "Single combined PDF", "Imposed sheets (N-up PDF)",
+                                           "Sharded workers (ZIP)"], index=0)
+    imposition = None
+    if export_mode == "Imposed sheets (N-up PDF)":
+        with st.expander("Imposition", expanded=True):
+            sheet_preset = st.selectbox("Sheet size", list(utils.SHEET_PRESETS_MM) + ["Custom"], key="nup_sheet")
+            if sheet_preset == "Custom":
+                sheet_w_mm = st.number_input("Sheet width (mm)", min_value=10.0, value=320.0, step=1.0, key="nup_w")
+                sheet_h_mm = st.number_input("Sheet height (mm)", min_value=10.0, value=450.0, step=1.0, key="nup_h")
+            else:
+                sheet_w_mm, sheet_h_mm = utils.SHEET_PRESETS_MM[sheet_preset]
+            if st.checkbox("Landscape", value=False, key="nup_landscape"):
+                sheet_w_mm, sheet_h_mm = sheet_h_mm, sheet_w_mm
+            imposition = {
+                "sheet_w_mm": float(sheet_w_mm),
+                "sheet_h_mm": float(sheet_h_mm),
+                "margin_mm": float(st.number_input("Sheet margin (mm)", min_value=0.0, value=10.0, step=0.5, key="nup_margin")),
+                "gap_mm": float(st.number_input("Gap between cells (mm)", min_value=0.0, value=4.0, step=0.5, key="nup_gap")),
+                "bleed_mm": float(st.number_input("Bleed (mm)", min_value=0.0, value=3.0, step=0.5, key="nup_bleed")),
+                "crop_marks": st.checkbox("Crop marks", value=True, key="nup_marks"),
+            }
+            st.caption("Cells use the template's own size. Artwork shared by all cells is drawn once per sheet.")
+    sharded = None
+    if export_mode == "Sharded workers (ZIP)":
+        with st.expander("Sharding", expanded=True):
+            sharded = {
+                "shards": int(st.number_input("Shards", min_value=1, max_value=256, value=os.cpu_count() or 4, step=1, key="shard_n")),
+                "by": "hash" if st.radio("Split rows by", ["Row ranges", "Hash of file name"], key="shard_by") != "Row ranges" else "rows",
+                "subfolder": st.text_input("Job subfolder (optional)", value="", key="shard_dir",
+                                           help=f"Jobs are written under {shard_export.job_root()} (SHARD_JOB_ROOT); "
+                                                "hosts running workers need that folder shared."),
+                "plan_only": st.checkbox("Only plan the job (workers run on other hosts)", value=False, key="shard_plan_only"),
+            }
+            st.caption("Each shard is exported by its own worker process into a partial ZIP; the parts are merged "
+                       "without recompressing, in the same names and order as a one-per-record export.")
     export_format = st.radio("Export format", ["SVG only", "PDF only", "PDF + SVG"], index=0)
+    raster_choice = st.selectbox("High-DPI raster (optional)", ["None"] + list(RASTER_FORMATS), index=0,
+                                 help="Also export every record as a print raster, rendered tile by tile so memory stays flat at any DPI.")
+    raster = None
+    if raster_choice != "None":
+        rc1, rc2 = st.columns(2)
+        raster = {"ext": RASTER_FORMATS[raster_choice],
+                  "dpi": int(rc1.select_slider("Raster DPI", options=[600, 720, 900, 1200], value=600, key="raster_dpi")),
+                  "tile_px": int(rc2.selectbox("Tile size (px)", [256, 512, 1024, 2048], index=2, key="raster_tile"))}
     name_field_hint = st.text_input("Filename field (optional)")
+    optimise_pdfs = st.checkbox("Optimise PDFs (pikepdf)", value=False,
+                                help="Post-export pass over every PDF: deduplicate identical streams, compressed object streams, linearise for fast first-page display.")
+    outline_text = st.checkbox("Outline text (Inkscape)", value=False,
+                               help="Convert text to paths before SVG/PDF/raster output, as many printers require. Needs Inkscape 1.x; a few long-lived Inkscape processes handle the whole export in batches.")
+    fanout_files = st.file_uploader("Fan-out: extra templates (.svg) + mappings (.json, same file name)", type=["svg", "json"],
+                                    accept_multiple_files=True, key="fanout_upload",
+                                    help="Every record is prepared once and rendered into each template; outputs go to one folder per template in the ZIP. Templates without a matching .json use the current mapping.")
+    export_budget_mb = st.number_input("Export memory budget (MB) — 0 = unlimited", min_value=0, value=0, step=256,
+                                       help="When RSS gets close to the budget, outputs are spilled to disk; the export stops cleanly if it still cannot fit.")
     st.caption("Only rows that have mapped placeholder values will be exported.")
 
 # ---------- Load data ----------
 df = None
+data_columns = []
+# (name, bytes) of a columnar upload; its rows are loaded after mapping, projected to the mapped columns
+columnar_data = None
 if data_file:
     try:
         if data_file.name.lower().endswith(".csv"):
@@ -534,15 +403,24 @@ if data_file:
             except Exception:
                 data_file.seek(0)
                 df = pd.read_csv(data_file, encoding="latin-1")
+        elif data_file.name.lower().endswith(COLUMNAR_EXTS):
+            columnar_data = (data_file.name, data_file.getvalue())
+            data_columns = read_data_columns(*columnar_data)
         else:
             txt = _decode_bytes(data_file.read())
             root = etree.fromstring(txt.encode("utf-8"))
             records = [{child.tag: child.text for child in row} for row in root]
             df = pd.DataFrame(records)
-        if role == "Editor":
-            st.success(f"Loaded {len(df)} rows × {len(df.columns)} cols")
+        if df is not None:
+            data_columns = list(df.columns)
+            if role == "Editor":
+                st.success(f"Loaded {len(df)} rows × {len(df.columns)} cols")
+    except ImportError as e:
+        st.error(f"Reading {data_file.name} needs an optional package that is not installed ({e.name}); see requirements.txt.")
+        columnar_data = None
     except Exception as e:
         st.error(f"Failed to parse data file: {e}")
+        columnar_data = None
 
 # ---------- sanitize template ----------
 sanitized_template = None
@@ -551,7 +429,7 @@ raw_svg_bytes = None
 if svg_file:
     raw_svg_bytes = svg_file.read()
     try:
-        sanitized_template = sanitize_for_preview(raw_svg_bytes)
+        sanitized_template = cached_sanitize_for_preview(raw_svg_bytes)
     except Exception as e:
         st.error(f"❌ Sanitized SVG failed validation; inspect template. ({e})")
         sanitized_template = None
@@ -564,6 +442,39 @@ else:
     if svg_file:
         st.warning("Uploaded SVG invalid or could not be sanitized.")
 
+# ---------- Fan-out targets ----------
+# extra templates rendered from the same data pass; the uploaded template + session mapping come first
+fanout_extra = []
+if fanout_files:
+    fanout_maps = {}
+    for f in fanout_files:
+        if f.name.lower().endswith(".json"):
+            try:
+                loaded = json.loads(f.getvalue().decode("utf-8"))
+                if isinstance(loaded, dict):
+                    fanout_maps[Path(f.name).stem] = loaded
+                else:
+                    st.error(f"{f.name}: JSON mapping must be an object mapping placeholder→config.")
+            except Exception as e:
+                st.error(f"{f.name}: failed to load mapping ({e})")
+    for f in fanout_files:
+        if not f.name.lower().endswith(".svg"):
+            continue
+        try:
+            fan_svg = cached_sanitize_for_preview(f.getvalue())
+        except Exception as e:
+            st.error(f"{f.name}: sanitized SVG failed validation ({e}) — not included in fan-out")
+            continue
+        fan_map = fanout_maps.get(Path(f.name).stem)
+        if fan_map is not None:
+            # same completion as the mapping UI gives the primary template: every entry has a "col"
+            fan_map, problems = normalize_mapping(fan_map, find_placeholders(fan_svg))
+            for problem in problems:
+                st.warning(f"{Path(f.name).stem}.json: {problem} — entry ignored")
+        fanout_extra.append({"name": Path(f.name).stem, "svg": fan_svg, "mapping": fan_map})
+    if fanout_extra and role == "Editor":
+        st.success(f"Fan-out: {len(fanout_extra)} extra template(s) ready.")
+
 # ---------- Mapping UI ----------
 left_col, right_col = st.columns([2,5])
 
@@ -598,7 +509,10 @@ with left_col:
                         "height_mm": float(r.get("height_mm", 0.0) or 0.0),
                         "width_mm": float(r.get("width_mm", 0.0) or 0.0),
                         "ratio_mode": str(r.get("ratio_mode", "Exact")),
-                        "ratio": float(r.get("ratio", 0.0) or 0.0)
+                        "ratio": float(r.get("ratio", 0.0) or 0.0),
+                        "fit": str(r.get("fit", "Off") if pd.notna(r.get("fit", "Off")) else "Off"),
+                        "box_w_mm": float(r.get("box_w_mm", 0.0) or 0.0),
+                        "box_h_mm": float(r.get("box_h_mm", 0.0) or 0.0)
                     }
                 if newmap:
                     st.session_state.mapping = newmap
@@ -617,10 +531,10 @@ with left_col:
 
     try:
         csv_buf = io.StringIO()
-        csv_buf.write("placeholder,col,align,dx,dy,scale,type,height_mm,width_mm,ratio_mode,ratio\n")
+        csv_buf.write("placeholder,col,align,dx,dy,scale,type,height_mm,width_mm,ratio_mode,ratio,fit,box_w_mm,box_h_mm\n")
         for ph, cfg in current_mapping.items():
             csv_buf.write(
-                f"{ph},{cfg.get('col','')},{cfg.get('align','Left')},{cfg.get('dx',0)},{cfg.get('dy',0)},{cfg.get('scale',1.0)},{cfg.get('type','Text')},{cfg.get('height_mm',0.0)},{cfg.get('width_mm',0.0)},{cfg.get('ratio_mode','Exact')},{cfg.get('ratio',0.0)}\n"
+                f"{ph},{cfg.get('col','')},{cfg.get('align','Left')},{cfg.get('dx',0)},{cfg.get('dy',0)},{cfg.get('scale',1.0)},{cfg.get('type','Text')},{cfg.get('height_mm',0.0)},{cfg.get('width_mm',0.0)},{cfg.get('ratio_mode','Exact')},{cfg.get('ratio',0.0)},{cfg.get('fit','Off')},{cfg.get('box_w_mm',0.0)},{cfg.get('box_h_mm',0.0)}\n"
             )
         st.download_button("Download mapping (CSV)", csv_buf.getvalue().encode("utf-8"), file_name="mapping.csv", help="Download current mapping as CSV")
     except Exception:
@@ -634,7 +548,7 @@ with left_col:
         for ph in placeholders:
             with st.expander(ph, expanded=False):
                 cols = st.columns([2,1,1])
-                options = [ph] + (list(df.columns) if df is not None else [])
+                options = [ph] + list(data_columns)
                 prev = st.session_state.mapping.get(ph, {})
                 default_idx = 0
                 if prev.get("col") in options:
@@ -685,6 +599,18 @@ with left_col:
                     height_mm_val = 0.0
                     width_mm_val = 0.0
 
+                fit_selected = "Off"
+                box_w_mm_val = box_h_mm_val = 0.0
+                if type_selected == "Text":
+                    fit_options = ["Off", "Shrink to fit", "Wrap to width"]
+                    fit_selected = st.selectbox("Fit to box", fit_options,
+                                                index=fit_options.index(prev.get("fit")) if prev.get("fit") in fit_options else 0,
+                                                key=f"fit_{ph}")
+                    if fit_selected != "Off":
+                        st.caption("Box size in mm (template units). Text is only ever shrunk, never enlarged.")
+                        box_w_mm_val = st.number_input("Box width (mm)", min_value=0.0, value=float(prev.get("box_w_mm", 0.0) or 0.0), step=0.5, key=f"box_w_mm_{ph}")
+                        box_h_mm_val = st.number_input("Box height (mm) — 0 = no limit", min_value=0.0, value=float(prev.get("box_h_mm", 0.0) or 0.0), step=0.5, key=f"box_h_mm_{ph}")
+
                 # save mapping and manage ratio storage/derivation
                 # If Maintain ratio and both set (>0) compute & store ratio
                 store_ratio = prev.get("ratio", None)
@@ -712,18 +638,74 @@ with left_col:
                     "height_mm": float(height_mm_val),
                     "width_mm": float(width_mm_val),
                     "ratio_mode": str(ratio_mode_selected),
-                    "ratio": float(store_ratio) if store_ratio is not None else None
+                    "ratio": float(store_ratio) if store_ratio is not None else None,
+                    "fit": fit_selected,
+                    "box_w_mm": float(box_w_mm_val),
+                    "box_h_mm": float(box_h_mm_val)
                 }
         st.markdown('</div>', unsafe_allow_html=True)
         st.caption("Scroll to edit placeholders. Changes persist in this session.")
 
+# ---------- Projected load of columnar data ----------
+if columnar_data is not None:
+    wanted = set()
+    for m in [st.session_state.get("mapping", {})] + [t["mapping"] or {} for t in fanout_extra]:
+        wanted.update(cfg.get("col", ph) for ph, cfg in m.items())
+    wanted.update(ph for ph in placeholders)
+    if name_field_hint:
+        wanted.add(name_field_hint)
+    projection = [c for c in data_columns if c in wanted] or data_columns[:1]
+    try:
+        df = load_projected_table(columnar_data[0], columnar_data[1], tuple(projection))
+        if role == "Editor":
+            with col_data:
+                st.success(f"Loaded {len(df)} rows × {len(df.columns)} of {len(data_columns)} cols (mapped columns only)")
+    except ImportError as e:
+        st.error(f"Reading {columnar_data[0]} needs an optional package that is not installed ({e.name}); see requirements.txt.")
+    except Exception as e:
+        st.error(f"Failed to parse data file: {e}")
+
+# ---------- Export targets & barcode pre-pass ----------
+export_targets = []
+if sanitized_template and st.session_state.get("mapping"):
+    primary_name = Path(svg_file.name).stem if svg_file is not None else "template"
+    export_targets.append({"name": primary_name, "svg": sanitized_template, "mapping": st.session_state.mapping})
+    for t in fanout_extra:
+        # target names become ZIP folders and combined-PDF keys, so templates sharing a file stem get a suffix
+        name, n = t["name"], 2
+        while any(name == other["name"] for other in export_targets):
+            name, n = f"{t['name']}-{n}", n + 1
+        if name != t["name"]:
+            st.warning(f"Fan-out: another template is also named {t['name']!r}; its files go to {name}/.")
+        export_targets.append({"name": name, "svg": t["svg"], "mapping": t["mapping"] or st.session_state.mapping})
+    for t in export_targets:
+        for problem in text_fit_problems(t["svg"], t["mapping"]):
+            st.warning(f"{t['name']}: {problem}" if len(export_targets) > 1 else problem)
+
+barcode_df, barcode_report, invalid_barcode_rows = df, None, set()
+if df is not None and not df.empty and export_targets:
+    # one pre-pass over every barcode column used by any target template
+    if len(export_targets) == 1:
+        checked_mapping = export_targets[0]["mapping"]
+    else:
+        checked_mapping = {f"{t['name']}:{ph}": cfg for t in export_targets for ph, cfg in t["mapping"].items()}
+    barcode_df, barcode_report, invalid_barcode_rows = cached_check_barcode_columns(df, barcode_columns(df, checked_mapping))
+    if barcode_report is not None and not barcode_report.empty:
+        with left_col:
+            counts = barcode_report["status"].value_counts().to_dict()
+            summary = ", ".join(f"{counts.get(k, 0)} {k}" for k in ("invalid", "corrected", "missing"))
+            with st.expander(f"Barcode check: {summary}", expanded=bool(invalid_barcode_rows)):
+                st.dataframe(barcode_report, use_container_width=True, hide_index=True)
+                if invalid_barcode_rows:
+                    st.caption("Rows with invalid EANs are skipped on export.")
+
 with right_col:
     st.subheader("Live Preview")
     preview_box = st.empty()
     if not sanitized_template:
         preview_box.info("Upload a valid SVG template first.")
     elif df is None or df.empty:
-        preview_box.info("Upload a data file (CSV/XML) and map placeholders to preview.")
+        preview_box.info("Upload a data file (CSV/XML/Parquet/Arrow/XLSX) and map placeholders to preview.")
     elif not st.session_state.get("mapping"):
         preview_box.info("Map placeholders to see a live preview.")
     else:
@@ -741,11 +723,105 @@ with right_col:
         else:
             idx_select = st.number_input("Preview row (1-based)", min_value=1, max_value=len(df), value=first_valid_idx+1, step=1)
             preview_idx = int(idx_select) - 1
-            rec = {str(k): ("" if pd.isna(v) else v) for k, v in df.iloc[preview_idx].to_dict().items()}
+            rec = {str(k): ("" if pd.isna(v) else v) for k, v in barcode_df.iloc[preview_idx].to_dict().items()}
+            if df.index[preview_idx] in invalid_barcode_rows:
+                st.warning(f"Record {preview_idx+1} has an invalid EAN; its barcode is left blank and the row is skipped on export.")
+            tune_ph = st.selectbox("Fast tuning (dx / dy / scale)", ["Off"] + [ph for ph in placeholders if ph in st.session_state.mapping],
+                                   key="tune_ph", help="Renders everything except this placeholder once, then re-renders only its own layer on each change.")
             try:
-                filled = apply_mapping_to_svg(sanitized_template, st.session_state.mapping, rec)
-                png = render_svg_to_png(filled, scale=st.session_state.preview_scale)
-                preview_box.image(png, caption=f"Preview of record {preview_idx+1}", use_container_width=True)
+                tuned = False
+                if tune_ph != "Off":
+                    t0 = time.perf_counter()
+                    # base key leaves out the tuned placeholder's dx/dy/scale so slider moves reuse it
+                    tuned_cfg = {k: v for k, v in st.session_state.mapping[tune_ph].items() if k not in ("dx", "dy", "scale")}
+                    base_mapping = {**st.session_state.mapping, tune_ph: tuned_cfg}
+                    base_key = render_cache.cache_key(RENDER_VERSION, "tune-base", sanitized_template, base_mapping, rec,
+                                                      tune_ph, st.session_state.preview_scale)
+                    cached_base = st.session_state.get("_tune_base")
+                    if cached_base is None or cached_base[0] != base_key:
+                        base_tpl, layer_tpl, above_tpl = split_template_layers(sanitized_template, only={tune_ph})
+                        if base_tpl is None:
+                            # the tuned text is painted first: nothing to reuse underneath, so render in full
+                            cached_base = (base_key, None, None, None, None)
+                        else:
+                            # the tuned layer is composited between what is painted below and above it
+                            below_png, above_png = (None if tpl is None else RENDER_CACHE.get_or_create(
+                                "preview", render_cache.cache_key(base_key, part), lambda tpl=tpl: render_svg_to_png(
+                                    apply_mapping_to_svg(tpl, st.session_state.mapping, rec, barcodes_canonical=True),
+                                    scale=st.session_state.preview_scale))
+                                for part, tpl in (("below", base_tpl), ("above", above_tpl)))
+                            cached_base = (base_key, png_to_rgba(below_png), layer_tpl,
+                                           png_to_rgba(above_png) if above_png is not None else None,
+                                           _svg_size_mm(sanitized_template)[2])
+                        st.session_state["_tune_base"] = cached_base
+                    _, base_rgba, layer_tpl, above_rgba, view_box = cached_base
+                    if base_rgba is not None:
+                        layer_svg = apply_mapping_to_svg(layer_tpl, st.session_state.mapping, rec, barcodes_canonical=True)
+                        patch = render_layer_patch(layer_svg, (base_rgba.shape[1], base_rgba.shape[0]), view_box,
+                                                   scale=st.session_state.preview_scale)
+                        frame = utils.composite_rgba(base_rgba, *patch) if patch is not None else base_rgba
+                        if above_rgba is not None:
+                            frame = utils.composite_rgba(frame, above_rgba, 0, 0)
+                        preview_box.image(frame, caption=f"Preview of record {preview_idx+1} — tuning {tune_ph} "
+                                                         f"({(time.perf_counter() - t0) * 1000:.0f} ms)", use_container_width=True)
+                        png = utils.label_array_to_png(frame) if pin_preview else None
+                        tuned = True
+                if not tuned:
+                    preview_key = render_cache.cache_key(RENDER_VERSION, "preview", sanitized_template,
+                                                         st.session_state.mapping, rec, st.session_state.preview_scale)
+                    caption = f"Preview of record {preview_idx+1}"
+                    job = st.session_state.get("_preview_job")
+                    if job is not None and job["key"] != preview_key:
+                        # user moved on: drop the stale render (a running cairosvg call finishes but is ignored)
+                        job["cancel"].set()
+                        job["future"].cancel()
+                        job = st.session_state["_preview_job"] = None
+                    png = None
+                    render_now = _fragment is None
+                    if job is not None and job["future"].done():
+                        fut = job["future"]
+                        if not fut.cancelled() and fut.exception() is None:
+                            png = fut.result()
+                        if png is None:
+                            # background render failed: redo it here so the error is reported below
+                            job = st.session_state["_preview_job"] = None
+                            render_now = True
+                    if png is None and not render_now:
+                        png = RENDER_CACHE.get("preview", preview_key)
+                    if png is not None or render_now:
+                        if png is None:
+                            png = render_svg_to_png(
+                                apply_mapping_to_svg(sanitized_template, st.session_state.mapping, rec, barcodes_canonical=True),
+                                scale=st.session_state.preview_scale)
+                            RENDER_CACHE.put("preview", preview_key, png)
+                        preview_box.image(png, caption=caption, use_container_width=True)
+                    else:
+                        if job is None:
+                            filled = apply_mapping_to_svg(sanitized_template, st.session_state.mapping, rec, barcodes_canonical=True)
+                            cancel = threading.Event()
+                            def _full_render(svg=filled, key=preview_key, scale=st.session_state.preview_scale, cancel=cancel):
+                                if cancel.is_set():
+                                    return None
+                                full = render_svg_to_png(svg, scale=scale)
+                                RENDER_CACHE.put("preview", key, full)
+                                return full
+                            job = {"key": preview_key, "cancel": cancel, "draft": render_svg_draft_png(filled),
+                                   "future": _preview_executor().submit(_full_render)}
+                            st.session_state["_preview_job"] = job
+                        png = job["draft"]
+                        preview_box.empty()
+
+                        @_fragment(run_every=0.3)
+                        def _progressive_preview():
+                            job = st.session_state.get("_preview_job")
+                            if job is None:
+                                return
+                            if job["future"].done():
+                                # full render is in: rerun once so the main pass shows it and polling stops
+                                st.rerun()
+                            st.image(job["draft"], caption=f"{caption} — draft, full quality rendering…", use_container_width=True)
+
+                        _progressive_preview()
                 if pin_preview:
                     b64 = base64.b64encode(png).decode("ascii")
                     overlay_html = f'''
@@ -759,58 +835,373 @@ with right_col:
                 preview_box.error(f"Preview rendering failed: {e}")
 
 # ---------- Generate / Export ----------
-if st.button("Generate") and sanitized_template and df is not None and not df.empty and st.session_state.get("mapping"):
+generate = st.button("Generate") and export_targets and df is not None and not df.empty
+if generate and sharded is not None:
+    if invalid_barcode_rows:
+        st.warning(f"Skipping {len(invalid_barcode_rows)} row(s) with invalid EANs (see Barcode check).")
+    if outline_text:
+        st.warning("Text outlining is not run by shard workers; sharded files keep live text.")
+    records = [(idx, {str(k): ("" if pd.isna(v) else v) for k, v in row.to_dict().items()})
+               for idx, row in barcode_df.iterrows() if idx not in invalid_barcode_rows]
+    job, job_dir = None, None
+    try:
+        # job folders hold customer records: only under the configured root, and never kept for long
+        shard_export.prune_jobs()
+        job_dir = shard_export.job_dir_under(shard_export.job_root(), sharded["subfolder"],
+                                             f"job-{time.strftime('%Y%m%d-%H%M%S')}-{username}")
+        job = shard_export.write_job(job_dir, export_targets, records, export_format, name_field_hint,
+                                     sharded["shards"], sharded["by"], raster, optimise_pdfs)
+    except Exception as e:
+        st.error(f"Could not plan the sharded job{f' in {job_dir}' if job_dir else ''}: {e}")
+        if job_dir is not None:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    if job is not None and sharded["plan_only"]:
+        st.info(f"Planned {job['records']} record(s) in {job['shards']} shard(s) under `{job_dir}`. On hosts sharing "
+                f"that folder run `python shard_export.py work {job_dir} --shard N` for N = 0…{job['shards'] - 1}, "
+                f"then `python shard_export.py merge {job_dir} --out variable_files.zip`. The folder is deleted "
+                f"{float(os.environ.get('SHARD_JOB_RETENTION_HOURS', '24')):g} h after its last change.")
+    elif job is not None:
+        export_t0 = time.perf_counter()
+        # one worker process per CPU at most; the remaining shards queue
+        workers = shard_export.LocalWorkers(job_dir)
+        progress = st.progress(0.0, text=f"Exporting {job['records']} record(s) in {job['shards']} shard(s)…")
+        while workers.poll() and not workers.failed:
+            done = len(shard_export.shard_status(job_dir)["done"])
+            progress.progress(done / job["shards"], text=f"{done}/{job['shards']} shard(s) done, "
+                                                         f"{len(workers.running)} running…")
+            time.sleep(0.5)
+        workers.terminate()
+        progress.empty()
+        failed = workers.failed
+        if failed:
+            st.error(f"{len(failed)} shard worker(s) failed; first error (shard {failed[0]}):\n\n"
+                     f"{shard_export.worker_log_tail(job_dir, failed[0])}")
+            shutil.rmtree(job_dir, ignore_errors=True)
+        else:
+            merged = job_dir / "variable_files.zip"
+            info = shard_export.merge_shards(job_dir, merged)
+            for warning in info["warnings"]:
+                st.warning(warning)
+            if info["files"]:
+                # the job folder (records included) goes as soon as the ZIP has been handed over
+                offer_download(merged, "variable_files.zip", discard_dir=job_dir)
+                st.success(f"Exported {info['files']} files in {time.perf_counter() - export_t0:.1f} s.")
+                st.caption(f"{job['shards']} shard(s) by {'file-name hash' if job['shard_by'] == 'hash' else 'row range'}: "
+                           f"{info['worker_seconds']:.1f} s of worker time, merge {info['seconds']:.1f} s, "
+                           f"{info['bytes'] / 2**20:.1f} MB.")
+            else:
+                st.warning("No rows matched placeholders or no files were generated.")
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+if generate and sharded is None:
     files_out = []
-    pdf_pages = []
-    for idx, row in df.iterrows():
-        rec = {str(k): ("" if pd.isna(v) else v) for k, v in row.to_dict().items()}
-        matched = any(rec.get(cfg["col"], "") not in ("", None) for cfg in st.session_state.mapping.values())
-        if not matched:
-            continue
+    # combined-PDF pages per target template
+    pdf_pages = {t["name"]: [] for t in export_targets}
+    # with several templates every output goes into a folder named after its template
+    fanout = len(export_targets) > 1
+    governor = utils.ExportMemoryGovernor(export_budget_mb)
+    zip_payload = None
+    exported_count = 0
+    budget_error = None
+    opt_totals = None
+    zip_dir = None
+    export_t0 = time.perf_counter()
+    raster_totals = {"files": 0, "pixels": 0, "bytes": 0, "seconds": 0.0}
+    outliner = None
+    if outline_text:
         try:
-            final_svg = apply_mapping_to_svg(sanitized_template, st.session_state.mapping, rec)
-        except Exception as e:
-            st.warning(f"Row {idx+1}: mapping error: {e} — skipped")
-            continue
-        fname_base = rec.get(name_field_hint, f"record_{idx+1:03d}") if name_field_hint else f"record_{idx+1:03d}"
-        safe = re.sub(r"[^A-Za-z0-9._-]", "_", fname_base)
+            outliner = text_outline.OutlinePool()
+        except text_outline.InkscapeUnavailable as e:
+            st.warning(f"Text outlining skipped: {e}")
+    # (row, target, prefix, file stem, filled SVG) waiting for the next outline batch
+    to_outline = []
+    # per-template imposition state: layout, variable layer to fill, cells waiting for the current sheet
+    impose = {}
+    if imposition is not None:
+        shared_layer = importlib.util.find_spec("pikepdf") is not None
+        for target in export_targets:
+            w_mm, h_mm, view_box = _svg_size_mm(target["svg"])
+            layout = utils.compute_nup_layout(imposition["sheet_w_mm"], imposition["sheet_h_mm"], w_mm, h_mm,
+                                              imposition["gap_mm"], imposition["bleed_mm"], imposition["margin_mm"])
+            if layout["per_sheet"] == 0:
+                st.error(f"{target['name']}: a {w_mm:.1f}×{h_mm:.1f} mm label does not fit on the sheet — not imposed.")
+                continue
+            below_svg, variable_svg, above_svg = (split_template_layers(target["svg"]) if shared_layer
+                                                  else (None, target["svg"], None))
+            impose[target["name"]] = {"layout": layout, "view_box": view_box, "size_mm": (w_mm, h_mm),
+                                      "below_svg": below_svg, "variable_svg": variable_svg, "above_svg": above_svg,
+                                      "pending": [], "cells_per_sheet": []}
+            st.info(f"{target['name']}: {layout['cols']}×{layout['rows']} = {layout['per_sheet']}-up "
+                    f"({w_mm:.1f}×{h_mm:.1f} mm on {imposition['sheet_w_mm']:.0f}×{imposition['sheet_h_mm']:.0f} mm)")
+        if not shared_layer:
+            st.warning("pikepdf is not installed: every cell draws the full template and sheets are exported as separate PDFs.")
+
+    def _outline_one(svg_text: str, what: str) -> str:
+        if outliner is None:
+            return svg_text
+        outlined = outliner.outline_many([svg_text])[0]
+        if outlined is None:
+            st.warning(f"{what}: text outlining failed — exported with live text")
+            return svg_text
+        return outlined
+
+    def _emit_outputs(idx, target, prefix: str, safe: str, final_svg: str):
         if export_format in ("SVG only", "PDF + SVG"):
-            files_out.append((f"{safe}.svg", final_svg.encode("utf-8")))
-        if export_format in ("PDF only", "PDF + SVG") or export_mode == "Single combined PDF":
+            files_out.append(governor.hold(f"{prefix}{safe}.svg", final_svg.encode("utf-8")))
+        if raster is not None:
+            try:
+                # rasters go straight to the spill directory; they can be far larger than RAM allows
+                raster_path = governor.spill_path(f"{safe}.{raster['ext']}")
+                info = export_raster_tiled(final_svg, raster_path, raster["ext"], raster["dpi"], raster["tile_px"])
+                files_out.append((f"{prefix}{safe}.{raster['ext']}", raster_path))
+                raster_totals["files"] += 1
+                raster_totals["pixels"] += info["width"] * info["height"]
+                raster_totals["bytes"] += info["bytes"]
+                raster_totals["seconds"] += info["seconds"]
+            except Exception as e:
+                st.warning(f"Row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: raster export failed: {e}")
+        if imposition is None and (export_format in ("PDF only", "PDF + SVG") or export_mode == "Single combined PDF"):
             try:
-                pdf_bytes = svg_to_pdf_bytes(final_svg)
+                pdf_bytes = cached_svg_to_pdf_bytes(final_svg)
                 if export_mode.startswith("One"):
-                    files_out.append((f"{safe}.pdf", pdf_bytes))
+                    files_out.append(governor.hold(f"{prefix}{safe}.pdf", pdf_bytes))
                 else:
-                    pdf_pages.append(pdf_bytes)
+                    pages = pdf_pages[target["name"]]
+                    pages.append(governor.hold(f"{prefix}page_{len(pages)+1:03d}.pdf", pdf_bytes))
             except Exception as e:
-                st.warning(f"Row {idx+1}: PDF generation failed: {e}")
+                st.warning(f"Row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: PDF generation failed: {e}")
+
+    def _drain_outlines():
+        # one call per batch: the Inkscape shells stay up, only the files change
+        outlined = outliner.outline_many([item[-1] for item in to_outline])
+        for (idx, target, prefix, safe, final_svg), svg_text in zip(to_outline, outlined):
+            if svg_text is None:
+                st.warning(f"Row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: text outlining failed — exported with live text")
+                svg_text = final_svg
+            _emit_outputs(idx, target, prefix, safe, svg_text)
+        to_outline.clear()
+
+    def _flush_sheet(tpl_name: str):
+        ctx = impose[tpl_name]
+        if not ctx["pending"]:
+            return
+        sheet_svg = build_sheet_svg(ctx["pending"], ctx["layout"], ctx["view_box"], imposition["crop_marks"])
+        pages = pdf_pages[tpl_name]
+        prefix = f"{tpl_name}/" if fanout else ""
+        sheet_svg = _outline_one(sheet_svg, f"{prefix}sheet_{len(pages)+1:03d}")
+        pages.append(governor.hold(f"{prefix}sheet_{len(pages)+1:03d}.pdf", svg_to_pdf_bytes(sheet_svg)))
+        ctx["cells_per_sheet"].append(len(ctx["pending"]))
+        ctx["pending"] = []
 
-    if export_mode == "Single combined PDF" and pdf_pages:
-        combined = None
-        try:
-            from PyPDF2 import PdfReader, PdfWriter
-            writer = PdfWriter()
-            for pb in pdf_pages:
-                reader = PdfReader(io.BytesIO(pb))
-                for p in reader.pages:
-                    writer.add_page(p)
-            outb = io.BytesIO()
-            writer.write(outb)
-            combined = outb.getvalue()
-        except Exception:
-            for i, pb in enumerate(pdf_pages, start=1):
-                files_out.append((f"page_{i:03d}.pdf", pb))
-        if combined:
-            files_out.append(("combined.pdf", combined))
-
-    if files_out:
-        st.download_button("Download ZIP", bundle_zip(files_out), file_name="variable_files.zip")
-        st.success(f"Exported {len(files_out)} files.")
+    try:
+        governor.start()
+        in_batch = 0
+        if invalid_barcode_rows:
+            st.warning(f"Skipping {len(invalid_barcode_rows)} row(s) with invalid EANs (see Barcode check).")
+        for idx, row in barcode_df.iterrows():
+            if idx in invalid_barcode_rows:
+                continue
+            rec = {str(k): ("" if pd.isna(v) else v) for k, v in row.to_dict().items()}
+            safe = record_file_stem(rec, idx, name_field_hint)
+            # barcode fragments are generated once per record and shared by every template
+            fragments = {}
+            for target in export_targets:
+                mapping = target["mapping"]
+                prefix = f"{target['name']}/" if fanout else ""
+                matched = any(rec.get(cfg["col"], "") not in ("", None) for cfg in mapping.values())
+                if not matched:
+                    continue
+                if imposition is not None:
+                    if target["name"] not in impose:
+                        continue
+                    ctx = impose[target["name"]]
+                    try:
+                        ctx["pending"].append(apply_mapping_to_svg(ctx["variable_svg"], mapping, rec, barcodes_canonical=True,
+                                                                   fragment_cache=fragments))
+                    except Exception as e:
+                        st.warning(f"Row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: mapping error: {e} — skipped")
+                    if len(ctx["pending"]) >= ctx["layout"]["per_sheet"]:
+                        try:
+                            _flush_sheet(target["name"])
+                        except Exception as e:
+                            st.warning(f"Sheet ending at row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: PDF generation failed: {e}")
+                            ctx["pending"] = []
+                    if export_format not in ("SVG only", "PDF + SVG") and raster is None:
+                        continue
+                try:
+                    final_svg = apply_mapping_to_svg(target["svg"], mapping, rec, barcodes_canonical=True,
+                                                     fragment_cache=fragments)
+                except Exception as e:
+                    st.warning(f"Row {idx+1}{' (' + target['name'] + ')' if fanout else ''}: mapping error: {e} — skipped")
+                    continue
+                if outliner is None:
+                    _emit_outputs(idx, target, prefix, safe, final_svg)
+                else:
+                    to_outline.append((idx, target, prefix, safe, final_svg))
+                    if len(to_outline) >= outliner.batch_size * outliner.processes:
+                        _drain_outlines()
+            in_batch += 1
+            if in_batch >= governor.batch_size:
+                in_batch = 0
+                governor.checkpoint(files_out, *pdf_pages.values(), where=f"at row {idx+1}")
+        if to_outline:
+            _drain_outlines()
+
+        for tpl_name, ctx in impose.items():
+            try:
+                _flush_sheet(tpl_name)
+            except Exception as e:
+                st.warning(f"Last sheet{' (' + tpl_name + ')' if fanout else ''}: PDF generation failed: {e}")
+            pages = pdf_pages[tpl_name]
+            if not pages:
+                continue
+            prefix = f"{tpl_name}/" if fanout else ""
+            try:
+                shared = {}
+                for layer in ("below", "above"):
+                    if ctx[f"{layer}_svg"] is not None:
+                        layer_svg = bleed_box_svg(ctx[f"{layer}_svg"], ctx["size_mm"], ctx["view_box"], ctx["layout"]["bleed_mm"])
+                        shared[layer] = svg_to_pdf_bytes(_outline_one(layer_svg, f"{prefix}shared layer ({layer})"))
+                imposed = utils.merge_sheets_with_shared_layer([pb for _, pb in pages], shared.get("below"), ctx["layout"],
+                                                               ctx["cells_per_sheet"], above_pdf=shared.get("above"))
+                files_out.append(governor.hold(f"{prefix}imposed.pdf", imposed))
+            except Exception:
+                files_out.extend(pages)
+            pdf_pages[tpl_name] = []
+            governor.checkpoint(files_out, *pdf_pages.values(), where="after imposing")
+
+        for tpl_name, pages in pdf_pages.items():
+            if export_mode != "Single combined PDF" or not pages:
+                continue
+            prefix = f"{tpl_name}/" if fanout else ""
+            combined = None
+            try:
+                from PyPDF2 import PdfReader, PdfWriter
+                writer = PdfWriter()
+                for i, (_, pb) in enumerate(pages, start=1):
+                    reader = PdfReader(str(pb) if isinstance(pb, Path) else io.BytesIO(pb))
+                    for p in reader.pages:
+                        writer.add_page(p)
+                    if i % governor.batch_size == 0:
+                        governor.checkpoint(files_out, *pdf_pages.values(), where=f"while merging page {i}")
+                if governor.spilling:
+                    combined = governor.spill_path("combined.pdf")
+                    with open(combined, "wb") as fh:
+                        writer.write(fh)
+                else:
+                    outb = io.BytesIO()
+                    writer.write(outb)
+                    combined = outb.getvalue()
+                del writer
+            except utils.MemoryBudgetExceeded:
+                raise
+            except Exception:
+                files_out.extend(pages)
+            if combined:
+                files_out.append((f"{prefix}combined.pdf", combined))
+            pdf_pages[tpl_name] = []
+            governor.checkpoint(files_out, *pdf_pages.values(), where="after merging")
+
+        export_seconds = time.perf_counter() - export_t0
+        if optimise_pdfs:
+            opt_totals = {"files": 0, "before": 0, "after": 0, "streams": 0, "seconds": 0.0, "error": None}
+            for i, (fname, data) in enumerate(files_out):
+                if not fname.lower().endswith(".pdf"):
+                    continue
+                try:
+                    optimised, info = utils.optimise_pdf_bytes(data.read_bytes() if isinstance(data, Path) else data)
+                except ImportError:
+                    opt_totals["error"] = "pikepdf is not installed; PDFs were left as rendered."
+                    break
+                except Exception as e:
+                    st.warning(f"{fname}: PDF optimisation failed: {e} — kept as rendered")
+                    continue
+                if isinstance(data, Path):
+                    data.write_bytes(optimised)
+                else:
+                    files_out[i] = (fname, optimised)
+                opt_totals["files"] += 1
+                opt_totals["before"] += info["before_bytes"]
+                opt_totals["after"] += info["after_bytes"]
+                opt_totals["streams"] += info["deduped_streams"]
+                opt_totals["seconds"] += info["seconds"]
+                if opt_totals["files"] % governor.batch_size == 0:
+                    governor.checkpoint(files_out, where="while optimising PDFs")
+
+        exported_count = len(files_out)
+        if files_out:
+            if governor.spilling or any(isinstance(data, Path) for _, data in files_out):
+                # spilled outputs and rasters are already on disk: the ZIP goes to disk too, outside the
+                # spill directory so it outlives governor.close(); streamed, never read back
+                zip_dir = Path(tempfile.mkdtemp(prefix="export_zip_"))
+                zip_payload = bundle_zip(files_out, dest=zip_dir / "variable_files.zip")
+                files_out = []
+                governor.checkpoint(where="after zipping")
+            else:
+                zip_payload = bundle_zip(files_out)
+            governor.sample()
+    except utils.MemoryBudgetExceeded as e:
+        budget_error = e
+        files_out, pdf_pages, zip_payload = [], {}, None
+        if zip_dir is not None:
+            shutil.rmtree(zip_dir, ignore_errors=True)
+    finally:
+        governor.close()
+        if outliner is not None:
+            outliner.close()
+
+    mem = governor.summary()
+    mem_msg = f"Peak memory: {mem['peak_rss_mb']} MB RSS"
+    if mem["peak_traced_mb"] is not None:
+        mem_msg += f", {mem['peak_traced_mb']} MB Python heap (tracemalloc)"
+    if mem["budget_mb"] is not None:
+        mem_msg += f" — budget {mem['budget_mb']} MB"
+    if mem["spilled_files"]:
+        mem_msg += f"; spilled {mem['spilled_files']} file(s) / {mem['spilled_mb']} MB to disk"
+    if mem["concurrent_exports"] > 1:
+        mem_msg += f" (process-wide figures, shared with up to {mem['concurrent_exports'] - 1} other export(s))"
+    if budget_error is not None:
+        st.error(f"Export stopped: memory budget exceeded — {budget_error}")
+    elif zip_payload:
+        offer_download(zip_payload, "variable_files.zip", discard_dir=zip_dir)
+        st.success(f"Exported {exported_count} files in {export_seconds:.1f} s.")
+        if raster_totals["files"]:
+            st.info(f"Rasters: {raster_totals['files']} file(s) at {raster['dpi']} DPI, "
+                    f"{raster_totals['pixels'] / 1e6:.0f} Mpx, {raster_totals['bytes'] / 2**20:.1f} MB, "
+                    f"{raster_totals['seconds']:.1f} s ({raster_totals['pixels'] / 1e6 / max(raster_totals['seconds'], 1e-6):.1f} Mpx/s)")
+        if outliner is not None and outliner.stats["files"]:
+            ostats = outliner.stats
+            st.info(f"Text outlining: {ostats['files']} file(s) in {ostats['seconds']:.1f} s "
+                    f"({ostats['files'] / max(ostats['seconds'], 1e-6):.1f} files/s) on {outliner.processes} "
+                    f"Inkscape process(es), {ostats['batches']} batch(es), {outliner.version}"
+                    + (f"; {ostats['failed']} kept live text" if ostats["failed"] else ""))
+        if opt_totals is not None:
+            if opt_totals["error"]:
+                st.warning(opt_totals["error"])
+            elif opt_totals["files"]:
+                saved = 1 - opt_totals["after"] / opt_totals["before"] if opt_totals["before"] else 0.0
+                st.info(f"PDF optimisation: {opt_totals['files']} PDF(s), "
+                        f"{opt_totals['before'] / 2**20:.2f} MB → {opt_totals['after'] / 2**20:.2f} MB ({saved:.0%} smaller), "
+                        f"{opt_totals['streams']} duplicate stream(s) merged, {opt_totals['seconds']:.1f} s "
+                        f"(export before optimisation: {export_seconds:.1f} s)")
     else:
         st.warning("No rows matched placeholders or no files were generated.")
+    st.caption(mem_msg)
 
 # Footer
 if role == "Editor":
+    with st.sidebar:
+        st.markdown("---")
+        st.header("Render cache")
+        cstats = RENDER_CACHE.stats()
+        if not RENDER_CACHE.enabled:
+            st.caption("Disabled (RENDER_CACHE_MAX_MB=0 or cache dir not writable).")
+        else:
+            st.caption(f"{cstats['entries']} entries, {cstats['size_mb']} / {cstats['max_mb']} MB at {RENDER_CACHE.root}")
+            for kind, ks in cstats["kinds"].items():
+                st.caption(f"{kind}: {ks['hit_rate']:.0%} hit rate ({ks['hits']} hits / {ks['misses']} misses)")
+            if st.button("Clear render cache"):
+                RENDER_CACHE.clear()
+                st.rerun()
     st.markdown("---")
     st.markdown("**Editor note:** Pin the preview to keep it visible while you scroll the page.")
@@ -0,0 +1,147 @@
+# download_server.py
+# Streams finished exports from disk. st.download_button keeps the whole payload in memory
+# (and Streamlit's static file route stops at 200 MB), so ZIPs that were built on disk are
+# published here instead: each file gets an unguessable token folder and is sent in 1 MB
+# chunks by a small HTTP server thread running next to the app. Files expire after the
+# retention period. Opt-in: the server only runs when both a port and the public URL that
+# reaches it are configured, so nothing listens on a port the deployment did not ask for.
+#
+#   DOWNLOAD_PORT            port of the download server (default 0: disabled)
+#   DOWNLOAD_BASE_URL        public URL that reaches that port, e.g. https://example.com/dl
+#                            behind a reverse proxy (required; unset disables the server)
+#   DOWNLOAD_DIR             where published files live (default <tmp>/packdeal_downloads)
+#   DOWNLOAD_RETENTION_MIN   minutes a published file stays available (default 60)
+
+import mimetypes
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote, unquote
+
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{20,}$")
+CHUNK = 1 << 20
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "PackdealDownload/1"
+
+    def _resolve(self) -> Optional[Path]:
+        parts = unquote(self.path.split("?", 1)[0]).strip("/").split("/")
+        if len(parts) != 2 or not _TOKEN_RE.match(parts[0]) or parts[1] in ("", ".", ".."):
+            return None
+        path = self.server.root / parts[0] / parts[1]
+        return path if path.is_file() else None
+
+    def _headers(self, path: Path) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(path.name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(path.name)}")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._resolve()
+        if path is None:
+            self.send_error(404)
+            return
+        self._headers(path)
+
+    def do_GET(self):
+        path = self._resolve()
+        if path is None:
+            self.send_error(404)
+            return
+        try:
+            with open(path, "rb") as fh:
+                self._headers(path)
+                shutil.copyfileobj(fh, self.wfile, CHUNK)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # browser cancelled the download
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadServer:
+    """Publishes files under token URLs and serves them until they expire."""
+
+    def __init__(self, root, host: str = "0.0.0.0", port: int = 8502, retention_s: float = 3600,
+                 base_url: str = ""):
+        self.root = Path(root)
+        self.host, self.port = host, int(port)
+        self.retention_s = retention_s
+        self.base_url = base_url.rstrip("/")
+        self._httpd = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> Optional["DownloadServer"]:
+        """Server configured from DOWNLOAD_* variables; None unless DOWNLOAD_PORT and DOWNLOAD_BASE_URL are set."""
+        port = int(os.environ.get("DOWNLOAD_PORT", "0") or 0)
+        base_url = os.environ.get("DOWNLOAD_BASE_URL", "").strip()
+        if port <= 0 or not base_url:
+            return None
+        root = os.environ.get("DOWNLOAD_DIR") or Path(tempfile.gettempdir()) / "packdeal_downloads"
+        return cls(root, port=port, retention_s=float(os.environ.get("DOWNLOAD_RETENTION_MIN", "60")) * 60,
+                   base_url=base_url)
+
+    def start(self) -> "DownloadServer":
+        """Bind and serve in background threads; raises OSError when the port cannot be bound."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.prune()
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.root = self.root
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, name="download-server", daemon=True).start()
+        threading.Thread(target=self._janitor, name="download-janitor", daemon=True).start()
+        return self
+
+    def _janitor(self):
+        while not self._stop.wait(min(300.0, max(self.retention_s / 4, 1.0))):
+            self.prune()
+
+    def publish(self, path, file_name: str) -> str:
+        """Move `path` under a fresh token folder; returns the URL path (/token/file_name)."""
+        token = secrets.token_urlsafe(24)
+        folder = self.root / token
+        folder.mkdir(parents=True)
+        # same filesystem: a rename; otherwise a chunked copy - never read into memory
+        shutil.move(str(path), str(folder / file_name))
+        return f"/{token}/{quote(file_name)}"
+
+    def url_for(self, url_path: str, request_host: str = "") -> str:
+        if self.base_url:
+            return self.base_url + url_path
+        host = request_host or "localhost"
+        if not host.endswith("]"):
+            host = host.rsplit(":", 1)[0]
+        return f"http://{host}:{self.port}{url_path}"
+
+    def prune(self) -> int:
+        """Delete published files older than the retention period. Returns how many were removed."""
+        removed = 0
+        cutoff = time.time() - self.retention_s
+        for folder in self.root.iterdir() if self.root.is_dir() else ():
+            try:
+                if folder.is_dir() and _TOKEN_RE.match(folder.name) and folder.stat().st_mtime < cutoff:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def close(self):
+        self._stop.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
@@ -0,0 +1,274 @@
+# loadtest.py
+# Multi-session load test for app.py, built on Streamlit's AppTest (no server, no browser,
+# no network). All simulated operators live in this one process, one thread and one AppTest
+# session each, driven through AppTest's public API only. Like the sessions of one server
+# they share st.cache_resource / st.cache_data, the render cache, memory and the GIL.
+#
+# What is measured, and how it differs from a server: AppTest installs a process-global
+# runtime for the length of every rerun, so two AppTest reruns cannot overlap in one process.
+# Reruns from different sessions therefore take turns on a lock. Each rerun is reported as
+# its run time (the script executing, with the other sessions' background preview renders
+# competing for the CPU) plus the time it queued behind other sessions' reruns. A server
+# interleaves concurrent reruns under the GIL instead of queueing them whole, so a long
+# export delays other sessions' previews less than here; queued time is a pessimistic
+# bound, run time is comparable. AppTest also recompiles app.py on every rerun, which a
+# server does once, so run times carry that compile time.
+#
+# Each session: log in -> upload template + data -> change mapping widgets -> preview rows
+# -> press Generate. For every session count the report gives rerun latency percentiles
+# (overall, per step, and the queued share), export throughput and the process's memory.
+#
+#   python loadtest.py --sessions 1,2,4,8 --rows 200
+#   python loadtest.py --sessions 4 --template my.svg --data my.csv --json report.json
+#
+# Needs a Streamlit whose AppTest can drive st.file_uploader; checked at startup.
+
+import argparse
+import io
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import streamlit
+from streamlit.testing.v1 import AppTest
+
+import utils
+
+APP_PATH = Path(__file__).with_name("app.py")
+DEFAULT_USER = ("Emdaduljs", "123")
+# AppTest.run swaps a process-global runtime in and out, so only one session reruns at a time
+_RUN_LOCK = threading.Lock()
+
+
+def synthetic_inputs(rows: int, seed: int = 0) -> tuple:
+    """A 60×40 mm label template (three text placeholders + one EAN) and a matching CSV."""
+    svg = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="60mm" height="40mm" viewBox="0 0 226.8 151.2">'
+        '<rect x="2" y="2" width="222.8" height="147.2" fill="none" stroke="#000" stroke-width="1"/>'
+        '<text x="10" y="24" font-family="DejaVu Sans" font-size="14" font-weight="bold">{{Brand}}</text>'
+        '<text x="10" y="46" font-family="DejaVu Sans" font-size="11">{{Name}}</text>'
+        '<text x="160" y="46" font-family="DejaVu Sans" font-size="16" font-weight="bold">{{Price}}</text>'
+        '<text x="10" y="120" font-family="DejaVu Sans" font-size="10">{{EAN}}</text>'
+        '</svg>'
+    ).encode("utf-8")
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    out.write("Brand,Name,Price,EAN\n")
+    for i in range(rows):
+        base = f"{590000000000 + rnd.randrange(10**9):012d}"
+        ean = base + utils.calculate_ean13_checksum(base)
+        out.write(f"Brand {i % 7},Product {i + 1},{rnd.randrange(99, 9999) / 100:.2f},{ean}\n")
+    return svg, out.getvalue().encode("utf-8")
+
+
+class RssSampler(threading.Thread):
+    """Samples process RSS in the background and keeps the peak."""
+
+    def __init__(self, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = utils.current_rss_bytes()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, utils.current_rss_bytes())
+
+    def stop(self) -> int:
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+def check_streamlit() -> None:
+    """Exit with a clear message when this Streamlit's AppTest cannot drive the app's uploaders."""
+    if not hasattr(AppTest, "file_uploader"):
+        sys.exit(f"loadtest needs a Streamlit whose AppTest supports st.file_uploader; "
+                 f"{streamlit.__version__} does not. Upgrade streamlit to run the load test.")
+
+
+def _by_label(widgets, prefix: str):
+    for w in widgets:
+        if w.label.startswith(prefix):
+            return w
+    raise LookupError(f"no widget labelled {prefix!r}")
+
+
+class SimulatedSession:
+    """One operator walking through the app; every rerun is timed and tagged with its step."""
+
+    def __init__(self, app_path, template: tuple, data: tuple, user=DEFAULT_USER, previews: int = 3,
+                 edits: int = 3, timeout: float = 600, seed: int = 0):
+        self.app_path = str(app_path)
+        self.template, self.data = template, data  # (filename, bytes)
+        self.user = user
+        self.previews, self.edits = previews, edits
+        self.timeout = timeout
+        self.rnd = random.Random(seed)
+        self.reruns = []  # (step, seconds, of which queued)
+        self.errors = []
+        self.export = None
+
+    def _rerun(self, step: str) -> float:
+        """One timed rerun; returns the seconds it ran, not counting the wait for its turn."""
+        t0 = time.perf_counter()
+        with _RUN_LOCK:
+            t1 = time.perf_counter()
+            self.at.run(timeout=self.timeout)
+        t2 = time.perf_counter()
+        self.reruns.append((step, t2 - t0, t1 - t0))
+        for exc in self.at.exception:
+            self.errors.append(f"{step}: {exc.message}")
+        for err in self.at.error:
+            self.errors.append(f"{step}: {err.value}")
+        return t2 - t1
+
+    def run(self) -> "SimulatedSession":
+        self.at = AppTest.from_file(self.app_path, default_timeout=self.timeout)
+        try:
+            self._rerun("open")
+            self.at.selectbox(key="login_user").set_value(self.user[0])
+            self.at.text_input(key="login_pass").set_value(self.user[1])
+            self._rerun("login")
+
+            _by_label(self.at.file_uploader, "SVG Template").set_value((*self.template, "image/svg+xml"))
+            _by_label(self.at.file_uploader, "CSV, XML").set_value((*self.data, "application/octet-stream"))
+            self._rerun("upload")
+
+            type_keys = [w.key for w in self.at.selectbox if (w.key or "").startswith("type_")]
+            barcode_ph = next((k[5:] for k in type_keys if "ean" in k.lower()), None)
+            if barcode_ph:
+                self.at.selectbox(key=f"type_{barcode_ph}").set_value("Barcode EAN13")
+                self._rerun("mapping")
+            dx_keys = [w.key for w in self.at.number_input if (w.key or "").startswith("dx_")]
+            for _ in range(self.edits if dx_keys else 0):
+                self.at.number_input(key=self.rnd.choice(dx_keys)).set_value(round(self.rnd.uniform(-5, 5), 1))
+                self._rerun("mapping")
+
+            row_input = _by_label(self.at.number_input, "Preview row")
+            for _ in range(self.previews):
+                row_input.set_value(self.rnd.randint(int(row_input.min), int(row_input.max)))
+                self._rerun("preview")
+                row_input = _by_label(self.at.number_input, "Preview row")
+
+            _by_label(self.at.button, "Generate").click()
+            seconds = self._rerun("export")
+            m = next((re.search(r"Exported (\d+) files", s.value) for s in self.at.success
+                      if s.value.startswith("Exported")), None)
+            self.export = {"seconds": seconds, "files": int(m.group(1)) if m else 0}
+        except Exception as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+        return self
+
+
+def run_sessions(n_sessions: int, template: tuple, data: tuple, **session_kwargs) -> list:
+    """Run n_sessions simulated operators at once, one thread each in this process; returns the sessions."""
+    # AppTest outside a server logs this bare-mode warning on every rerun
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    sessions = [SimulatedSession(APP_PATH, template, data, seed=i, **session_kwargs) for i in range(n_sessions)]
+    with ThreadPoolExecutor(n_sessions, thread_name_prefix="session") as pool:
+        return list(pool.map(SimulatedSession.run, sessions))
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {}
+    arr = np.asarray(values) * 1000.0
+    return {"n": len(values), "p50_ms": round(float(np.percentile(arr, 50)), 1),
+            "p90_ms": round(float(np.percentile(arr, 90)), 1), "p95_ms": round(float(np.percentile(arr, 95)), 1),
+            "p99_ms": round(float(np.percentile(arr, 99)), 1), "max_ms": round(float(arr.max()), 1)}
+
+
+def run_level(n_sessions: int, template: tuple, data: tuple, **session_kwargs) -> dict:
+    """Run n_sessions simulated operators at once and summarise latency, throughput and memory."""
+    rss_before = utils.current_rss_bytes()
+    sampler = RssSampler()
+    sampler.start()
+    t0 = time.perf_counter()
+    sessions = run_sessions(n_sessions, template, data, **session_kwargs)
+    wall = time.perf_counter() - t0
+    peak = sampler.stop()
+
+    reruns = [r for sess in sessions for r in sess.reruns]
+    exports = [sess.export for sess in sessions if sess.export]
+    export_files = sum(e["files"] for e in exports)
+    return {
+        "sessions": n_sessions,
+        "wall_s": round(wall, 2),
+        "rerun": _percentiles([sec for _, sec, _ in reruns]),
+        "queued": _percentiles([queued for _, _, queued in reruns]),
+        "steps": {step: _percentiles([sec for st_, sec, _ in reruns if st_ == step])
+                  for step in dict.fromkeys(st_ for st_, _, _ in reruns)},
+        # files per second of export run time, and over the whole level
+        "export": {"sessions_done": len(exports), "files": export_files,
+                   "files_per_s": round(export_files / max(sum(e["seconds"] for e in exports), 1e-9), 2) if exports else 0.0,
+                   "aggregate_files_per_s": round(export_files / wall, 2)},
+        "memory": {"rss_before_mb": round(rss_before / 2**20, 1),
+                   "peak_rss_mb": round(peak / 2**20, 1),
+                   "per_session_mb": round((peak - rss_before) / 2**20 / n_sessions, 1)},
+        "errors": [e for sess in sessions for e in sess.errors][:20],
+    }
+
+
+def _print_level(r: dict):
+    rr, q, mem, ex = r["rerun"], r["queued"], r["memory"], r["export"]
+    print(f"\n== {r['sessions']} session(s): {r['wall_s']} s wall ==")
+    if rr:
+        print(f"  reruns {rr['n']}: p50 {rr['p50_ms']} ms, p95 {rr['p95_ms']} ms, p99 {rr['p99_ms']} ms, max {rr['max_ms']} ms")
+        print(f"    of which queued behind other sessions: p50 {q['p50_ms']} ms, p95 {q['p95_ms']} ms, max {q['max_ms']} ms")
+    for step, p in r["steps"].items():
+        print(f"    {step:<8} n={p['n']:<4} p50 {p['p50_ms']:>9} ms  p95 {p['p95_ms']:>9} ms")
+    print(f"  export: {ex['files']} file(s) from {ex['sessions_done']} session(s), "
+          f"{ex['files_per_s']} files/s per session, {ex['aggregate_files_per_s']} files/s aggregate")
+    print(f"  memory: peak RSS {mem['peak_rss_mb']} MB "
+          f"(+{mem['per_session_mb']} MB per session over a {mem['rss_before_mb']} MB baseline)")
+    for e in r["errors"]:
+        print(f"  ! {e}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Concurrent-session load test for the Streamlit app (offline, AppTest based).")
+    ap.add_argument("--sessions", default="1,2,4", help="comma-separated session counts to run, e.g. 1,2,4,8")
+    ap.add_argument("--rows", type=int, default=100, help="rows in the synthetic data set (ignored with --data)")
+    ap.add_argument("--template", type=Path, help="SVG template to upload (default: built-in synthetic label)")
+    ap.add_argument("--data", type=Path, help="data file to upload (default: synthetic CSV)")
+    ap.add_argument("--previews", type=int, default=3, help="preview rows per session")
+    ap.add_argument("--edits", type=int, default=3, help="mapping widget edits per session")
+    ap.add_argument("--timeout", type=float, default=600, help="seconds allowed for a single rerun")
+    ap.add_argument("--clear-caches", action="store_true",
+                    help="clear the render cache and st.cache_data before each level (otherwise earlier levels warm them)")
+    ap.add_argument("--no-warmup", action="store_true", help="skip the untimed warm-up session (render cache and font setup)")
+    ap.add_argument("--json", type=Path, help="also write the report as JSON here")
+    args = ap.parse_args(argv)
+
+    svg, csv = synthetic_inputs(args.rows)
+    template = (args.template.name, args.template.read_bytes()) if args.template else ("loadtest.svg", svg)
+    data = (args.data.name, args.data.read_bytes()) if args.data else ("loadtest.csv", csv)
+
+    check_streamlit()
+    if not args.no_warmup:
+        run_sessions(1, template, data, previews=1, edits=1, timeout=args.timeout)
+
+    report = []
+    for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+        if args.clear_caches:
+            import render_cache
+            render_cache.RenderCache.from_env().clear()
+            streamlit.cache_data.clear()
+        result = run_level(n, template, data, previews=args.previews, edits=args.edits, timeout=args.timeout)
+        _print_level(result)
+        report.append(result)
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1076 @@
+# pipeline.py
+# -*- coding: utf-8 -*-
+# Rendering pipeline shared by the Streamlit app and the export workers: template
+# sanitising, placeholder mapping, barcodes, PDF/PNG/raster rendering, N-up helpers and
+# ZIP bundling. Nothing here touches Streamlit, so worker processes can import it.
+import io
+import os
+import re
+import copy
+import time
+import functools
+import zipfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from lxml import etree
+import cairosvg
+
+# barcode generation via python-barcode (SVGWriter)
+import barcode
+from barcode.writer import SVGWriter
+
+# utils must expose mm_to_px
+import utils
+import render_cache
+from PIL import Image as PILImage
+
+# ---------- Render cache ----------
+# bump RENDER_VERSION whenever a change alters rendered output, so stale cache entries stop matching
+RENDER_VERSION = f"1|cairosvg-{getattr(cairosvg, '__version__', '?')}|barcode-{getattr(barcode, 'version', '?')}"
+# one cache handle per process; the on-disk cache itself is shared by every process on the host
+RENDER_CACHE = render_cache.RenderCache.from_env()
+
+# ---------- Helpers & sanitization ----------
+SVG_NS = "http://www.w3.org/2000/svg"
+
+def _decode_bytes(b: bytes) -> str:
+    for enc in ("utf-8", "utf-8-sig", "latin-1", "cp1252"):
+        try:
+            return b.decode(enc)
+        except Exception:
+            pass
+    return b.decode("utf-8", errors="ignore")
+
+def sanitize_for_preview(svg_bytes: bytes) -> str:
+    if not svg_bytes:
+        raise ValueError("Empty SVG input")
+    raw = _decode_bytes(svg_bytes)
+    raw = raw.lstrip("\ufeff")
+    raw = re.sub(r"<!DOCTYPE[^>[]*(\[[^\]]*\])?>", "", raw, flags=re.IGNORECASE | re.DOTALL)
+    raw = re.sub(r"<!ENTITY[^>]*>", "", raw, flags=re.IGNORECASE | re.DOTALL)
+    raw = re.sub(r'(<\/?)([A-Za-z0-9_]+):([A-Za-z0-9_\-]+)', lambda m: f"{m.group(1)}{m.group(2)}_{m.group(3)}", raw)
+    raw = re.sub(r'(\s)([A-Za-z0-9_]+):([A-Za-z0-9_\-]+)=', lambda m: f"{m.group(1)}{m.group(2)}_{m.group(3)}=", raw)
+    raw = re.sub(r'\s+xmlns:[a-zA-Z0-9_]+="[^"]+"', '', raw)
+    raw = re.sub(r"&([A-Za-z0-9_]+);", lambda m: f"&{m.group(1)};" if m.group(1) in ("lt","gt","amp","quot","apos") else "", raw)
+
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    try:
+        root = etree.fromstring(raw.encode("utf-8"), parser=parser)
+    except Exception:
+        m = re.search(r"(<svg\b[^>]*>.*?</svg>)", raw, flags=re.DOTALL | re.IGNORECASE)
+        if m:
+            frag = m.group(1)
+            root = etree.fromstring(frag.encode("utf-8"), parser=parser)
+        else:
+            raise
+
+    if not (isinstance(root.tag, str) and root.tag.lower().endswith("svg")):
+        cand = root.find(".//{http://www.w3.org/2000/svg}svg") or root.find(".//svg")
+        if cand is not None:
+            root = cand
+        else:
+            found = None
+            for el in root.iter():
+                if isinstance(el.tag, str) and el.tag.lower().endswith("svg"):
+                    found = el
+                    break
+            if found is None:
+                raise ValueError("No <svg> element found")
+            root = found
+
+    if not root.get("xmlns"):
+        root.set("xmlns", SVG_NS)
+    if "version" not in root.attrib:
+        root.set("version", "1.1")
+
+    if "viewBox" not in root.attrib:
+        w = root.get("width"); h = root.get("height")
+        if w and h:
+            try:
+                wn = float(re.match(r"^\s*([0-9.+-eE]+)", w).group(1))
+                hn = float(re.match(r"^\s*([0-9.+-eE]+)", h).group(1))
+                root.set("viewBox", f"0 0 {wn} {hn}")
+            except Exception:
+                pass
+
+    for el in root.iter():
+        style = el.get("style")
+        if style:
+            parts = [p.strip() for p in style.split(";") if p.strip()]
+            seen = {}
+            for p in parts:
+                if ":" in p:
+                    k, v = p.split(":", 1)
+                    seen[k.strip()] = v.strip()
+            el.set("style", "; ".join(f"{k}: {v}" for k, v in seen.items()))
+
+    out = etree.tostring(root, encoding="utf-8", xml_declaration=True, pretty_print=False).decode("utf-8")
+    return out
+
+def ensure_svg_size(svg_text: str) -> str:
+    if "width=" in svg_text and "height=" in svg_text:
+        return svg_text
+    m = re.search(r'viewBox="\s*([\d.\-]+)\s+([\d.\-]+)\s+([\d.\-]+)\s+([\d.\-]+)\s*"', svg_text)
+    if m:
+        w, h = m.group(3), m.group(4)
+        return re.sub(r"<svg", f"<svg width='{w}' height='{h}'", svg_text, count=1)
+    return re.sub(r"<svg", "<svg width='1000' height='1000'", svg_text, count=1)
+
+def render_svg_to_png(svg_text: str, scale: float = 1.0) -> bytes:
+    svg_text = ensure_svg_size(svg_text)
+    internal_scale = max(1.0, scale * 2.0)
+    return cairosvg.svg2png(bytestring=svg_text.encode("utf-8"), scale=internal_scale)
+
+def render_svg_draft_png(svg_text: str, max_px: int = 480) -> bytes:
+    """Quick low-resolution render (longest side ~max_px) shown while the full preview renders."""
+    w_mm, h_mm, _ = _svg_size_mm(svg_text)
+    longest_px = max(w_mm, h_mm) / (25.4 / 96.0)
+    draft_scale = min(1.0, max_px / longest_px) if longest_px > 0 else 1.0
+    return cairosvg.svg2png(bytestring=ensure_svg_size(svg_text).encode("utf-8"), scale=draft_scale)
+
+def svg_to_pdf_bytes(svg_text: str) -> bytes:
+    svg_text = ensure_svg_size(svg_text)
+    return cairosvg.svg2pdf(bytestring=svg_text.encode("utf-8"))
+
+def cached_svg_to_pdf_bytes(svg_text: str) -> bytes:
+    key = render_cache.cache_key(RENDER_VERSION, "pdf", svg_text)
+    return RENDER_CACHE.get_or_create("pdf", key, lambda: svg_to_pdf_bytes(svg_text))
+
+def cached_sanitize_for_preview(svg_bytes: bytes) -> str:
+    key = render_cache.cache_key(RENDER_VERSION, "template", svg_bytes)
+    return RENDER_CACHE.get_or_create("template", key, lambda: sanitize_for_preview(svg_bytes).encode("utf-8")).decode("utf-8")
+
+# ---------- incremental (dirty-region) preview ----------
+def png_to_rgba(png: bytes) -> np.ndarray:
+    return np.asarray(PILImage.open(io.BytesIO(png)).convert("RGBA"))
+
+def render_layer_patch(layer_svg: str, base_size: tuple, view_box: tuple, scale: float = 1.0, probe_px: int = 384):
+    """
+    Render only the inked region of `layer_svg` at preview resolution.
+    A low-res probe of the whole artboard finds the ink bounding box; just that box is then
+    rendered at render_svg_to_png's scale. Returns (rgba_patch, x, y) in pixels of a base
+    preview of `base_size` (w, h), or None when the layer draws nothing on the artboard.
+    """
+    base_w, base_h = base_size
+    vb_x, vb_y, vb_w, vb_h = view_box
+    internal_scale = max(1.0, scale * 2.0)
+    svg_w, svg_h = base_w / internal_scale, base_h / internal_scale
+    layer_svg = ensure_svg_size(layer_svg)
+    probe = png_to_rgba(cairosvg.svg2png(bytestring=layer_svg.encode("utf-8"),
+                                         scale=min(1.0, probe_px / max(svg_w, svg_h))))
+    ys, xs = np.nonzero(probe[:, :, 3])
+    if len(xs) == 0:
+        return None
+    ph, pw = probe.shape[:2]
+    # probe pixels -> base pixels, padded by ~1.5 probe pixels so antialiased edges are not clipped
+    fx, fy = base_w / pw, base_h / ph
+    x0 = max(0, int(np.floor((xs.min() - 1.5) * fx)))
+    y0 = max(0, int(np.floor((ys.min() - 1.5) * fy)))
+    x1 = min(base_w, int(np.ceil((xs.max() + 2.5) * fx)))
+    y1 = min(base_h, int(np.ceil((ys.max() + 2.5) * fy)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    root = etree.fromstring(layer_svg.encode("utf-8"), parser=parser)
+    root.set("viewBox", f"{vb_x + x0 * vb_w / base_w} {vb_y + y0 * vb_h / base_h} "
+                        f"{(x1 - x0) * vb_w / base_w} {(y1 - y0) * vb_h / base_h}")
+    root.set("width", str((x1 - x0) / internal_scale))
+    root.set("height", str((y1 - y0) / internal_scale))
+    root.set("preserveAspectRatio", "none")
+    patch = png_to_rgba(cairosvg.svg2png(bytestring=etree.tostring(root), scale=internal_scale))
+    return patch, x0, y0
+
+# ---------- tiled high-DPI raster export ----------
+RASTER_FORMATS = {"PNG": "png", "TIFF (tiled)": "tif"}
+
+def _render_raster_tile(svg_head: bytes, svg_rest: bytes, view_box: tuple, px_w: int, px_h: int) -> np.ndarray:
+    # the root <svg> is re-opened with this tile's viewBox and an exact pixel size; output is RGB on white
+    vb = " ".join(f"{v:.6f}" for v in view_box)
+    tile_svg = svg_head + f' width="{px_w}" height="{px_h}" viewBox="{vb}" preserveAspectRatio="none"'.encode("utf-8") + svg_rest
+    rgba = png_to_rgba(cairosvg.svg2png(bytestring=tile_svg, scale=1.0))
+    out = np.full((px_h, px_w, 3), 255, dtype=np.uint8)
+    h, w = min(px_h, rgba.shape[0]), min(px_w, rgba.shape[1])
+    alpha = rgba[:h, :w, 3:4].astype(np.uint16)
+    out[:h, :w] = ((rgba[:h, :w, :3].astype(np.uint16) * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+    return out
+
+def export_raster_tiled(svg_text: str, dest: Path, fmt: str = "png", dpi: int = 600, tile_px: int = 1024, workers: int = None) -> dict:
+    """
+    Render a filled SVG to `dest` as a PNG or tiled TIFF at `dpi`, about tile_px² pixels at a time.
+    TIFF renders tile_px × tile_px tiles; PNG, which has to be written top to bottom, renders
+    full-width bands of tile_px² / width rows. Pieces render in parallel and are compressed
+    straight to disk, so peak memory is a few pieces per worker whatever the image size.
+    Returns {"width", "height", "tiles", "seconds", "bytes"}.
+    """
+    t0 = time.perf_counter()
+    w_mm, h_mm, (vb_x, vb_y, vb_w, vb_h) = _svg_size_mm(svg_text)
+    width, height = max(1, round(w_mm / 25.4 * dpi)), max(1, round(h_mm / 25.4 * dpi))
+    sx, sy = vb_w / width, vb_h / height  # user units per output pixel
+
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+    for attr in ("width", "height", "viewBox", "preserveAspectRatio"):
+        root.attrib.pop(attr, None)
+    svg_bytes = etree.tostring(root)
+    m = re.search(rb"<([A-Za-z_][\w.-]*:)?svg\b", svg_bytes)
+    svg_head, svg_rest = svg_bytes[:m.end()], svg_bytes[m.end():]
+
+    def _region(x0, y0, pw, ph):
+        return _render_raster_tile(svg_head, svg_rest, (vb_x + x0 * sx, vb_y + y0 * sy, pw * sx, ph * sy), pw, ph)
+
+    if fmt == "png":
+        band = max(1, min(height, tile_px * tile_px // width))
+        pieces = [(0, y0, width, min(band, height - y0)) for y0 in range(0, height, band)]
+    else:
+        pieces = [(tx * tile_px, ty * tile_px, min(tile_px, width - tx * tile_px), min(tile_px, height - ty * tile_px))
+                  for ty in range(-(-height // tile_px)) for tx in range(-(-width // tile_px))]
+    workers = workers or min(4, os.cpu_count() or 2)
+    with open(dest, "wb") as fh, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="raster") as pool:
+        if fmt == "png":
+            writer = utils.StreamingPNGWriter(fh, width, height, channels=3, dpi=dpi)
+        else:
+            writer = utils.TiledTIFFWriter(fh, width, height, tile=tile_px, channels=3, dpi=dpi)
+        # bounded window of in-flight pieces keeps memory at ~2 per worker; map() keeps them in order
+        for start in range(0, len(pieces), workers * 2):
+            window = pieces[start:start + workers * 2]
+            for (x0, y0, _, _), arr in zip(window, pool.map(lambda p: _region(*p), window)):
+                if fmt == "png":
+                    writer.write_rows(arr)
+                else:
+                    writer.write_tile(y0 // tile_px, x0 // tile_px, arr)
+        writer.close()
+    return {"width": width, "height": height, "tiles": len(pieces),
+            "seconds": time.perf_counter() - t0, "bytes": Path(dest).stat().st_size}
+
+# ---------- parse svg dims ----------
+def _parse_svg_dimensions(svg_text: str):
+    try:
+        parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+        root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+        vb = root.get("viewBox")
+        if vb:
+            parts = [float(p) for p in vb.strip().split()]
+            if len(parts) == 4:
+                return parts[2], parts[3]
+        w_attr = root.get("width")
+        h_attr = root.get("height")
+        def _attr_to_px(v):
+            if not v:
+                return None
+            v = str(v).strip()
+            if v.endswith("mm"):
+                return utils.mm_to_px(float(v[:-2]))
+            if v.endswith("px"):
+                try:
+                    return float(v[:-2])
+                except Exception:
+                    return None
+            if v.endswith("pt"):
+                try:
+                    return float(v[:-2]) * 1.3333333
+                except Exception:
+                    return None
+            try:
+                return float(re.match(r"^([0-9.+-eE]+)", v).group(1))
+            except Exception:
+                return None
+        wpx = _attr_to_px(w_attr)
+        hpx = _attr_to_px(h_attr)
+        if wpx and hpx:
+            return wpx, hpx
+    except Exception:
+        pass
+    return 1000.0, 1000.0
+
+# ---------- reliable EAN-13 SVG generator ----------
+def render_ean13_svg_text(ean: str, canonical: bool = False) -> str:
+    # canonical=True: value already normalised by prepare_barcode_columns, skip per-row checks
+    if canonical:
+        ean_clean = str(ean)
+    else:
+        ean_clean = ''.join(filter(str.isdigit, str(ean)))
+        if len(ean_clean) not in (12, 13):
+            raise ValueError("EAN must be 12 or 13 digits")
+    EAN = barcode.get_barcode_class('ean13')
+    writer = SVGWriter()
+    obj = EAN(ean_clean, writer=writer)
+    buf = io.BytesIO()
+    options = {"write_text": True}
+    obj.write(buf, options)
+    buf.seek(0)
+    try:
+        svg_text = buf.getvalue().decode("utf-8")
+    except Exception:
+        svg_text = buf.getvalue().decode("latin-1")
+    return svg_text
+
+def cached_ean13_svg_text(ean: str, canonical: bool = False) -> str:
+    key = render_cache.cache_key(RENDER_VERSION, "ean13", str(ean), canonical)
+    return RENDER_CACHE.get_or_create("barcode", key, lambda: render_ean13_svg_text(ean, canonical=canonical).encode("utf-8")).decode("utf-8")
+
+# ---------- conservative white rect remover ----------
+def _remove_white_background_rects(frag_root):
+    to_remove = []
+    for el in list(frag_root.iter()):
+        tag = el.tag
+        if not isinstance(tag, str):
+            continue
+        if tag.lower().endswith("rect"):
+            fill = (el.get("fill") or "").strip().lower()
+            style = (el.get("style") or "").lower()
+            if fill in ("#fff", "#ffffff", "white", "rgb(255,255,255)"):
+                to_remove.append(el)
+                continue
+            if "fill:#fff" in style or "fill:#ffffff" in style or "fill:white" in style:
+                to_remove.append(el)
+                continue
+            try:
+                w = float(el.get("width") or 0)
+                h = float(el.get("height") or 0)
+                if w > 500 or h > 500:
+                    to_remove.append(el)
+            except Exception:
+                pass
+    for r in to_remove:
+        parent = r.getparent()
+        if parent is not None:
+            parent.remove(r)
+
+# ---------- placeholders ----------
+def find_placeholders(svg_text: str):
+    return sorted(set(re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", svg_text)))
+
+# mapping entry defaults, as written by the mapping UI in app.py
+MAPPING_DEFAULTS = {"align": "Left", "dx": 0.0, "dy": 0.0, "scale": 1.0, "type": "Text", "height_mm": 0.0,
+                    "width_mm": 0.0, "ratio_mode": "Exact", "ratio": None, "fit": "Off", "box_w_mm": 0.0, "box_h_mm": 0.0}
+_MAPPING_NUMBERS = ("dx", "dy", "scale", "height_mm", "width_mm", "box_w_mm", "box_h_mm")
+
+def normalize_mapping(raw: dict, placeholders=()) -> tuple:
+    """
+    Complete a mapping loaded from JSON the way the mapping UI does: every entry gets all
+    fields ("col" defaults to the placeholder name), numbers are coerced, and placeholders
+    of the template that have no entry map to the column of the same name.
+    Returns (mapping, problems); entries that cannot be used are dropped and listed in problems.
+    """
+    mapping, problems = {}, []
+    for ph, cfg in raw.items():
+        if isinstance(cfg, str):
+            cfg = {"col": cfg}
+        if not isinstance(cfg, dict):
+            problems.append(f"{ph}: entry must be an object, got {type(cfg).__name__}")
+            continue
+        entry = dict(MAPPING_DEFAULTS, **cfg)
+        entry["col"] = str(cfg.get("col") or ph)
+        try:
+            for key in _MAPPING_NUMBERS:
+                entry[key] = float(entry[key] or 0.0)
+            entry["scale"] = entry["scale"] or 1.0
+            entry["ratio"] = float(entry["ratio"]) if entry["ratio"] not in (None, "") else None
+        except (TypeError, ValueError) as e:
+            problems.append(f"{ph}: {e}")
+            continue
+        if entry["type"] not in ("Text", "Barcode EAN13"):
+            problems.append(f"{ph}: unknown type {entry['type']!r}")
+            continue
+        mapping[str(ph)] = entry
+    for ph in placeholders:
+        mapping.setdefault(ph, dict(MAPPING_DEFAULTS, col=ph))
+    return mapping, problems
+
+def apply_mapping_to_svg(svg_text: str, mapping: dict, record: dict, barcodes_canonical: bool = False,
+                         fragment_cache: dict = None) -> str:
+    # fragment_cache: optional dict shared by several templates so each barcode is generated once per record
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+
+    text_nodes = list(root.findall(".//{http://www.w3.org/2000/svg}text")) + list(root.findall(".//text"))
+
+    for text_elem in text_nodes:
+        content = "".join(text_elem.itertext()) or ""
+        matches = re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", content)
+        if not matches:
+            continue
+
+        barcode_placeholders = [ph for ph in matches if mapping.get(ph, {}).get("type", "Text") == "Barcode EAN13"]
+        if barcode_placeholders and len(matches) == 1:
+            ph = barcode_placeholders[0]
+            cfg = mapping.get(ph, {"col": ph, "align": "Left"})
+            col = cfg.get("col", ph)
+            val = record.get(col, "")
+            if val is None or str(val).strip() == "":
+                for child in list(text_elem):
+                    text_elem.remove(child)
+                text_elem.text = ""
+                continue
+
+            # Read cfg values
+            height_mm = float(cfg.get("height_mm", 0.0) or 0.0)
+            width_mm = float(cfg.get("width_mm", 0.0) or 0.0)
+            ratio_mode = cfg.get("ratio_mode", "Exact")  # "Exact" or "Maintain"
+
+            # If ratio_mode == Maintain, attempt to compute missing side using stored ratio
+            ratio = cfg.get("ratio", None)
+            # if user provided both >0 and ratio_mode == Maintain -> compute/store fresh ratio
+            if ratio_mode == "Maintain":
+                if width_mm > 0 and height_mm > 0:
+                    # update stored ratio (width/height)
+                    try:
+                        cfg["ratio"] = float(width_mm) / float(height_mm)
+                        ratio = cfg["ratio"]
+                    except Exception:
+                        ratio = cfg.get("ratio", None)
+                else:
+                    # one side only set -> fill missing based on stored ratio (if possible)
+                    if ratio and width_mm == 0 and height_mm > 0:
+                        try:
+                            width_mm = float(height_mm) * float(ratio)
+                            cfg["width_mm"] = float(width_mm)
+                        except Exception:
+                            pass
+                    elif ratio and height_mm == 0 and width_mm > 0:
+                        try:
+                            height_mm = float(width_mm) / float(ratio)
+                            cfg["height_mm"] = float(height_mm)
+                        except Exception:
+                            pass
+                    # if ratio not present and both not >0, nothing to infer
+
+            # px targets (None means auto)
+            try:
+                desired_h_px = utils.mm_to_px(height_mm) if height_mm > 0 else None
+            except Exception:
+                desired_h_px = int(round((height_mm / 25.4) * 300)) if height_mm > 0 else None
+            try:
+                desired_w_px = utils.mm_to_px(width_mm) if width_mm > 0 else None
+            except Exception:
+                desired_w_px = int(round((width_mm / 25.4) * 300)) if width_mm > 0 else None
+
+            # text element position
+            x_val = text_elem.get("x") or text_elem.get("dx") or "0"
+            y_val = text_elem.get("y") or text_elem.get("dy") or "0"
+            try:
+                xf = float(x_val)
+            except Exception:
+                xf = 0.0
+            try:
+                yf = float(y_val)
+            except Exception:
+                yf = 0.0
+
+            # mapping adjustments
+            try:
+                cfg_dx = float(cfg.get("dx", 0) or 0)
+            except Exception:
+                cfg_dx = 0.0
+            try:
+                cfg_dy = float(cfg.get("dy", 0) or 0)
+            except Exception:
+                cfg_dy = 0.0
+            try:
+                cfg_scale = float(cfg.get("scale", 1.0) or 1.0)
+            except Exception:
+                cfg_scale = 1.0
+
+            # generate vector barcode svg (reusing this record's fragment when a cache is passed)
+            cached = fragment_cache.get(str(val)) if fragment_cache is not None else None
+            if cached is not None:
+                frag, orig_w, orig_h = cached
+            else:
+                try:
+                    svg_bar = cached_ean13_svg_text(val, canonical=barcodes_canonical)
+                except Exception as e:
+                    for child in list(text_elem):
+                        text_elem.remove(child)
+                    text_elem.text = f"[barcode generate error: {e}]"
+                    continue
+
+                # parse frag
+                try:
+                    parser2 = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+                    frag = etree.fromstring(svg_bar.encode("utf-8"), parser=parser2)
+                except Exception as e:
+                    for child in list(text_elem):
+                        text_elem.remove(child)
+                    text_elem.text = f"[barcode svg parse error: {e}]"
+                    continue
+
+                # strip white background rects
+                try:
+                    _remove_white_background_rects(frag)
+                except Exception:
+                    pass
+
+                # compute original dims
+                orig_w, orig_h = _parse_svg_dimensions(svg_bar)
+                if fragment_cache is not None:
+                    fragment_cache[str(val)] = (frag, orig_w, orig_h)
+
+            # Decide scaling:
+            # - If desired_w_px and desired_h_px both None -> no size change (scale=cfg_scale)
+            # - If both specified -> non-uniform scale to match both exactly (scale_x, scale_y)
+            # - If only one specified -> uniform scale to match that side (other computed by orig ratio)
+            if desired_w_px is None and desired_h_px is None:
+                scale_x = cfg_scale
+                scale_y = cfg_scale
+            elif desired_w_px is not None and desired_h_px is not None:
+                # both specified --> non-uniform exact match, then multiply by cfg_scale
+                sx = (float(desired_w_px) / float(orig_w)) if orig_w != 0 else 1.0
+                sy = (float(desired_h_px) / float(orig_h)) if orig_h != 0 else 1.0
+                scale_x = sx * cfg_scale
+                scale_y = sy * cfg_scale
+            elif desired_w_px is not None:
+                # width only -> uniform scale by width
+                if orig_w == 0:
+                    u = cfg_scale
+                else:
+                    u = (float(desired_w_px) / float(orig_w)) * cfg_scale
+                scale_x = u
+                scale_y = u
+            else:
+                # height only -> uniform scale by height
+                if orig_h == 0:
+                    u = cfg_scale
+                else:
+                    u = (float(desired_h_px) / float(orig_h)) * cfg_scale
+                scale_x = u
+                scale_y = u
+
+            total_tx = xf + cfg_dx
+            total_ty = yf + cfg_dy
+
+            # build group and import children - note: scale can be non-uniform
+            g = etree.Element("{http://www.w3.org/2000/svg}g")
+            g.set("transform", f"translate({total_tx},{total_ty}) scale({scale_x},{scale_y})")
+            for child in list(frag):
+                if fragment_cache is not None:
+                    g.append(copy.deepcopy(child))
+                else:
+                    frag.remove(child)
+                    g.append(child)
+
+            parent = text_elem.getparent()
+            if parent is None:
+                text_elem.text = ""
+                root.append(g)
+            else:
+                parent.replace(text_elem, g)
+            continue
+
+        # fallback textual substitution
+        new_text = content
+        for ph in matches:
+            cfg = mapping.get(ph, {"col": ph, "align": "Left"})
+            col = cfg.get("col", ph)
+            val = record.get(col, "")
+            if val is None:
+                val = ""
+            new_text = re.sub(r"\{\{\s*%s\s*\}\}" % re.escape(ph), str(val), new_text)
+
+        cfg0 = mapping.get(matches[0], {})
+        lines = str(new_text).splitlines() or [""]
+        fit_size = None
+        if cfg0.get("fit", "Off") in ("Shrink to fit", "Wrap to width") and float(cfg0.get("box_w_mm", 0) or 0) > 0:
+            try:
+                lines, fit_size = _fit_text_to_box(text_elem, lines, cfg0, svg_text)
+            except Exception:
+                # TextFitUnresolved included: text_fit_problems() reports those up front
+                fit_size = None
+
+        # remove child tspans and re-split lines preserving line structure
+        for child in list(text_elem):
+            text_elem.remove(child)
+        text_elem.text = lines[0]
+        for ln in lines[1:]:
+            tspan = etree.Element("{http://www.w3.org/2000/svg}tspan")
+            if text_elem.get("x"):
+                tspan.set("x", text_elem.get("x"))
+            tspan.set("dy", "1em")
+            tspan.text = ln
+            text_elem.append(tspan)
+
+        if fit_size is not None:
+            style = re.sub(r"(^|;)\s*font-size\s*:[^;]*", r"\1", text_elem.get("style") or "").strip("; ")
+            text_elem.set("style", (style + "; " if style else "") + f"font-size: {fit_size:.3f}px")
+
+        align_map = {"Left": "start", "Center": "middle", "Right": "end", "Justify": "start"}
+        text_elem.set("text-anchor", align_map.get(cfg0.get("align", "Left"), "start"))
+        # transform support (dx,dy,scale) on text
+        try:
+            dx = float(cfg0.get("dx", 0))
+            dy = float(cfg0.get("dy", 0))
+            scale_val = float(cfg0.get("scale", 1.0))
+            old = text_elem.get("transform", "")
+            tf = f" translate({dx},{dy}) scale({scale_val})"
+            text_elem.set("transform", (old + tf).strip())
+        except Exception:
+            pass
+
+    return etree.tostring(root, encoding="utf-8").decode("utf-8")
+
+# ---------- N-up imposition helpers ----------
+_UNIT_MM = {"mm": 1.0, "cm": 10.0, "in": 25.4, "pt": 25.4 / 72.0, "pc": 25.4 / 6.0, "px": 25.4 / 96.0, "": 25.4 / 96.0}
+# elements that never paint by themselves; kept in the variable layer so references still resolve
+_NON_RENDERING = {"defs", "style", "clippath", "mask", "lineargradient", "radialgradient", "pattern",
+                  "symbol", "marker", "filter", "font", "font-face", "metadata", "title", "desc"}
+
+def _local_tag(el) -> str:
+    return el.tag.split("}")[-1].lower() if isinstance(el.tag, str) else ""
+
+@functools.lru_cache(maxsize=32)
+def _svg_size_mm(svg_text: str):
+    """Physical trim size (mm) of a template plus its viewBox (x, y, w, h) in user units."""
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+    vb_w, vb_h = _parse_svg_dimensions(svg_text)
+    vb_x = vb_y = 0.0
+    try:
+        parts = [float(p) for p in (root.get("viewBox") or "").replace(",", " ").split()]
+        if len(parts) == 4:
+            vb_x, vb_y = parts[0], parts[1]
+    except Exception:
+        pass
+    def _len_mm(v, fallback_px):
+        m = re.match(r"^\s*([0-9.+\-eE]+)\s*([a-z]*)\s*$", str(v or ""))
+        if m and m.group(2) in _UNIT_MM:
+            return float(m.group(1)) * _UNIT_MM[m.group(2)]
+        # cairosvg treats unitless / missing sizes as CSS px (96 dpi)
+        return float(fallback_px) * _UNIT_MM["px"]
+    return _len_mm(root.get("width"), vb_w), _len_mm(root.get("height"), vb_h), (vb_x, vb_y, vb_w, vb_h)
+
+# containers paint nothing themselves; what they hold is split element by element
+_CONTAINERS = {"svg", "g", "a", "switch"}
+
+def _has_group_effect(el) -> bool:
+    """Opacity, filters, masks and blending composite a group as one image, so it cannot be split."""
+    for prop in ("opacity", "filter", "mask", "mix-blend-mode", "isolation"):
+        value = (_own_svg_prop(el, prop) or "").lower()
+        if prop == "opacity":
+            try:
+                if value and float(value) < 1.0:
+                    return True
+            except ValueError:
+                return True
+        elif value and value not in ("none", "normal", "auto"):
+            return True
+    return False
+
+def _paint_units(root) -> list:
+    """
+    Painting elements in paint (document) order, as [[element, ...], ...]. Each unit goes into one
+    layer: a single element, or everything inside a <switch> or a group with a group effect.
+    """
+    units = []
+    def _visit(parent, unit):
+        for child in parent:
+            tag = _local_tag(child)
+            if not tag or tag in _NON_RENDERING:
+                continue
+            if tag in _CONTAINERS:
+                if unit is None and (tag == "switch" or _has_group_effect(child)):
+                    units.append([])
+                    _visit(child, units[-1])
+                else:
+                    _visit(child, unit)
+            elif unit is not None:
+                unit.append(child)
+            else:
+                units.append([child])
+    _visit(root, None)
+    return [u for u in units if u]
+
+def split_template_layers(svg_text: str, only: set = None):
+    """
+    Split a template into (below_svg, variable_svg, above_svg) along paint order. The variable
+    layer runs from the first to the last placeholder <text> node (artwork painted in between
+    stays with it); below/above hold what is painted before/after it, or are None when nothing
+    is. Stacking below + filled variable + above reproduces the filled template. Every layer
+    keeps the containers and the non-rendering defs/styles. With `only`, just the text nodes
+    using one of those placeholders count as variable.
+    """
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    def _is_placeholder_text(el):
+        if _local_tag(el) != "text":
+            return False
+        found = re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", "".join(el.itertext()) or "")
+        return bool(found) if only is None else any(ph in only for ph in found)
+
+    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+    position = {el: i for i, el in enumerate(root.iter())}
+    units = _paint_units(root)
+    variable_units = [i for i, unit in enumerate(units) if any(_is_placeholder_text(el) for el in unit)]
+    first = variable_units[0] if variable_units else len(units)
+    last = variable_units[-1] if variable_units else len(units) - 1
+    layers = {"below": units[:first], "variable": units[first:last + 1], "above": units[last + 1:]}
+
+    out = []
+    paint_positions = {position[el] for unit in units for el in unit}
+    for name in ("below", "variable", "above"):
+        keep = {position[el] for unit in layers[name] for el in unit}
+        if not keep and name != "variable":
+            out.append(None)
+            continue
+        layer_root = copy.deepcopy(root)  # same tree shape, so positions carry over
+        for i, el in [(i, el) for i, el in enumerate(layer_root.iter()) if i in paint_positions and i not in keep]:
+            el.getparent().remove(el)
+        out.append(etree.tostring(layer_root, encoding="utf-8").decode("utf-8"))
+    return tuple(out)
+
+def bleed_box_svg(svg_text: str, size_mm, view_box, bleed_mm: float) -> str:
+    """Resize a template's viewport to its bleed box (trim + bleed on every side)."""
+    w_mm, h_mm = size_mm
+    vb_x, vb_y, vb_w, vb_h = view_box
+    bx, by = bleed_mm * vb_w / w_mm, bleed_mm * vb_h / h_mm
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    root = etree.fromstring(svg_text.encode("utf-8"), parser=parser)
+    root.set("width", f"{w_mm + 2 * bleed_mm}mm")
+    root.set("height", f"{h_mm + 2 * bleed_mm}mm")
+    root.set("viewBox", f"{vb_x - bx} {vb_y - by} {vb_w + 2 * bx} {vb_h + 2 * by}")
+    return etree.tostring(root, encoding="utf-8").decode("utf-8")
+
+_URL_REF = re.compile(r"url\(\s*['\"]?#([^'\")\s]+)['\"]?\s*\)")
+
+def _suffix_ids(root, suffix: str):
+    """Rename every id in a cell (and the references to it) so cells placed on one sheet never share ids."""
+    ids = {el.get("id") for el in root.iter() if isinstance(el.tag, str) and el.get("id")}
+    if not ids:
+        return
+    def _url(m):
+        return f"url(#{m.group(1)}{suffix})" if m.group(1) in ids else m.group(0)
+    css_ref = re.compile(r"#(%s)(?![\w-])" % "|".join(re.escape(i) for i in sorted(ids, key=len, reverse=True)))
+    for el in root.iter():
+        if not isinstance(el.tag, str):
+            continue
+        for attr, value in el.attrib.items():
+            if attr == "id":
+                el.set(attr, value + suffix)
+            elif attr.endswith("href") and value.startswith("#") and value[1:] in ids:
+                el.set(attr, value + suffix)
+            elif "url(" in value:
+                el.set(attr, _URL_REF.sub(_url, value))
+        if _local_tag(el) == "style" and el.text:
+            el.text = css_ref.sub(lambda m: f"#{m.group(1)}{suffix}", el.text)
+
+def build_sheet_svg(cell_svgs: list, layout: dict, view_box, crop_marks: bool = True) -> str:
+    """Place filled cell SVGs on one sheet (user units = mm), clipped to their bleed boxes."""
+    sheet_w, sheet_h = layout["sheet_w_mm"], layout["sheet_h_mm"]
+    cell_w, cell_h, bleed = layout["cell_w_mm"], layout["cell_h_mm"], layout["bleed_mm"]
+    vb_x, vb_y, vb_w, vb_h = view_box
+    sx, sy = cell_w / vb_w, cell_h / vb_h
+    root = etree.Element(f"{{{SVG_NS}}}svg", nsmap={None: SVG_NS})
+    root.set("version", "1.1")
+    root.set("width", f"{sheet_w}mm")
+    root.set("height", f"{sheet_h}mm")
+    root.set("viewBox", f"0 0 {sheet_w} {sheet_h}")
+    defs = etree.SubElement(root, f"{{{SVG_NS}}}defs")
+    clip = etree.SubElement(defs, f"{{{SVG_NS}}}clipPath", id="nup_bleed_box")
+    clip.set("clipPathUnits", "userSpaceOnUse")
+    etree.SubElement(clip, f"{{{SVG_NS}}}rect", x=str(vb_x - bleed / sx), y=str(vb_y - bleed / sy),
+                     width=str(vb_w + 2 * bleed / sx), height=str(vb_h + 2 * bleed / sy))
+    parser = etree.XMLParser(ns_clean=True, recover=True, remove_blank_text=True)
+    for i, (cell_svg, (x, y)) in enumerate(zip(cell_svgs, layout["cells"])):
+        cell_root = etree.fromstring(cell_svg.encode("utf-8"), parser=parser)
+        # every cell carries the template's defs; give each copy its own ids
+        _suffix_ids(cell_root, f"-c{i}")
+        outer = etree.SubElement(root, f"{{{SVG_NS}}}g", transform=f"translate({x},{y}) scale({sx},{sy}) translate({-vb_x},{-vb_y})")
+        inner = etree.SubElement(outer, f"{{{SVG_NS}}}g")
+        inner.set("clip-path", "url(#nup_bleed_box)")
+        for attr in ("style", "fill", "stroke", "font-family", "font-size"):
+            if cell_root.get(attr):
+                inner.set(attr, cell_root.get(attr))
+        for child in list(cell_root):
+            inner.append(child)
+    if crop_marks:
+        marks = etree.SubElement(root, f"{{{SVG_NS}}}g", stroke="#000", fill="none")
+        marks.set("stroke-width", "0.09")  # ~0.25 pt
+        off, length = bleed + 1.0, 4.0
+        for x, y in layout["cells"][:len(cell_svgs)]:
+            for cx, cy, dx, dy in ((x, y, -1, -1), (x + cell_w, y, 1, -1), (x, y + cell_h, -1, 1), (x + cell_w, y + cell_h, 1, 1)):
+                etree.SubElement(marks, f"{{{SVG_NS}}}line", x1=str(cx + dx * off), y1=str(cy), x2=str(cx + dx * (off + length)), y2=str(cy))
+                etree.SubElement(marks, f"{{{SVG_NS}}}line", x1=str(cx), y1=str(cy + dy * off), x2=str(cx), y2=str(cy + dy * (off + length)))
+    return etree.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
+
+# ---------- barcode column pre-pass ----------
+BARCODE_REPORT_COLUMNS = ["row", "placeholder", "column", "value", "status", "canonical"]
+
+def barcode_columns(df: pd.DataFrame, mapping: dict) -> tuple:
+    """((column, placeholder), ...) for every data column mapped to a barcode placeholder."""
+    cols = {}
+    for ph, cfg in mapping.items():
+        col = cfg.get("col", ph)
+        if cfg.get("type", "Text") == "Barcode EAN13" and col in df.columns:
+            cols.setdefault(col, ph)
+    return tuple(cols.items())
+
+def check_barcode_columns(df: pd.DataFrame, barcode_cols: tuple):
+    """
+    Validate the given barcode columns in one vectorised pass.
+    Returns (checked_df, report_df, invalid_rows): checked_df carries canonical EANs
+    (blank where missing/invalid), report_df lists every row that is not "ok".
+    """
+    if not barcode_cols:
+        return df, pd.DataFrame(columns=BARCODE_REPORT_COLUMNS), set()
+    checked = df.copy()
+    reports = []
+    invalid_rows = set()
+    for col, ph in barcode_cols:
+        canonical, status = utils.validate_ean13_column(df[col].tolist())
+        canonical = np.array([c if c is not None else "" for c in canonical], dtype=object)
+        status = np.array(status, dtype=object)
+        checked[col] = canonical
+        invalid_rows.update(df.index[status == "invalid"])
+        pos = np.flatnonzero(status != "ok")
+        if not len(pos):
+            continue
+        orig = df[col].iloc[pos]
+        reports.append(pd.DataFrame({"row": pos + 1, "placeholder": ph, "column": col,
+                                     "value": orig.where(orig.notna(), "").astype(str).to_numpy(),
+                                     "status": status[pos], "canonical": canonical[pos]}))
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=BARCODE_REPORT_COLUMNS)
+    return checked, report[BARCODE_REPORT_COLUMNS], invalid_rows
+
+def prepare_barcode_columns(df: pd.DataFrame, mapping: dict):
+    """check_barcode_columns() over every column the mapping uses for a barcode placeholder."""
+    return check_barcode_columns(df, barcode_columns(df, mapping))
+
+# ---------- text auto-fit ----------
+# CSS absolute lengths in px, i.e. user units of the element's own coordinate system
+_CSS_PX = {"": 1.0, "px": 1.0, "pt": 4.0 / 3.0, "pc": 16.0, "in": 96.0, "cm": 96.0 / 2.54, "mm": 96.0 / 25.4,
+           "q": 96.0 / 101.6}
+_FONT_SIZE_KEYWORDS = {"xx-small": 9.0, "x-small": 10.0, "small": 13.0, "medium": 16.0, "large": 18.0,
+                       "x-large": 24.0, "xx-large": 32.0}
+_CSS_NUMBER = re.compile(r"^([+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?)\s*([a-z%]*)$")
+_TRANSFORM_FN = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+
+class TextFitUnresolved(ValueError):
+    """The template's font size or transforms cannot be resolved, so a text placeholder is left unfitted."""
+
+_FONT_SHORTHAND = re.compile(
+    r"^(?P<pre>(?:(?:normal|italic|oblique|small-caps|bold|bolder|lighter|[1-9]00)\s+)*)"
+    r"(?P<size>[^\s/]+)(?:\s*/\s*\S+)?\s+(?P<family>\S.*)$")
+_SIMPLE_SELECTOR = re.compile(r"^(?P<tag>[A-Za-z][\w-]*|\*)?(?P<rest>(?:[.#][\w-]+)*)$")
+
+def _declarations(block: str) -> dict:
+    """CSS declarations of a style attribute or rule body, later ones winning; `font` is expanded."""
+    out = {}
+    for decl in block.split(";"):
+        name, sep, value = decl.partition(":")
+        name, value = name.strip().lower(), value.replace("!important", "").strip()
+        if not sep or not name or not value:
+            continue
+        if name == "font":
+            m = _FONT_SHORTHAND.match(value)
+            # an unparsable shorthand still sets the size, to something _font_size_user_units rejects
+            out["font-size"] = m.group("size") if m else value
+            if m:
+                out["font-family"] = m.group("family")
+                weight = [w for w in m.group("pre").split() if w in ("bold", "bolder", "lighter") or w[0].isdigit()]
+                out["font-weight"] = weight[-1] if weight else "normal"
+        else:
+            out[name] = value
+    return out
+
+@functools.lru_cache(maxsize=64)
+def _parse_stylesheet(css: str) -> tuple:
+    """
+    Rules of a <style> sheet as ((selector, specificity, declarations), ...) in source order.
+    Only simple selectors (tag, .class, #id and combinations of them) are matched; any
+    other selector is kept with selector None so callers can tell its properties are unknown.
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S).replace("<![CDATA[", "").replace("]]>", "")
+    rules = []
+    for selectors, body in re.findall(r"([^{}]+)\{([^{}]*)\}", css):
+        decls = _declarations(body)
+        for sel in selectors.split(","):
+            m = _SIMPLE_SELECTOR.match(sel.strip())
+            if not m or not sel.strip() or sel.strip().startswith("@"):
+                rules.append((None, (0, 0, 0), decls))
+                continue
+            ids = tuple(part[1:] for part in re.findall(r"#[\w-]+", m.group("rest")))
+            classes = tuple(part[1:] for part in re.findall(r"\.[\w-]+", m.group("rest")))
+            tag = m.group("tag") if m.group("tag") not in (None, "*") else None
+            rules.append(((tag, ids, classes), (len(ids), len(classes), int(tag is not None)), decls))
+    return tuple(rules)
+
+def _document_css(el) -> str:
+    root = el.getroottree().getroot()
+    return "\n".join(s.text or "" for s in root.iter("{http://www.w3.org/2000/svg}style", "style"))
+
+def _own_svg_prop(el, prop: str, strict: bool = False):
+    """
+    CSS property set on the element itself: inline style, then the document's <style> rules by
+    specificity and order, then the presentation attribute. With `strict`, a rule the simple
+    matcher cannot evaluate that sets `prop` raises TextFitUnresolved instead of being skipped.
+    """
+    inline = _declarations(el.get("style") or "")
+    if prop in inline:
+        return inline[prop]
+    css = _document_css(el)
+    if css.strip():
+        tag = _local_tag(el)
+        classes = set((el.get("class") or "").split())
+        best = None
+        for order, (selector, specificity, decls) in enumerate(_parse_stylesheet(css)):
+            if prop not in decls:
+                continue
+            if selector is None:
+                if strict:
+                    raise TextFitUnresolved(f"a <style> rule sets {prop} through a selector that cannot be evaluated here")
+                continue
+            sel_tag, ids, sel_classes = selector
+            if (sel_tag is None or sel_tag == tag) and all(i == el.get("id") for i in ids) and classes.issuperset(sel_classes):
+                if best is None or (specificity, order) >= best[0]:
+                    best = ((specificity, order), decls[prop])
+        if best is not None:
+            return best[1]
+    return el.get(prop).strip() if el.get(prop) else None
+
+def _inherited_svg_prop(el, prop: str):
+    """CSS property from the element's or an ancestor's style/presentation attribute."""
+    while el is not None:
+        value = _own_svg_prop(el, prop)
+        if value is not None:
+            return value
+        el = el.getparent()
+    return None
+
+def _font_size_user_units(el) -> float:
+    """
+    Computed font-size of `el` in its own user units, resolving em/ex/%/rem and the size
+    keywords against the ancestors. Raises TextFitUnresolved for what only a browser knows (vw, calc(), ...).
+    """
+    chain = []
+    while el is not None:
+        chain.append(el)
+        el = el.getparent()
+    size = root_size = 16.0  # CSS "medium"
+    for depth, node in enumerate(reversed(chain)):
+        raw = _own_svg_prop(node, "font-size", strict=True)
+        value = (raw or "inherit").lower()
+        if value == "inherit":
+            pass
+        elif value in _FONT_SIZE_KEYWORDS:
+            size = _FONT_SIZE_KEYWORDS[value]
+        elif value in ("larger", "smaller"):
+            size = size * 1.2 if value == "larger" else size / 1.2
+        else:
+            m = _CSS_NUMBER.match(value)
+            unit = m.group(2) if m else None
+            if unit in _CSS_PX:
+                size = float(m.group(1)) * _CSS_PX[unit]
+            elif unit in ("em", "ex", "%", "rem"):
+                base = {"em": size, "ex": size / 2.0, "%": size / 100.0, "rem": root_size}[unit]
+                size = float(m.group(1)) * base
+            else:
+                raise TextFitUnresolved(f"font-size {raw!r} cannot be resolved")
+        if depth == 0:
+            root_size = size
+    if size <= 0:
+        raise TextFitUnresolved(f"font-size {size:g} is not positive")
+    return size
+
+def _transform_matrix(value: str) -> np.ndarray:
+    """3×3 matrix of an SVG transform attribute."""
+    m = np.eye(3)
+    for fn, args in _TRANSFORM_FN.findall(value or ""):
+        try:
+            v = [float(a) for a in args.replace(",", " ").split()]
+        except ValueError:
+            raise TextFitUnresolved(f"transform {fn}({args}) cannot be parsed")
+        if fn == "matrix" and len(v) == 6:
+            t = np.array([[v[0], v[2], v[4]], [v[1], v[3], v[5]], [0, 0, 1]])
+        elif fn == "translate" and v:
+            t = np.array([[1, 0, v[0]], [0, 1, v[1] if len(v) > 1 else 0.0], [0, 0, 1]])
+        elif fn == "scale" and v:
+            t = np.diag([v[0], v[1] if len(v) > 1 else v[0], 1.0])
+        elif fn == "rotate" and v:
+            a = np.radians(v[0])
+            cx, cy = (v[1], v[2]) if len(v) == 3 else (0.0, 0.0)
+            r = np.array([[np.cos(a), -np.sin(a), 0], [np.sin(a), np.cos(a), 0], [0, 0, 1]])
+            t = np.array([[1, 0, cx], [0, 1, cy], [0, 0, 1]]) @ r @ np.array([[1, 0, -cx], [0, 1, -cy], [0, 0, 1]])
+        elif fn in ("skewX", "skewY") and v:
+            t = np.eye(3)
+            t[(0, 1) if fn == "skewX" else (1, 0)] = np.tan(np.radians(v[0]))
+        else:
+            raise TextFitUnresolved(f"transform {fn}({args}) cannot be parsed")
+        m = m @ t
+    return m
+
+def _user_space_scale(el) -> tuple:
+    """
+    (x, y) scale from `el`'s coordinates to the template's user space: its own transform and
+    every ancestor's, up to (not including) the root <svg>, whose viewBox the mm box already uses.
+    """
+    m = np.eye(3)
+    while el is not None and el.getparent() is not None:
+        m = _transform_matrix(el.get("transform")) @ m
+        el = el.getparent()
+    sx, sy = float(np.hypot(m[0, 0], m[1, 0])), float(np.hypot(m[0, 1], m[1, 1]))
+    if sx <= 0 or sy <= 0:
+        raise TextFitUnresolved("the text's transforms collapse it to zero size")
+    return sx, sy
+
+def _fit_text_to_box(text_elem, lines: list, cfg: dict, svg_text: str):
+    """
+    Shrink or wrap a text placeholder into its mm box using cached font metrics. Returns
+    (lines, font_size): the size in the text element's own user units, or None when the
+    text already fits at its own size (nothing to write back).
+    """
+    w_mm, _, view_box = _svg_size_mm(svg_text)
+    uu_per_mm = view_box[2] / w_mm if w_mm else 1.0
+    scale = float(cfg.get("scale", 1.0) or 1.0)
+    sx, sy = _user_space_scale(text_elem)
+    box_w = float(cfg.get("box_w_mm", 0) or 0) * uu_per_mm / (scale * sx)
+    box_h = float(cfg.get("box_h_mm", 0) or 0) * uu_per_mm / (scale * sy)
+    size = _font_size_user_units(text_elem)
+    family = (_inherited_svg_prop(text_elem, "font-family") or "").split(",")[0].strip().strip("'\"")
+    weight = (_inherited_svg_prop(text_elem, "font-weight") or "").lower()
+    font_path = utils.resolve_font_path(family or None, bold=weight in ("bold", "bolder", "600", "700", "800", "900"))
+    lines, fitted = utils.fit_text_lines(lines, font_path, size, box_w, box_h or None, wrap=cfg.get("fit") == "Wrap to width")
+    return lines, (fitted if fitted < size else None)
+
+def text_fit_problems(svg_text: str, mapping: dict) -> list:
+    """Messages for fit-to-box placeholders whose font size or transforms cannot be resolved (they export unfitted)."""
+    problems = []
+    try:
+        root = etree.fromstring(svg_text.encode("utf-8"), parser=etree.XMLParser(recover=True, remove_blank_text=True))
+    except Exception:
+        return problems
+    for text_elem in list(root.iter("{http://www.w3.org/2000/svg}text")) + list(root.iter("text")):
+        matches = re.findall(r"\{\{\s*([A-Za-z0-9_\-\.]+)\s*\}\}", "".join(text_elem.itertext()))
+        cfg0 = mapping.get(matches[0], {}) if matches else {}
+        if cfg0.get("fit", "Off") == "Off" or not float(cfg0.get("box_w_mm", 0) or 0) > 0:
+            continue
+        try:
+            _font_size_user_units(text_elem)
+            _user_space_scale(text_elem)
+        except TextFitUnresolved as e:
+            problems.append(f"{{{{{matches[0]}}}}}: {e}; fit to box is skipped and the text keeps its size.")
+    return problems
+
+# ---------- output naming ----------
+def record_file_stem(rec: dict, idx: int, name_field: str = "") -> str:
+    """File name (without extension) of a record's outputs: the filename field or record_NNN, made path-safe."""
+    fname_base = rec.get(name_field, f"record_{idx+1:03d}") if name_field else f"record_{idx+1:03d}"
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(fname_base))
+
+# ---------- bundle helper ----------
+def bundle_zip(named_files: list, dest=None):
+    # payloads may be bytes or a Path spilled to disk by the memory governor;
+    # with dest set the archive is written to that file and its Path returned
+    buf = open(dest, "wb") if dest is not None else io.BytesIO()
+    try:
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for fname, data in named_files:
+                # rasters are already deflate-compressed; storing them skips a second pass over every pixel
+                compress = zipfile.ZIP_STORED if fname.lower().endswith((".png", ".tif")) else None
+                if isinstance(data, Path):
+                    zf.write(data, arcname=fname, compress_type=compress)
+                else:
+                    zf.writestr(fname, data, compress_type=compress)
+        return Path(dest) if dest is not None else buf.getvalue()
+    finally:
+        if dest is not None:
+            buf.close()
@@ -0,0 +1,242 @@
+# render_cache.py
+# Content-addressed on-disk cache for render outputs (sanitized templates, barcode
+# fragments, preview PNGs, per-record PDFs), shared by every Streamlit session and
+# worker process on the host and kept across restarts.
+#
+# Layout under the cache root:
+#   objects/ab/abcdef...   payload files, written atomically (temp file + os.replace)
+#   index.db               SQLite index: size + last use per key (LRU), a running byte total
+#                          kept by triggers, and hit/miss counters
+#
+# SQLite does the cross-process locking; eviction runs inside an IMMEDIATE transaction so
+# only one process evicts at a time. A reader that loses a race with eviction just sees a miss.
+# Hits never write to SQLite directly: last-use times (at most one per key per TOUCH_INTERVAL)
+# and hit/miss counters are buffered per process and flushed in one transaction every
+# FLUSH_INTERVAL seconds or FLUSH_BATCH events, so lookups do not queue on the writer lock.
+
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+DEFAULT_DIR = Path(tempfile.gettempdir()) / "packdeal_render_cache"
+DEFAULT_MAX_MB = 1024
+TOUCH_INTERVAL = 60.0
+FLUSH_INTERVAL = 5.0
+FLUSH_BATCH = 256
+
+
+def cache_key(*parts) -> str:
+    """
+    SHA-256 over the given parts. bytes/str are hashed as-is; anything else
+    (mapping plans, records) is hashed as canonical JSON.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode("utf-8")
+        else:
+            data = json.dumps(part, sort_keys=True, default=str, ensure_ascii=False).encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+class RenderCache:
+    """Size-bounded LRU cache of render payloads on local disk."""
+
+    def __init__(self, root=DEFAULT_DIR, max_mb: float = DEFAULT_MAX_MB):
+        self.root = Path(root)
+        self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        self.enabled = self.max_bytes > 0
+        # per-process buffers, written by flush(): key -> last use, kind -> [hits, misses]
+        self._lock = threading.Lock()
+        self._touches = {}
+        self._touched_at = {}
+        self._counts = {}
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        if self.enabled:
+            try:
+                (self.root / "objects").mkdir(parents=True, exist_ok=True)
+                with self._connect() as con:
+                    con.execute("PRAGMA journal_mode=WAL")
+                    con.execute("BEGIN IMMEDIATE")
+                    con.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, kind TEXT, size INTEGER, last_used REAL)")
+                    con.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_used)")
+                    con.execute("CREATE TABLE IF NOT EXISTS stats (kind TEXT PRIMARY KEY, hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)")
+                    con.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+                    # running total of entries.size; seeded once from indexes created before it existed
+                    con.execute("INSERT OR IGNORE INTO meta(name, value) "
+                                "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries")
+                    con.execute("CREATE TRIGGER IF NOT EXISTS entries_ins AFTER INSERT ON entries BEGIN "
+                                "UPDATE meta SET value = value + NEW.size WHERE name = 'total_bytes'; END")
+                    con.execute("CREATE TRIGGER IF NOT EXISTS entries_del AFTER DELETE ON entries BEGIN "
+                                "UPDATE meta SET value = value - OLD.size WHERE name = 'total_bytes'; END")
+                    con.execute("CREATE TRIGGER IF NOT EXISTS entries_upd AFTER UPDATE OF size ON entries BEGIN "
+                                "UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_bytes'; END")
+                    con.execute("COMMIT")
+                atexit.register(self.flush)
+            except (OSError, sqlite3.Error):
+                # read-only or full disk: run uncached rather than fail renders
+                self.enabled = False
+
+    @classmethod
+    def from_env(cls):
+        """Configured by RENDER_CACHE_DIR and RENDER_CACHE_MAX_MB (0 disables the cache)."""
+        return cls(os.environ.get("RENDER_CACHE_DIR", DEFAULT_DIR),
+                   float(os.environ.get("RENDER_CACHE_MAX_MB", DEFAULT_MAX_MB)))
+
+    @contextmanager
+    def _connect(self):
+        # autocommit connection per operation: safe to use from any Streamlit script thread
+        con = sqlite3.connect(self.root / "index.db", timeout=30, isolation_level=None)
+        try:
+            con.execute("PRAGMA synchronous=NORMAL")
+            yield con
+        finally:
+            con.close()
+
+    def _path(self, key: str) -> Path:
+        return self.root / "objects" / key[:2] / key
+
+    def _note(self, kind: str, hit: bool, key: str = None):
+        now = time.monotonic()
+        with self._lock:
+            self._counts.setdefault(kind, [0, 0])[0 if hit else 1] += 1
+            self._pending += 1
+            if key is not None and now - self._touched_at.get(key, -TOUCH_INTERVAL) >= TOUCH_INTERVAL:
+                if len(self._touched_at) > 50_000:
+                    self._touched_at.clear()
+                self._touched_at[key] = now
+                self._touches[key] = time.time()
+            due = self._pending >= FLUSH_BATCH or now - self._flushed_at >= FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write buffered last-use times and hit/miss counters in one transaction."""
+        with self._lock:
+            touches, counts = self._touches, self._counts
+            self._touches, self._counts, self._pending = {}, {}, 0
+            self._flushed_at = time.monotonic()
+        if not self.enabled or not (touches or counts):
+            return
+        try:
+            with self._connect() as con:
+                con.execute("BEGIN IMMEDIATE")
+                con.executemany("UPDATE entries SET last_used = MAX(last_used, ?) WHERE key = ?",
+                                [(ts, key) for key, ts in touches.items()])
+                con.executemany("INSERT INTO stats(kind, hits, misses) VALUES (?, ?, ?) ON CONFLICT(kind) DO UPDATE "
+                                "SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+                                [(kind, h, m) for kind, (h, m) in counts.items()])
+                con.execute("COMMIT")
+        except (OSError, sqlite3.Error):
+            pass  # counters and LRU order are best effort
+
+    def get(self, kind: str, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        try:
+            data = self._path(key).read_bytes()
+        except FileNotFoundError:
+            self._note(kind, hit=False)
+            return None
+        except OSError:
+            return None
+        self._note(kind, hit=True, key=key)
+        return data
+
+    def put(self, kind: str, key: str, data: bytes):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        try:
+            path = self._path(key)
+            path.parent.mkdir(exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp_")
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    fh.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+            with self._connect() as con:
+                # upsert (not INSERT OR REPLACE) so the size triggers see a replaced entry as an update
+                con.execute("INSERT INTO entries(key, kind, size, last_used) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(key) DO UPDATE SET kind = excluded.kind, size = excluded.size, "
+                            "last_used = excluded.last_used", (key, kind, len(data), time.time()))
+                total = con.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(con, int(self.max_bytes * 0.9))
+        except (OSError, sqlite3.Error):
+            pass
+
+    def _evict(self, con, target_bytes: int):
+        # IMMEDIATE takes the write lock up front so concurrent evictors queue instead of double-deleting
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            total = con.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+            victims = []
+            for key, size in con.execute("SELECT key, size FROM entries ORDER BY last_used"):
+                if total <= target_bytes:
+                    break
+                victims.append(key)
+                total -= size
+            con.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in victims])
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        for key in victims:
+            self._path(key).unlink(missing_ok=True)
+
+    def get_or_create(self, kind: str, key: str, producer: Callable[[], bytes]) -> bytes:
+        data = self.get(kind, key)
+        if data is None:
+            data = producer()
+            self.put(kind, key, data)
+        return data
+
+    def stats(self) -> dict:
+        """{"size_mb", "max_mb", "entries", "kinds": {kind: {"hits", "misses", "hit_rate"}}}"""
+        out = {"size_mb": 0.0, "max_mb": round(self.max_bytes / 2**20, 1), "entries": 0, "kinds": {}}
+        if not self.enabled:
+            return out
+        self.flush()
+        try:
+            with self._connect() as con:
+                n = con.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                total = con.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+                out["entries"] = n
+                out["size_mb"] = round(total / 2**20, 1)
+                for kind, hits, misses in con.execute("SELECT kind, hits, misses FROM stats ORDER BY kind"):
+                    lookups = hits + misses
+                    out["kinds"][kind] = {"hits": hits, "misses": misses,
+                                          "hit_rate": round(hits / lookups, 3) if lookups else 0.0}
+        except sqlite3.Error:
+            pass
+        return out
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._touches, self._touched_at, self._counts, self._pending = {}, {}, {}, 0
+        with self._connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            keys = [k for (k,) in con.execute("SELECT key FROM entries")]
+            con.execute("DELETE FROM entries")
+            con.execute("DELETE FROM stats")
+            con.execute("COMMIT")
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
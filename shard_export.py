@@ -0,0 +1,405 @@
+# shard_export.py
+# Row-sharded "one per record" export. The record set is split into shards (by row range or
+# by a hash of the output file name); independent workers - local processes or other hosts
+# sharing the job folder - each write a partial ZIP plus a manifest, and a final merge copies
+# the compressed entries into one ZIP without re-compressing, in single-node name and order.
+#
+# Job folder layout:
+#   job.json              templates, mappings and export settings
+#   records-00003.jsonl   the records of shard 3, one per line: seq (export order), idx (source row), stem, rec
+#   part-00003.zip        written by the worker for shard 3
+#   part-00003.json       its manifest; written last, so its presence means the shard is complete
+#   part-00003.log        stderr of a locally started worker
+#
+#   python shard_export.py plan JOB --template t.svg --mapping m.json --data d.csv --shards 8
+#   python shard_export.py work JOB --shard 3          (one per shard, on any host)
+#   python shard_export.py merge JOB --out variable_files.zip
+#   python shard_export.py run JOB --workers 4         (all shards as local processes, then merge)
+#   python shard_export.py prune                       (delete jobs older than the retention period)
+#
+# Job folders hold customer records, so the app only writes them under one root and removes
+# each folder once its ZIP has been handed over; plan-only jobs are pruned after a retention period.
+#   SHARD_JOB_ROOT              root of all job folders (default <tmp>/packdeal_jobs)
+#   SHARD_JOB_RETENTION_HOURS   age after which prune() deletes a job folder (default 24)
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from contextlib import ExitStack
+from pathlib import Path
+
+import pandas as pd
+
+import utils
+import pipeline
+
+JOB_FILE = "job.json"
+SHARD_BY = ("rows", "hash")
+# output order inside one record + template, as in the single-node export loop
+KIND_SVG, KIND_RASTER, KIND_PDF = 0, 1, 2
+
+
+def _part(job_dir: Path, shard: int, ext: str) -> Path:
+    return Path(job_dir) / f"part-{shard:05d}.{ext}"
+
+
+def _records(job_dir: Path, shard: int) -> Path:
+    return Path(job_dir) / f"records-{shard:05d}.jsonl"
+
+
+def job_root() -> Path:
+    return Path(os.environ.get("SHARD_JOB_ROOT") or Path(tempfile.gettempdir()) / "packdeal_jobs")
+
+
+def job_dir_under(root, subfolder: str, name: str) -> Path:
+    """
+    Folder for a new job: root/subfolder/name. The subfolder is one user-chosen path segment
+    (blank for none); anything that would leave the root raises ValueError.
+    """
+    root = Path(root).resolve()
+    subfolder = (subfolder or "").strip()
+    if subfolder and not re.fullmatch(r"[A-Za-z0-9._-]+", subfolder) or subfolder in (".", ".."):
+        raise ValueError(f"job subfolder {subfolder!r}: use letters, digits, '.', '_' and '-' only")
+    job_dir = (root / subfolder / name).resolve()
+    if root not in job_dir.parents:
+        raise ValueError(f"{job_dir} is outside the job root {root}")
+    return job_dir
+
+
+def prune_jobs(root=None, max_age_s: float = None) -> int:
+    """
+    Delete job folders (any folder holding a job.json) under `root` untouched for `max_age_s`
+    (default SHARD_JOB_RETENTION_HOURS). Returns how many were removed.
+    """
+    root = Path(root or job_root())
+    if max_age_s is None:
+        max_age_s = float(os.environ.get("SHARD_JOB_RETENTION_HOURS", "24")) * 3600
+    cutoff = time.time() - max_age_s
+    removed = 0
+    for marker in list(root.glob(f"**/{JOB_FILE}")) if root.is_dir() else ():
+        folder = marker.parent
+        try:
+            # workers touch the folder as they write parts and manifests
+            if max(folder.stat().st_mtime, marker.stat().st_mtime) < cutoff:
+                shutil.rmtree(folder, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def _json_value(v):
+    # numpy scalars -> python scalars, anything else (timestamps, decimals) -> str
+    return v.item() if hasattr(v, "item") else str(v)
+
+
+def shard_of(seq: int, stem: str, shards: int, by: str, total: int) -> int:
+    if by == "hash":
+        return zlib.crc32(stem.encode("utf-8")) % shards
+    return seq * shards // max(total, 1)
+
+
+def write_job(job_dir, targets: list, records: list, export_format: str, name_field: str = "",
+              shards: int = 4, shard_by: str = "rows", raster: dict = None, optimise_pdfs: bool = False) -> dict:
+    """
+    Lay out a sharded job. `targets` are {"name", "svg", "mapping"} dicts as in the app, `records`
+    the (source_idx, record) pairs to export in order (barcodes already canonical, invalid rows
+    dropped). Each shard's records go to their own file, so a worker reads only its share.
+    Stale parts of an earlier job in the same folder are removed. Returns the job dict.
+    """
+    if shard_by not in SHARD_BY:
+        raise ValueError(f"shard_by must be one of {SHARD_BY}")
+    job_dir = Path(job_dir)
+    job_dir.mkdir(parents=True, exist_ok=True)
+    for stale in list(job_dir.glob("part-*")) + list(job_dir.glob("records-*")):
+        stale.unlink()
+    shards = max(1, int(shards))
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(_records(job_dir, s), "w", encoding="utf-8")) for s in range(shards)]
+        for seq, (idx, rec) in enumerate(records):
+            stem = pipeline.record_file_stem(rec, idx, name_field)
+            line = {"seq": seq, "idx": int(idx), "stem": stem, "rec": rec}
+            files[shard_of(seq, stem, shards, shard_by, len(records))].write(
+                json.dumps(line, ensure_ascii=False, default=_json_value) + "\n")
+    job = {"version": 1, "targets": targets, "fanout": len(targets) > 1, "export_format": export_format,
+           "name_field": name_field, "shards": shards, "shard_by": shard_by, "records": len(records),
+           "raster": raster, "optimise_pdfs": bool(optimise_pdfs), "render_version": pipeline.RENDER_VERSION}
+    (job_dir / JOB_FILE).write_text(json.dumps(job, ensure_ascii=False), encoding="utf-8")
+    return job
+
+
+def run_shard(job_dir, shard: int) -> dict:
+    """Export every record of one shard into part-NNNNN.zip and write its manifest. Returns the manifest."""
+    job_dir = Path(job_dir)
+    job = json.loads((job_dir / JOB_FILE).read_text(encoding="utf-8"))
+    if not 0 <= shard < job["shards"]:
+        raise ValueError(f"shard {shard} out of range (job has {job['shards']})")
+    if job.get("render_version") != pipeline.RENDER_VERSION:
+        raise RuntimeError(f"job was planned with renderer {job.get('render_version')}, this worker has {pipeline.RENDER_VERSION}")
+    want_svg = job["export_format"] in ("SVG only", "PDF + SVG")
+    want_pdf = job["export_format"] in ("PDF only", "PDF + SVG")
+    raster = job.get("raster")
+    t0 = time.perf_counter()
+    entries, warnings, n_records = [], [], 0
+    tmp_zip = _part(job_dir, shard, "zip.tmp")
+    with zipfile.ZipFile(tmp_zip, "w", zipfile.ZIP_DEFLATED) as zf, \
+            open(_records(job_dir, shard), encoding="utf-8") as records:
+        for line in records:
+            item = json.loads(line)
+            n_records += 1
+            seq, idx, safe, rec = item["seq"], item["idx"], item["stem"], item["rec"]
+            fragments = {}
+            for t_i, target in enumerate(job["targets"]):
+                mapping = target["mapping"]
+                prefix = f"{target['name']}/" if job["fanout"] else ""
+                where = f"Row {idx+1}{' (' + target['name'] + ')' if job['fanout'] else ''}"
+                if not any(rec.get(cfg["col"], "") not in ("", None) for cfg in mapping.values()):
+                    continue
+                try:
+                    final_svg = pipeline.apply_mapping_to_svg(target["svg"], mapping, rec, barcodes_canonical=True,
+                                                              fragment_cache=fragments)
+                except Exception as e:
+                    warnings.append(f"{where}: mapping error: {e} — skipped")
+                    continue
+                if want_svg:
+                    zf.writestr(f"{prefix}{safe}.svg", final_svg.encode("utf-8"))
+                    entries.append([seq, t_i, KIND_SVG, f"{prefix}{safe}.svg"])
+                if raster is not None:
+                    raster_path = job_dir / f"raster-{shard:05d}.{raster['ext']}"
+                    try:
+                        pipeline.export_raster_tiled(final_svg, raster_path, raster["ext"], raster["dpi"], raster["tile_px"])
+                        zf.write(raster_path, arcname=f"{prefix}{safe}.{raster['ext']}", compress_type=zipfile.ZIP_STORED)
+                        entries.append([seq, t_i, KIND_RASTER, f"{prefix}{safe}.{raster['ext']}"])
+                    except Exception as e:
+                        warnings.append(f"{where}: raster export failed: {e}")
+                    finally:
+                        raster_path.unlink(missing_ok=True)
+                if want_pdf:
+                    try:
+                        pdf_bytes = pipeline.cached_svg_to_pdf_bytes(final_svg)
+                    except Exception as e:
+                        warnings.append(f"{where}: PDF generation failed: {e}")
+                        continue
+                    if job["optimise_pdfs"]:
+                        try:
+                            pdf_bytes = utils.optimise_pdf_bytes(pdf_bytes)[0]
+                        except Exception as e:
+                            warnings.append(f"{safe}.pdf: PDF optimisation failed: {e} — kept as rendered")
+                    zf.writestr(f"{prefix}{safe}.pdf", pdf_bytes)
+                    entries.append([seq, t_i, KIND_PDF, f"{prefix}{safe}.pdf"])
+    os.replace(tmp_zip, _part(job_dir, shard, "zip"))
+    manifest = {"shard": shard, "records": n_records, "entries": entries, "warnings": warnings,
+                "seconds": round(time.perf_counter() - t0, 3), "host": platform.node()}
+    tmp_manifest = _part(job_dir, shard, "json.tmp")
+    tmp_manifest.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp_manifest, _part(job_dir, shard, "json"))
+    return manifest
+
+
+def shard_status(job_dir) -> dict:
+    """{"shards", "done": [shard numbers with a manifest]}"""
+    job = json.loads((Path(job_dir) / JOB_FILE).read_text(encoding="utf-8"))
+    return {"shards": job["shards"], "done": [s for s in range(job["shards"]) if _part(job_dir, s, "json").exists()]}
+
+
+def merge_shards(job_dir, dest) -> dict:
+    """
+    Merge every shard's partial ZIP into `dest` in single-node order, copying compressed entries
+    as-is. Raises FileNotFoundError while a shard has not finished.
+    Returns {"files", "records", "warnings", "worker_seconds", "seconds", "bytes"}.
+    """
+    t0 = time.perf_counter()
+    job_dir = Path(job_dir)
+    job = json.loads((job_dir / JOB_FILE).read_text(encoding="utf-8"))
+    manifests = []
+    for shard in range(job["shards"]):
+        path = _part(job_dir, shard, "json")
+        if not path.exists():
+            raise FileNotFoundError(f"shard {shard} has not finished ({path.name} missing)")
+        manifests.append(json.loads(path.read_text(encoding="utf-8")))
+
+    order = sorted((tuple(entry[:3]), shard, pos)
+                   for shard, man in enumerate(manifests) for pos, entry in enumerate(man["entries"]))
+    with ExitStack() as stack:
+        sources = []
+        for shard in range(job["shards"]):
+            fh = stack.enter_context(open(_part(job_dir, shard, "zip"), "rb"))
+            infos = zipfile.ZipFile(fh).infolist()
+            if len(infos) != len(manifests[shard]["entries"]):
+                raise zipfile.BadZipFile(f"shard {shard}: ZIP and manifest disagree")
+            sources.append((fh, infos))
+        with open(dest, "wb") as out:
+            writer = utils.RawZipWriter(out)
+            for _, shard, pos in order:
+                fh, infos = sources[shard]
+                writer.copy_entry(fh, infos[pos])
+            writer.close()
+    return {"files": len(order), "records": sum(m["records"] for m in manifests),
+            "warnings": [w for m in manifests for w in m["warnings"]],
+            "worker_seconds": round(sum(m["seconds"] for m in manifests), 3),
+            "seconds": round(time.perf_counter() - t0, 3), "bytes": Path(dest).stat().st_size}
+
+
+class LocalWorkers:
+    """
+    Runs shard workers as local processes, at most `max_workers` at a time (default: one per
+    CPU); the other shards wait in a queue. Each worker's stderr goes to part-NNNNN.log in the
+    job folder. Call poll() until it returns False, or wait().
+    """
+
+    def __init__(self, job_dir, shards=None, max_workers=None):
+        self.job_dir = Path(job_dir)
+        job = json.loads((self.job_dir / JOB_FILE).read_text(encoding="utf-8"))
+        self.pending = deque(range(job["shards"]) if shards is None else shards)
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.running = {}       # shard -> Popen
+        self.returncodes = {}   # shard -> exit status of a finished worker
+
+    def _launch(self, shard: int) -> subprocess.Popen:
+        with open(_part(self.job_dir, shard, "log"), "wb") as log:
+            return subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "work", str(self.job_dir),
+                                     "--shard", str(shard)], stdout=subprocess.DEVNULL, stderr=log)
+
+    def poll(self) -> bool:
+        """Reap finished workers and start queued shards in their place; True while any shard is queued or running."""
+        for shard, proc in list(self.running.items()):
+            if proc.poll() is not None:
+                self.returncodes[shard] = proc.returncode
+                del self.running[shard]
+        while self.pending and len(self.running) < self.max_workers:
+            shard = self.pending.popleft()
+            self.running[shard] = self._launch(shard)
+        return bool(self.running or self.pending)
+
+    def wait(self, interval: float = 0.2) -> dict:
+        while self.poll():
+            time.sleep(interval)
+        return self.returncodes
+
+    @property
+    def failed(self) -> list:
+        return sorted(shard for shard, code in self.returncodes.items() if code)
+
+    def terminate(self):
+        """Drop the queued shards and stop the running workers (neither counts as failed)."""
+        self.pending.clear()
+        for proc in self.running.values():
+            proc.terminate()
+            proc.wait()
+        self.running.clear()
+
+
+def worker_log_tail(job_dir, shard: int, lines: int = 5) -> str:
+    try:
+        return "\n".join(_part(job_dir, shard, "log").read_text(encoding="utf-8", errors="replace").strip().splitlines()[-lines:])
+    except OSError:
+        return ""
+
+
+def load_table(path: Path) -> pd.DataFrame:
+    name = path.name.lower()
+    if name.endswith(".csv"):
+        try:
+            return pd.read_csv(path)
+        except UnicodeDecodeError:
+            return pd.read_csv(path, encoding="latin-1")
+    if name.endswith((".parquet", ".pq")):
+        return pd.read_parquet(path)
+    if name.endswith((".arrow", ".feather", ".ipc")):
+        return pd.read_feather(path)
+    if name.endswith(".xlsx"):
+        return pd.read_excel(path, engine="openpyxl")
+    if name.endswith(".xml"):
+        from lxml import etree
+        root = etree.fromstring(pipeline._decode_bytes(path.read_bytes()).encode("utf-8"))
+        return pd.DataFrame([{child.tag: child.text for child in row} for row in root])
+    raise ValueError(f"Unsupported data file: {path.name}")
+
+
+def plan_from_files(job_dir, template: Path, mapping: Path, data: Path, **job_kwargs) -> dict:
+    """CLI planning: same preparation as the app (sanitise, barcode pre-pass, skip invalid rows)."""
+    svg = pipeline.cached_sanitize_for_preview(template.read_bytes())
+    raw_mapping = json.loads(mapping.read_text(encoding="utf-8"))
+    if not isinstance(raw_mapping, dict):
+        raise ValueError(f"{mapping.name}: JSON mapping must be an object mapping placeholder→config")
+    mapping_cfg, problems = pipeline.normalize_mapping(raw_mapping, pipeline.find_placeholders(svg))
+    for problem in problems:
+        print(f"{mapping.name}: {problem} — entry ignored", file=sys.stderr)
+    df = load_table(data)
+    checked, _, invalid_rows = pipeline.prepare_barcode_columns(df, mapping_cfg)
+    records = [(idx, {str(k): ("" if pd.isna(v) else v) for k, v in row.to_dict().items()})
+               for idx, row in checked.iterrows() if idx not in invalid_rows]
+    if invalid_rows:
+        print(f"Skipping {len(invalid_rows)} row(s) with invalid EANs.", file=sys.stderr)
+    return write_job(job_dir, [{"name": template.stem, "svg": svg, "mapping": mapping_cfg}], records, **job_kwargs)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Row-sharded export: plan, run shard workers, merge partial ZIPs.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("plan", help="split a template + data set into a sharded job")
+    p.add_argument("job_dir", type=Path)
+    p.add_argument("--template", type=Path, required=True)
+    p.add_argument("--mapping", type=Path, required=True, help="mapping JSON as downloaded from the app")
+    p.add_argument("--data", type=Path, required=True)
+    p.add_argument("--shards", type=int, default=os.cpu_count() or 4)
+    p.add_argument("--by", choices=SHARD_BY, default="rows", help="row ranges or hash of the output file name")
+    p.add_argument("--format", choices=["SVG only", "PDF only", "PDF + SVG"], default="PDF only")
+    p.add_argument("--name-field", default="")
+    p.add_argument("--optimise-pdfs", action="store_true")
+    w = sub.add_parser("work", help="export one shard")
+    w.add_argument("job_dir", type=Path)
+    w.add_argument("--shard", type=int, required=True)
+    m = sub.add_parser("merge", help="merge finished shards into one ZIP")
+    m.add_argument("job_dir", type=Path)
+    m.add_argument("--out", type=Path, default=Path("variable_files.zip"))
+    r = sub.add_parser("run", help="run every shard as a local process, then merge")
+    r.add_argument("job_dir", type=Path)
+    r.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="shard processes running at once")
+    r.add_argument("--out", type=Path, default=Path("variable_files.zip"))
+    c = sub.add_parser("prune", help="delete job folders older than the retention period")
+    c.add_argument("--root", type=Path, help="job root (default: SHARD_JOB_ROOT)")
+    c.add_argument("--hours", type=float, help="retention (default: SHARD_JOB_RETENTION_HOURS or 24)")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "plan":
+        job = plan_from_files(args.job_dir, args.template, args.mapping, args.data, export_format=args.format,
+                              name_field=args.name_field, shards=args.shards, shard_by=args.by,
+                              optimise_pdfs=args.optimise_pdfs)
+        print(f"Planned {job['records']} record(s) in {job['shards']} shard(s) by {job['shard_by']} under {args.job_dir}")
+    elif args.cmd == "work":
+        man = run_shard(args.job_dir, args.shard)
+        print(f"Shard {args.shard}: {man['records']} record(s), {len(man['entries'])} file(s) in {man['seconds']:.1f} s")
+        for warning in man["warnings"]:
+            print(warning, file=sys.stderr)
+    elif args.cmd == "prune":
+        removed = prune_jobs(args.root, args.hours * 3600 if args.hours is not None else None)
+        print(f"Removed {removed} job folder(s) from {args.root or job_root()}")
+    else:
+        if args.cmd == "run":
+            workers = LocalWorkers(args.job_dir, max_workers=args.workers)
+            while workers.poll() and not workers.failed:
+                time.sleep(0.2)
+            if workers.failed:
+                workers.terminate()
+                shard = workers.failed[0]
+                sys.exit(f"shard {shard} failed:\n{worker_log_tail(args.job_dir, shard)}")
+        info = merge_shards(args.job_dir, args.out)
+        print(f"Merged {info['files']} file(s) from {info['records']} record(s) into {args.out} "
+              f"({info['bytes'] / 2**20:.1f} MB, merge {info['seconds']:.1f} s, workers {info['worker_seconds']:.1f} s total)")
+        for warning in info["warnings"]:
+            print(warning, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# tests import the app's flat modules (utils, render_cache, ...) from the repository root
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
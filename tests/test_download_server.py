@@ -0,0 +1,20 @@
+import pytest
+
+import download_server
+
+
+@pytest.mark.parametrize("env, enabled", [
+    ({}, False),
+    ({"DOWNLOAD_PORT": "8502"}, False),
+    ({"DOWNLOAD_BASE_URL": "https://example.com/dl"}, False),
+    ({"DOWNLOAD_PORT": "8502", "DOWNLOAD_BASE_URL": "https://example.com/dl"}, True),
+])
+def test_server_is_opt_in(monkeypatch, env, enabled):
+    for name in ("DOWNLOAD_PORT", "DOWNLOAD_BASE_URL"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    server = download_server.DownloadServer.from_env()
+    assert (server is not None) == enabled
+    if enabled:
+        assert server.url_for("/tok/a.zip") == "https://example.com/dl/tok/a.zip"
@@ -0,0 +1,36 @@
+import numpy as np
+
+import utils
+
+
+def test_validate_ean13_column_statuses():
+    values = ["5901234123457", "590123412345", "5901234123450", None, "", "abc", "12", " 590-1234-12345-7 "]
+    canonical, status = utils.validate_ean13_column(values)
+    assert status == ["ok", "corrected", "corrected", "missing", "missing", "invalid", "invalid", "ok"]
+    assert canonical == ["5901234123457", "5901234123457", "5901234123457", None, None, None, None, "5901234123457"]
+
+
+def test_validate_ean13_column_spreadsheet_floats():
+    canonical, status = utils.validate_ean13_column([5901234123457.0, float("nan"), np.float64(4006381333931)])
+    assert canonical == ["5901234123457", None, "4006381333931"]
+    assert status == ["ok", "missing", "ok"]
+
+
+def test_validate_ean13_column_matches_scalar_normalizer():
+    rng = np.random.default_rng(7)
+    values = ["".join(map(str, rng.integers(0, 10, size=rng.choice([11, 12, 13, 14])))) for _ in range(500)]
+    canonical, _ = utils.validate_ean13_column(values)
+    assert canonical == [utils.normalize_to_ean13(v) for v in values]
+
+
+def test_validate_ean13_column_empty():
+    assert utils.validate_ean13_column([]) == ([], [])
+
+
+def test_bars_are_not_cached_per_code_but_columns_are():
+    utils._ean13_columns.cache_clear()
+    for code in ("4006381333931", "5901234123457", "9780201379624"):
+        bars = utils.ean13_bars_array(code, 226, 80)
+        assert bars.flags.writeable
+    assert utils._ean13_columns.cache_info().hits == 2
+    assert not hasattr(utils.ean13_bars_array, "cache_info")
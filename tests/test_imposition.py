@@ -0,0 +1,107 @@
+import io
+
+import pytest
+from lxml import etree
+
+import pipeline
+import utils
+
+
+def test_nup_layout_counts_and_centres_the_grid():
+    layout = utils.compute_nup_layout(320, 450, 60, 40, gap_mm=2, bleed_mm=3, margin_mm=5)
+    # footprint 66×46 mm; (310 + 2) // 68 = 4 columns, (440 + 2) // 48 = 9 rows
+    assert (layout["cols"], layout["rows"], layout["per_sheet"]) == (4, 9, 36)
+    assert len(layout["cells"]) == 36
+    x0, y0 = layout["cells"][0]
+    used_w, used_h = 4 * 66 + 3 * 2, 9 * 46 + 8 * 2
+    assert x0 == pytest.approx(5 + (310 - used_w) / 2 + 3)
+    assert y0 == pytest.approx(5 + (440 - used_h) / 2 + 3)
+    # row-major, stepping by footprint + gap
+    assert layout["cells"][1] == pytest.approx((x0 + 68, y0))
+    assert layout["cells"][4] == pytest.approx((x0, y0 + 48))
+
+
+def test_nup_layout_cells_stay_on_the_sheet():
+    layout = utils.compute_nup_layout(210, 297, 50, 30, gap_mm=1.5, bleed_mm=2, margin_mm=4)
+    for x, y in layout["cells"]:
+        assert x - 2 >= 4 and y - 2 >= 4
+        assert x + 50 + 2 <= 210 - 4 + 1e-9 and y + 30 + 2 <= 297 - 4 + 1e-9
+
+
+def test_nup_layout_cell_larger_than_sheet():
+    layout = utils.compute_nup_layout(210, 297, 300, 30)
+    assert layout["per_sheet"] == 0 and layout["cells"] == []
+
+
+def _painted(svg_text):
+    """Tags and text of the painting elements of a layer, in paint order (None for no layer)."""
+    if svg_text is None:
+        return None
+    root = etree.fromstring(svg_text.encode("utf-8"))
+    out = []
+    for el in root.iter():
+        tag = etree.QName(el).localname
+        if tag in ("rect", "circle", "path"):
+            out.append(tag)
+        elif tag == "text":
+            out.append("".join(el.itertext()))
+    return out
+
+
+def _svg(body):
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10">'
+            f'<defs><linearGradient id="g1"/></defs>{body}</svg>')
+
+
+def test_split_keeps_artwork_above_the_placeholders_in_its_own_layer():
+    svg = _svg('<rect/><g transform="scale(2)"><text>{{a}}</text><circle/></g><text>{{b}}</text><path/>')
+    below, variable, above = pipeline.split_template_layers(svg)
+    assert _painted(below) == ["rect"]
+    # artwork painted between two placeholders has to stay with them
+    assert _painted(variable) == ["{{a}}", "circle", "{{b}}"]
+    assert _painted(above) == ["path"]
+    for layer in (below, variable, above):
+        assert 'id="g1"' in layer and 'transform="scale(2)"' in layer
+
+
+def test_split_for_one_placeholder_puts_later_placeholders_above():
+    below, variable, above = pipeline.split_template_layers(
+        _svg("<rect/><text>{{name}}</text><text>{{price}}</text>"), only={"name"})
+    assert (_painted(below), _painted(variable), _painted(above)) == (["rect"], ["{{name}}"], ["{{price}}"])
+
+
+def test_split_without_artwork_around_the_placeholders():
+    below, variable, above = pipeline.split_template_layers(_svg("<text>{{a}}</text>"))
+    assert below is None and above is None and _painted(variable) == ["{{a}}"]
+
+
+def test_split_never_divides_a_group_with_opacity():
+    below, variable, above = pipeline.split_template_layers(
+        _svg('<g opacity="0.5"><rect/><text>{{a}}</text></g><path/>'))
+    assert below is None
+    assert _painted(variable) == ["rect", "{{a}}"]
+    assert _painted(above) == ["path"]
+
+
+def test_shared_layers_are_drawn_below_and_above_each_sheet():
+    pikepdf = pytest.importorskip("pikepdf")
+
+    def _pdf():
+        with pikepdf.new() as pdf:
+            pdf.add_blank_page(page_size=(200, 200))
+            buf = io.BytesIO()
+            pdf.save(buf)
+        return buf.getvalue()
+
+    layout = utils.compute_nup_layout(70, 70, 20, 20)
+    merged = utils.merge_sheets_with_shared_layer([_pdf()], _pdf(), layout, [2], above_pdf=_pdf())
+    with pikepdf.open(io.BytesIO(merged)) as pdf:
+        page = pdf.pages[0]
+        names = [str(n) for n in page.Resources.XObject.keys()]
+        streams = page.obj.Contents
+        ops = [bytes(s.read_bytes()).decode("ascii") for s in streams]
+    assert len(names) == 2
+    # the blank sheet's own content sits between the two stamps
+    first, last = ({n for n in names if n in ops[i]} for i in (0, -1))
+    assert len(first) == len(last) == 1 and first != last
+    assert ops[0].count(" Do Q") == 2 and ops[-1].count(" Do Q") == 2
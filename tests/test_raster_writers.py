@@ -0,0 +1,65 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+
+
+def _image(width, height, channels):
+    rng = np.random.default_rng(7)
+    return rng.integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_png_writer_round_trip_in_uneven_bands(channels):
+    img = _image(37, 23, channels)
+    buf = io.BytesIO()
+    writer = utils.StreamingPNGWriter(buf, 37, 23, channels=channels, dpi=300)
+    for y0, y1 in ((0, 1), (1, 10), (10, 23)):
+        writer.write_rows(img[y0:y1])
+    writer.close()
+    out = Image.open(io.BytesIO(buf.getvalue()))
+    assert out.mode == ("RGBA" if channels == 4 else "RGB")
+    assert np.array_equal(np.asarray(out), img)
+    assert out.info["dpi"] == pytest.approx((300, 300), abs=0.01)
+
+
+def test_png_writer_rejects_missing_rows():
+    writer = utils.StreamingPNGWriter(io.BytesIO(), 8, 8)
+    writer.write_rows(_image(8, 4, 3))
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+@pytest.mark.parametrize("channels, bigtiff", [(3, False), (4, False), (3, True)])
+def test_tiff_writer_round_trip_with_edge_tiles_out_of_order(channels, bigtiff):
+    width, height, tile = 40, 35, 16
+    img = _image(width, height, channels)
+    buf = io.BytesIO()
+    writer = utils.TiledTIFFWriter(buf, width, height, tile=tile, channels=channels, dpi=150, bigtiff=bigtiff)
+    grid = [(r, c) for r in range(writer.down) for c in range(writer.across)]
+    for r, c in reversed(grid):
+        writer.write_tile(r, c, img[r * tile:(r + 1) * tile, c * tile:(c + 1) * tile])
+    writer.close()
+    out = Image.open(io.BytesIO(buf.getvalue()))
+    assert out.size == (width, height)
+    assert np.array_equal(np.asarray(out), img)
+
+
+def test_tiff_writer_tile_size_must_be_a_multiple_of_16():
+    with pytest.raises(ValueError):
+        utils.TiledTIFFWriter(io.BytesIO(), 10, 10, tile=20)
+
+
+def test_rasters_written_to_the_spill_dir_are_not_counted_as_spilled():
+    governor = utils.ExportMemoryGovernor(0)
+    raster = governor.spill_path("a.png")
+    raster.write_bytes(b"png")
+    files = [governor.hold("a.svg", b"<svg/>"), governor.hold("a.png", raster)]
+    governor.checkpoint(files)
+    assert files == [("a.svg", b"<svg/>"), ("a.png", raster)]
+    assert governor.summary()["spilled_files"] == 0
+    governor.close()
+    assert not raster.exists()
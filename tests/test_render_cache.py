@@ -0,0 +1,59 @@
+import sqlite3
+
+import render_cache
+
+
+def _total(cache):
+    with sqlite3.connect(cache.root / "index.db") as con:
+        running = con.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+        actual = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    return running, actual
+
+
+def test_eviction_keeps_cache_under_budget(tmp_path):
+    cache = render_cache.RenderCache(tmp_path, max_mb=0.01)  # ~10 KB
+    for i in range(40):
+        cache.put("pdf", f"{i:064x}", bytes(1000))
+    running, actual = _total(cache)
+    assert running == actual <= cache.max_bytes
+    assert cache.get("pdf", f"{0:064x}") is None  # oldest entries went first
+    assert cache.get("pdf", f"{39:064x}") == bytes(1000)
+
+
+def test_eviction_follows_last_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_cache, "TOUCH_INTERVAL", 0.0)
+    cache = render_cache.RenderCache(tmp_path, max_mb=0.01)
+    for i in range(8):
+        cache.put("pdf", f"{i:064x}", bytes(1000))
+    assert cache.get("pdf", f"{0:064x}") is not None  # touch the oldest entry
+    cache.flush()
+    for i in range(8, 12):
+        cache.put("pdf", f"{i:064x}", bytes(1000))
+    assert cache.get("pdf", f"{0:064x}") is not None
+    assert cache.get("pdf", f"{1:064x}") is None
+
+
+def test_running_total_tracks_replace_and_clear(tmp_path):
+    cache = render_cache.RenderCache(tmp_path, max_mb=1)
+    cache.put("pdf", "a" * 64, bytes(100))
+    cache.put("pdf", "a" * 64, bytes(300))
+    cache.put("png", "b" * 64, bytes(50))
+    assert _total(cache) == (350, 350)
+    cache.clear()
+    assert _total(cache) == (0, 0)
+
+
+def test_hit_and_miss_counters_are_flushed(tmp_path):
+    cache = render_cache.RenderCache(tmp_path, max_mb=1)
+    calls = []
+    for _ in range(3):
+        cache.get_or_create("pdf", "c" * 64, lambda: calls.append(1) or b"payload")
+    assert calls == [1]
+    assert cache.stats()["kinds"]["pdf"] == {"hits": 2, "misses": 1, "hit_rate": 0.667}
+
+
+def test_disabled_cache_is_a_no_op(tmp_path):
+    cache = render_cache.RenderCache(tmp_path, max_mb=0)
+    cache.put("pdf", "d" * 64, b"x")
+    assert cache.get("pdf", "d" * 64) is None
+    assert not (tmp_path / "index.db").exists()
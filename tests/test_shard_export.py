@@ -0,0 +1,97 @@
+import io
+import json
+import os
+import time
+import zipfile
+
+import pytest
+
+import shard_export
+import utils
+
+SVG = ('<svg xmlns="http://www.w3.org/2000/svg" width="40mm" height="20mm" viewBox="0 0 40 20">'
+       '<text x="2" y="10">{{name}}</text></svg>')
+
+
+def _zip(entries, compression):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    return buf
+
+
+def test_raw_zip_writer_copies_entries_verbatim_in_any_order():
+    a = _zip([("a/one.svg", b"<svg/>" * 500), ("ünï.txt", "text".encode("utf-8"))], zipfile.ZIP_DEFLATED)
+    b = _zip([("two.png", bytes(range(256)) * 40)], zipfile.ZIP_STORED)
+    out = io.BytesIO()
+    writer = utils.RawZipWriter(out)
+    for src in (b, a):
+        for info in zipfile.ZipFile(src).infolist():
+            writer.copy_entry(src, info)
+    writer.close()
+
+    merged = zipfile.ZipFile(io.BytesIO(out.getvalue()))
+    assert merged.testzip() is None
+    assert merged.namelist() == ["two.png", "a/one.svg", "ünï.txt"]
+    assert merged.read("a/one.svg") == b"<svg/>" * 500
+    assert merged.getinfo("a/one.svg").compress_type == zipfile.ZIP_DEFLATED
+    assert merged.getinfo("two.png").compress_type == zipfile.ZIP_STORED
+
+
+def _records(n):
+    return [(i, {"name": f"item-{i}"}) for i in range(n)]
+
+
+@pytest.mark.parametrize("by", shard_export.SHARD_BY)
+def test_each_shard_gets_its_own_records_file(tmp_path, by):
+    shard_export.write_job(tmp_path, [{"name": "t", "svg": SVG, "mapping": {"name": {"col": "name"}}}],
+                           _records(10), "SVG only", shards=3, shard_by=by)
+    seen = []
+    for shard in range(3):
+        lines = (tmp_path / f"records-{shard:05d}.jsonl").read_text(encoding="utf-8").splitlines()
+        seen += [json.loads(line)["seq"] for line in lines]
+    assert sorted(seen) == list(range(10))
+
+
+def test_sharded_job_merges_in_single_node_order(tmp_path):
+    shard_export.write_job(tmp_path, [{"name": "t", "svg": SVG, "mapping": {"name": {"col": "name"}}}],
+                           _records(7), "SVG only", shards=3, shard_by="hash")
+    for shard in range(3):
+        shard_export.run_shard(tmp_path, shard)
+    info = shard_export.merge_shards(tmp_path, tmp_path / "out.zip")
+    names = zipfile.ZipFile(tmp_path / "out.zip").namelist()
+    assert info["files"] == 7
+    assert names == [f"record_{i + 1:03d}.svg" for i in range(7)]
+
+
+def test_job_dir_stays_under_the_root(tmp_path):
+    assert shard_export.job_dir_under(tmp_path, "", "job-1") == tmp_path.resolve() / "job-1"
+    assert shard_export.job_dir_under(tmp_path, "team-a", "job-1") == tmp_path.resolve() / "team-a" / "job-1"
+    for bad in ("..", "../x", "/etc", "a/b"):
+        with pytest.raises(ValueError):
+            shard_export.job_dir_under(tmp_path, bad, "job-1")
+
+
+def test_prune_jobs_removes_only_old_job_folders(tmp_path):
+    for name in ("old", "new"):
+        shard_export.write_job(tmp_path / name, [{"name": "t", "svg": SVG, "mapping": {}}], _records(1), "SVG only")
+    (tmp_path / "not-a-job").mkdir()
+    past = time.time() - 7200
+    for path in (tmp_path / "old", tmp_path / "old" / "job.json"):
+        os.utime(path, (past, past))
+    assert shard_export.prune_jobs(tmp_path, max_age_s=3600) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["new", "not-a-job"]
+
+
+def test_local_workers_queue_shards_beyond_max_workers(tmp_path):
+    shard_export.write_job(tmp_path, [{"name": "t", "svg": SVG, "mapping": {"name": {"col": "name"}}}],
+                           _records(5), "SVG only", shards=4, shard_by="rows")
+    workers = shard_export.LocalWorkers(tmp_path, max_workers=2)
+    peak = 0
+    while workers.poll():
+        peak = max(peak, len(workers.running))
+        time.sleep(0.05)
+    assert peak == 2
+    assert workers.returncodes == {0: 0, 1: 0, 2: 0, 3: 0} and not workers.failed
+    assert shard_export.merge_shards(tmp_path, tmp_path / "out.zip")["files"] == 5
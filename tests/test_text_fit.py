@@ -0,0 +1,94 @@
+import pytest
+from lxml import etree
+
+import pipeline
+import utils
+
+SVG_NS = "http://www.w3.org/2000/svg"
+
+
+def test_fit_text_lines_shrinks_to_the_widest_line():
+    lines = ["short", "a much longer line of text"]
+    widest = utils.text_width(lines[1], None, 20)
+    out, size = utils.fit_text_lines(lines, None, 20, widest / 2)
+    assert out == lines
+    assert size == pytest.approx(10, rel=1e-3)
+    assert utils.text_width(lines[1], None, size) <= widest / 2 * 1.0001
+
+
+def test_fit_text_lines_never_grows_and_respects_height():
+    assert utils.fit_text_lines(["x"], None, 12, 1000)[1] == 12
+    # two lines in a 10-unit-high box: at most 5 units each
+    assert utils.fit_text_lines(["a", "b"], None, 12, 1000, box_h=10)[1] == pytest.approx(5)
+
+
+def test_fit_text_lines_wraps_to_width():
+    text = "one two three four five six"
+    box_w = utils.text_width("one two three", None, 10)
+    out, size = utils.fit_text_lines([text], None, 10, box_w, wrap=True)
+    assert size == 10 and len(out) > 1
+    assert " ".join(out) == text
+    assert all(utils.text_width(l, None, size) <= box_w * 1.0001 for l in out)
+
+
+def _text(svg_body: str):
+    root = etree.fromstring(f'<svg xmlns="{SVG_NS}" viewBox="0 0 100 100" width="100mm" height="100mm">'
+                            f'{svg_body}</svg>')
+    return root, root.find(f".//{{{SVG_NS}}}text")
+
+
+@pytest.mark.parametrize("style, expected", [
+    ("font-size:12px", 12), ("font-size:12", 12), ("font-size:9pt", 12), ("font-size:1in", 96),
+    ("font-size:25.4mm", 96), ("font-size:2.54cm", 96), ("font-size:large", 18),
+])
+def test_font_size_units(style, expected):
+    _, text = _text(f'<text style="{style}">{{{{a}}}}</text>')
+    assert pipeline._font_size_user_units(text) == pytest.approx(expected)
+
+
+def test_font_size_relative_units_follow_the_parents():
+    _, text = _text('<g font-size="10mm"><g style="font-size:50%"><text style="font-size:2em">{{a}}</text></g></g>')
+    assert pipeline._font_size_user_units(text) == pytest.approx(10 * 96 / 25.4)
+
+
+def test_font_size_unresolvable_unit_is_reported():
+    root, text = _text('<text style="font-size:3vw">{{a}}</text>')
+    with pytest.raises(pipeline.TextFitUnresolved):
+        pipeline._font_size_user_units(text)
+    problems = pipeline.text_fit_problems(etree.tostring(root).decode(),
+                                          {"a": {"fit": "Shrink to fit", "box_w_mm": 20}})
+    assert len(problems) == 1 and "3vw" in problems[0]
+
+
+def test_parent_transforms_scale_the_box():
+    _, text = _text('<g transform="translate(5 5) scale(2)"><text transform="rotate(90)">{{a}}</text></g>')
+    assert pipeline._user_space_scale(text) == pytest.approx((2, 2))
+
+
+def test_font_size_from_class_rules_and_the_font_shorthand():
+    _, text = _text('<style>text{font-size:20px} .st0{font-size:4px} #t.st0{font:bold 3mm/1.2 "DejaVu Sans"}</style>'
+                    '<text class="st0" id="t">{{a}}</text><text class="st0">{{b}}</text><text>{{c}}</text>')
+    t, b, c = text.getparent().iterfind(f"{{{SVG_NS}}}text")
+    assert pipeline._font_size_user_units(t) == pytest.approx(3 * 96 / 25.4)
+    assert pipeline._inherited_svg_prop(t, "font-family") == '"DejaVu Sans"'
+    assert pipeline._font_size_user_units(b) == pytest.approx(4)
+    assert pipeline._font_size_user_units(c) == pytest.approx(20)
+
+
+def test_fit_never_grows_class_styled_text():
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 50" width="100mm" height="50mm">'
+           '<style>.st0{font-size:4px}</style><text class="st0" x="1" y="10">{{name}}</text></svg>')
+    fits = {"name": {"col": "name", "fit": "Shrink to fit", "box_w_mm": 80}}
+    out = pipeline.apply_mapping_to_svg(svg, fits, {"name": "Product name"})
+    assert "font-size:" not in out.split("</style>")[1]
+    narrow = {"name": {**fits["name"], "box_w_mm": 20}}
+    out = pipeline.apply_mapping_to_svg(svg, narrow, {"name": "Product name"})
+    size = float(out.split("font-size: ")[1].split("px")[0])
+    assert size < 4 and utils.text_width("Product name", None, size) <= 20 * 1.0001
+
+
+def test_unevaluable_style_rule_is_reported():
+    root, _ = _text('<style>g > .st0{font-size:4px}</style><text class="st0">{{a}}</text>')
+    problems = pipeline.text_fit_problems(etree.tostring(root).decode(),
+                                          {"a": {"fit": "Shrink to fit", "box_w_mm": 20}})
+    assert len(problems) == 1 and "selector" in problems[0]
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import loadtest
+
+APP = str(Path(__file__).resolve().parent.parent / "app.py")
+
+
+def _open_app(svg: bytes, csv: bytes) -> AppTest:
+    at = AppTest.from_file(APP, default_timeout=120)
+    at.run()
+    at.selectbox(key="login_user").set_value(loadtest.DEFAULT_USER[0])
+    at.text_input(key="login_pass").set_value(loadtest.DEFAULT_USER[1])
+    at.run()
+    loadtest._by_label(at.file_uploader, "SVG Template").set_value(("t.svg", svg, "image/svg+xml"))
+    loadtest._by_label(at.file_uploader, "CSV, XML").set_value(("d.csv", csv, "text/csv"))
+    at.run()
+    return at
+
+
+@pytest.mark.parametrize("placeholder", ["Brand", "Name", "EAN"])
+def test_tuning_a_placeholder_with_artwork_drawn_after_it(placeholder):
+    # the synthetic label draws three more placeholder texts after {{Brand}}, none after {{EAN}}
+    svg, csv = loadtest.synthetic_inputs(3)
+    at = _open_app(svg, csv)
+    at.selectbox(key="tune_ph").set_value(placeholder)
+    at.run()
+    assert not at.exception
+    assert not [e.value for e in at.error]
+    assert at.get("image")
+    # something is painted below every placeholder here, so tuning composites instead of rendering in full
+    assert at.session_state["_tune_base"][1] is not None
@@ -0,0 +1,181 @@
+# text_outline.py
+# Text-to-outline stage for print exports. Printers want text converted to paths; starting
+# one `inkscape` per file costs about a second each, so this keeps a few Inkscape 1.x
+# `--shell` processes alive and feeds them filled SVGs in batches.
+#
+# One shell command line per file (open, text-to-path, plain-SVG export, close). After a
+# batch the `inkscape-version` action is sent; its output line marks that every earlier
+# command has finished. A shell that dies or stalls is restarted; files it did not produce
+# come back as None so the caller can keep the un-outlined SVG and warn.
+
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+
+class InkscapeUnavailable(RuntimeError):
+    pass
+
+
+def find_inkscape() -> tuple:
+    """
+    (binary, version line) of an Inkscape 1.x install: INKSCAPE_BIN or `inkscape` on PATH.
+    Raises InkscapeUnavailable with a user-facing reason otherwise.
+    """
+    binary = os.environ.get("INKSCAPE_BIN") or shutil.which("inkscape")
+    if not binary:
+        raise InkscapeUnavailable("Inkscape is not installed (see install_inkscape.sh, or set INKSCAPE_BIN).")
+    try:
+        out = subprocess.run([binary, "--version"], capture_output=True, text=True, timeout=60).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise InkscapeUnavailable(f"Could not run {binary}: {e}")
+    m = re.search(r"Inkscape (\d+)\.(\d+)[^\n]*", out)
+    if not m:
+        raise InkscapeUnavailable(f"{binary} --version gave no Inkscape version.")
+    if int(m.group(1)) < 1:
+        raise InkscapeUnavailable(f"{m.group(0).strip()} found; the outline stage needs Inkscape 1.0 or newer.")
+    return binary, m.group(0).strip()
+
+
+class InkscapeShell:
+    """One long-lived `inkscape --shell` process."""
+
+    def __init__(self, binary: str, version_line: str, workdir: Path):
+        self.binary, self.workdir = binary, workdir
+        # "Inkscape 1.2.2 (b0a8486541, 2022-12-01)" -> the part the inkscape-version action repeats
+        self.marker = version_line.split(" (")[0]
+        self.proc = None
+        self._lines = None
+
+    def _start(self):
+        self.proc = subprocess.Popen([self.binary, "--shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, cwd=self.workdir, text=True, bufsize=1)
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self.proc.stdout, self._lines), daemon=True).start()
+
+    @staticmethod
+    def _read(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)
+
+    def run_batch(self, jobs: list, timeout: float) -> None:
+        """Outline each (in_path, out_path); returns once the shell has processed them all."""
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        # bare file names: the shell runs inside the work dir, so paths never need quoting
+        commands = "".join(f"file-open:{src.name};export-text-to-path;export-plain-svg;export-overwrite;"
+                           f"export-filename:{dst.name};export-do;file-close\n" for src, dst in jobs)
+        try:
+            self.proc.stdin.write(commands + "inkscape-version\n")
+            self.proc.stdin.flush()
+        except OSError:
+            self.close()
+            raise RuntimeError("Inkscape shell exited")
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.close()
+                raise TimeoutError(f"Inkscape shell did not finish {len(jobs)} file(s) in {timeout:.0f} s")
+            if line is None:
+                self.close()
+                raise RuntimeError("Inkscape shell exited")
+            if self.marker in line:
+                return
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
+
+
+class OutlinePool:
+    """
+    A few persistent Inkscape shells. outline_many() splits the SVGs across the shells in
+    batches and returns the outlined SVG texts in order (None where a file failed).
+    Raises InkscapeUnavailable on construction when Inkscape cannot be used.
+    """
+
+    def __init__(self, processes: Optional[int] = None, batch_size: int = 16, seconds_per_file: float = 30.0):
+        binary, self.version = find_inkscape()
+        self.processes = max(1, processes or min(2, os.cpu_count() or 1))
+        self.batch_size = max(1, batch_size)
+        self.seconds_per_file = seconds_per_file
+        self.tmp = Path(tempfile.mkdtemp(prefix="outline_"))
+        self._shells = queue.Queue()
+        for _ in range(self.processes):
+            self._shells.put(InkscapeShell(binary, self.version, self.tmp))
+        self._pool = ThreadPoolExecutor(max_workers=self.processes, thread_name_prefix="inkscape")
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.stats = {"files": 0, "failed": 0, "batches": 0, "seconds": 0.0}
+
+    def _run_chunk(self, svgs: list) -> list:
+        with self._lock:
+            base = self._seq
+            self._seq += len(svgs)
+        jobs = []
+        for i, svg in enumerate(svgs):
+            src, dst = self.tmp / f"in_{base + i:08d}.svg", self.tmp / f"out_{base + i:08d}.svg"
+            src.write_text(svg, encoding="utf-8")
+            dst.unlink(missing_ok=True)
+            jobs.append((src, dst))
+        shell = self._shells.get()
+        try:
+            shell.run_batch(jobs, timeout=30 + self.seconds_per_file * len(jobs))
+        except (RuntimeError, TimeoutError):
+            pass  # whatever was written before the failure is still picked up below
+        finally:
+            self._shells.put(shell)
+        out = []
+        for src, dst in jobs:
+            try:
+                out.append(dst.read_text(encoding="utf-8") if dst.stat().st_size else None)
+            except OSError:
+                out.append(None)
+            src.unlink(missing_ok=True)
+            dst.unlink(missing_ok=True)
+        return out
+
+    def outline_many(self, svgs: list) -> list:
+        if not svgs:
+            return []
+        t0 = time.perf_counter()
+        chunk = min(self.batch_size, -(-len(svgs) // self.processes))
+        chunks = [svgs[i:i + chunk] for i in range(0, len(svgs), chunk)]
+        results = [svg for part in self._pool.map(self._run_chunk, chunks) for svg in part]
+        self.stats["files"] += len(svgs)
+        self.stats["failed"] += sum(1 for r in results if r is None)
+        self.stats["batches"] += len(chunks)
+        self.stats["seconds"] += time.perf_counter() - t0
+        return results
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        while not self._shells.empty():
+            self._shells.get().close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,13 +2,36 @@
 # Adds robust EAN-13 support: checksum calculation, normalization, PNG bytes and SVG text
 # Backwards-compatible: keeps existing render_label_image + render_barcode_image behavior
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageFont
 import barcode
 from barcode.writer import ImageWriter, SVGWriter
 import io
-from typing import Optional
+import os
+import gc
+import time
+import contextlib
+import hashlib
+import struct
+import zlib
+import zipfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from pathlib import Path
+from typing import Iterable, Optional
 import base64
 
+import numpy as np
+
+try:
+    import resource  # POSIX only
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
 DPI_DEFAULT = 300
 
 def mm_to_px(mm: float, dpi: int = DPI_DEFAULT) -> int:
@@ -49,6 +72,65 @@ def normalize_to_ean13(value: str) -> Optional[str]:
         return s if chk == s[-1] else s[:12] + chk
     return None
 
+EAN13_WEIGHTS = np.array([1, 3] * 6, dtype=np.int64)
+
+
+def _ean_cell_to_str(value) -> str:
+    # spreadsheets hand EANs over as floats ("5901234123457.0"); keep the integer digits only
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value != value:  # NaN
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def validate_ean13_column(values) -> tuple:
+    """
+    Vectorised normalize_to_ean13 over a whole column.
+
+    Builds an (n, 13) digit matrix with NumPy and computes every checksum at once.
+    Returns (canonical, status): canonical is a list of 13-digit strings (None where
+    the row is missing/invalid); status is a list with one of
+    "ok", "corrected", "missing", "invalid" per row.
+    """
+    strs = [_ean_cell_to_str(v).strip() for v in values]
+    n = len(strs)
+    if n == 0:
+        return [], []
+    raw = np.array([s.encode("ascii", errors="replace") for s in strs], dtype=bytes)
+    width = max(1, raw.dtype.itemsize)
+    chars = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(n, width)
+    is_digit = (chars >= 48) & (chars <= 57)
+    ndigits = is_digit.sum(axis=1)
+
+    # stable sort pulls each row's digits to the front, keeping their order
+    order = np.argsort(~is_digit, axis=1, kind="stable")
+    packed = np.take_along_axis(chars, order, axis=1)
+    if width < 13:
+        packed = np.pad(packed, ((0, 0), (0, 13 - width)), constant_values=48)
+    digits = packed[:, :13].astype(np.int64) - 48
+    digits[np.arange(13)[None, :] >= ndigits[:, None]] = 0
+
+    check = (10 - (digits[:, :12] @ EAN13_WEIGHTS) % 10) % 10
+    len12 = ndigits == 12
+    len13 = ndigits == 13
+    valid = len12 | len13
+    digits[valid, 12] = check[valid]
+
+    empty = np.array([s == "" for s in strs], dtype=bool)
+    status = np.full(n, "invalid", dtype=object)
+    status[empty] = "missing"
+    status[len12 | (len13 & (packed[:, 12].astype(np.int64) - 48 != check))] = "corrected"
+    status[len13 & (packed[:, 12].astype(np.int64) - 48 == check)] = "ok"
+
+    canon = (digits + 48).astype(np.uint8)
+    canon_bytes = np.ascontiguousarray(canon).view("S13").ravel()
+    canonical = [c.decode("ascii") if ok else None for c, ok in zip(canon_bytes, valid)]
+    return canonical, status.tolist()
+
 # ---------------- Barcode rendering ----------------
 def render_barcode_image(ean: str, height_mm: float, dpi: int = DPI_DEFAULT) -> Image.Image:
     """
@@ -122,56 +204,885 @@ def png_bytes_to_data_uri(png_bytes: bytes) -> str:
 
 # ---------------- Label renderer (keeps previous behaviour) ----------------
 
-def render_label_image(brand: str, name: str, price: str, ean: str,
+# Fonts, glyph masks and barcode column layouts are cached per process: batch renders reuse
+# them across records and threads. Whole barcode bitmaps are not, since EANs rarely repeat.
+FALLBACK_FONTS = ("arial.ttf", "DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+
+@functools.lru_cache(maxsize=128)
+def load_font(font_path: Optional[str], size: int):
+    """TrueType font at `size` px; falls back to Arial / DejaVu / Pillow's default font."""
+    size = max(1, int(size))
+    for candidate in ((font_path,) if font_path else ()) + FALLBACK_FONTS:
+        try:
+            return ImageFont.truetype(candidate, size=size)
+        except Exception:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow without FreeType
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=8192)
+def _glyph(font_path: Optional[str], size: int, ch: str):
+    """(coverage 0..1, x offset, y offset, advance) of one glyph; rasterised once per font, size and character."""
+    font = load_font(font_path, size)
+    if hasattr(font, "getmask2"):
+        core, (ox, oy) = font.getmask2(ch, mode="L")
+    else:  # Pillow's bitmap fallback font
+        core, (ox, oy) = font.getmask(ch), (0, 0)
+    w, h = core.size
+    mask = np.asarray(core, dtype=np.uint8).reshape(h, w).astype(np.float32) / 255.0
+    mask.flags.writeable = False
+    return mask, ox, oy, font.getlength(ch)
+
+
+def text_length_array(text: str, font_path: Optional[str], size: int) -> float:
+    return sum(_glyph(font_path, size, ch)[3] for ch in text)
+
+
+def draw_text_array(arr: np.ndarray, xy: tuple, text: str, font_path: Optional[str], size: int, color) -> float:
+    """
+    Composite `text` into a uint8 (H, W) or (H, W, C) array in place, top-left at xy (same
+    anchor as ImageDraw.text), from cached glyph masks. Returns the x after the last glyph.
+    """
+    x, y = xy
+    height, width = arr.shape[:2]
+    color = np.asarray(color, dtype=np.float32)
+    for ch in text:
+        mask, ox, oy, advance = _glyph(font_path, size, ch)
+        gx, gy = int(round(x)) + ox, int(round(y)) + oy
+        x0, y0 = max(gx, 0), max(gy, 0)
+        x1, y1 = min(gx + mask.shape[1], width), min(gy + mask.shape[0], height)
+        if x0 < x1 and y0 < y1:
+            m = mask[y0 - gy:y1 - gy, x0 - gx:x1 - gx]
+            if arr.ndim == 3:
+                m = m[:, :, None]
+            region = arr[y0:y1, x0:x1]
+            region[...] = (region * (1.0 - m) + color * m + 0.5).astype(np.uint8)
+        x += advance
+    return x
+
+
+_EAN13_QUIET_MODULES = 9
+_EAN13_GUARDS = (0, 1, 2, 45, 46, 47, 48, 49, 92, 93, 94)
+# 95 modules plus quiet zones: below one pixel per module some bars would be dropped
+EAN13_MIN_WIDTH_PX = 95 + 2 * _EAN13_QUIET_MODULES
+
+
+@functools.lru_cache(maxsize=64)
+def _ean13_columns(width_px: int):
+    """(module index, long guard bar) per pixel column; shared by every symbol of this width."""
+    n_modules = 95 + 2 * _EAN13_QUIET_MODULES
+    col_module = np.arange(width_px) * n_modules // width_px
+    guards = np.zeros(n_modules, dtype=bool)
+    guards[[_EAN13_QUIET_MODULES + g for g in _EAN13_GUARDS]] = True
+    col_guard = guards[col_module]
+    col_module.flags.writeable = col_guard.flags.writeable = False
+    return col_module, col_guard
+
+
+def ean13_bars_array(canonical: str, width_px: int, height_px: int, font_path: Optional[str] = None) -> np.ndarray:
+    """
+    Grayscale (uint8, 0 = ink) EAN-13 symbol of width_px×height_px drawn straight from the
+    module pattern, with longer guard bars and the human-readable digits underneath.
+    Raises ValueError below EAN13_MIN_WIDTH_PX. Not cached (every record has its own code);
+    the column mapping and the digit glyphs are.
+    """
+    if width_px < EAN13_MIN_WIDTH_PX:
+        raise ValueError(f"EAN-13 needs at least {EAN13_MIN_WIDTH_PX} px width (one per module), got {width_px}")
+    pattern = barcode.get_barcode_class('ean13')(canonical).build()[0]
+    quiet = _EAN13_QUIET_MODULES
+    modules = np.zeros(len(pattern) + 2 * quiet, dtype=bool)
+    modules[quiet:quiet + len(pattern)] = np.frombuffer(pattern.encode("ascii"), dtype=np.uint8) == ord("1")
+    col_module, col_guard = _ean13_columns(width_px)
+    ink = modules[col_module]
+
+    text_h = max(1, int(height_px * 0.18))
+    bar_h = height_px - text_h
+    arr = np.full((height_px, width_px), 255, dtype=np.uint8)
+    arr[:bar_h, ink] = 0
+    arr[bar_h:bar_h + text_h // 2, ink & col_guard] = 0
+
+    size = max(1, int(text_h * 0.9))
+    mod_px = width_px / len(modules)
+    y = bar_h + max(0, (text_h - size) // 2)
+    draw_text_array(arr, (mod_px * 1, y), canonical[0], font_path, size, 0)
+    for group, start_module in ((canonical[1:7], quiet + 3), (canonical[7:], quiet + 50)):
+        gx0 = start_module * mod_px
+        gw = 42 * mod_px
+        tw = text_length_array(group, font_path, size)
+        draw_text_array(arr, (gx0 + (gw - tw) / 2, y), group, font_path, size, 0)
+    return arr
+
+
+def render_label_array(brand: str, name: str, price: str, ean: str,
                        width_mm: float = 80.0, height_mm: float = 50.0,
-                       dpi: int = DPI_DEFAULT, font_path: Optional[str] = None) -> Image.Image:
+                       dpi: int = DPI_DEFAULT, font_path: Optional[str] = None) -> np.ndarray:
+    """
+    Label as an RGB uint8 array (H, W, 3); same layout as render_label_image. The barcode
+    is widened to EAN13_MIN_WIDTH_PX when its usual share of the label is narrower;
+    raises ValueError when the label itself is too narrow for a scannable EAN-13.
+    """
     w = mm_to_px(width_mm, dpi)
     h = mm_to_px(height_mm, dpi)
-    bg_color = (255, 255, 255, 255)
-    label = Image.new("RGBA", (w, h), bg_color)
-    draw = ImageDraw.Draw(label)
-
-    # Fonts (fallback to default PIL font if custom not provided)
-    try:
-        if font_path:
-            font_bold = ImageFont.truetype(font_path, size=int(h*0.13))
-            font_regular = ImageFont.truetype(font_path, size=int(h*0.10))
-        else:
-            font_bold = ImageFont.truetype("arial.ttf", size=int(h*0.13))
-            font_regular = ImageFont.truetype("arial.ttf", size=int(h*0.10))
-    except Exception:
-        font_bold = ImageFont.load_default()
-        font_regular = ImageFont.load_default()
+    arr = np.full((h, w, 3), 255, dtype=np.uint8)
+    bold_size, regular_size = max(1, int(h * 0.13)), max(1, int(h * 0.10))
 
     # Layout: simple left text, right barcode
     padding = int(w * 0.04)
-    # Draw brand and name
     y = padding
-    draw.text((padding, y), brand.upper(), font=font_bold, fill=(30,30,30))
+    draw_text_array(arr, (padding, y), str(brand).upper(), font_path, bold_size, (30, 30, 30))
     y += int(h * 0.16)
-    draw.text((padding, y), name, font=font_regular, fill=(60,60,60))
+    draw_text_array(arr, (padding, y), str(name), font_path, regular_size, (60, 60, 60))
     # Price at bottom-left
     ptext = f"{price}"
-    psize = draw.textsize(ptext, font=font_bold)
-    draw.text((padding, h - padding - psize[1]), ptext, font=font_bold, fill=(0,0,0))
+    bottom = load_font(font_path, bold_size).getbbox(ptext)[3]
+    draw_text_array(arr, (padding, h - padding - bottom), ptext, font_path, bold_size, (0, 0, 0))
+
+    canonical = normalize_to_ean13(ean)
+    bc_w = max(int(w * 0.48), EAN13_MIN_WIDTH_PX)
+    bc_h = min(mm_to_px(height_mm * 0.45, dpi), h - 2 * padding)
+    if canonical is not None and bc_w > w - 2 * padding:
+        raise ValueError(f"a {width_mm:g} mm label at {dpi} DPI is {w} px wide; a scannable EAN-13 needs "
+                         f"{EAN13_MIN_WIDTH_PX} px plus padding. Raise the DPI or the label width.")
+    if canonical is None or bc_h < 1:
+        # If barcode generation fails, draw placeholder box
+        x0, y0, x1, y1 = w - int(w * 0.48) - padding, h - int(h * 0.35) - padding, w - padding, h - padding
+        arr[y0:y1 + 1, [x0, x1]] = 0
+        arr[[y0, y1], x0:x1 + 1] = 0
+        return arr
+
+    bars = ean13_bars_array(canonical, bc_w, bc_h, font_path)
+    bc_x = w - bc_w - padding
+    bc_y = h - bc_h - padding
+    arr[bc_y:bc_y + bc_h, bc_x:bc_x + bc_w] = bars[:, :, None]
+    return arr
+
+
+def render_label_image(brand: str, name: str, price: str, ean: str,
+                       width_mm: float = 80.0, height_mm: float = 50.0,
+                       dpi: int = DPI_DEFAULT, font_path: Optional[str] = None) -> Image.Image:
+    arr = render_label_array(brand, name, price, ean, width_mm=width_mm, height_mm=height_mm,
+                             dpi=dpi, font_path=font_path)
+    return Image.fromarray(arr, "RGB").convert("RGBA")
 
-    # Render barcode and paste on right side
+
+# ---------------- Text metrics / auto-fit ----------------
+
+# Advance widths are measured once per glyph per font face at a reference size and scaled
+# linearly, so fitting text for 50k rows never renders anything.
+METRICS_REF_SIZE = 1000
+_GLYPH_ADVANCES: dict = {}
+
+
+@functools.lru_cache(maxsize=256)
+def resolve_font_path(family: Optional[str], bold: bool = False) -> Optional[str]:
+    """Font file for a CSS font-family via fontconfig (fc-match); None lets load_font fall back."""
+    if not family or not shutil.which("fc-match"):
+        return None
+    pattern = family + (":bold" if bold else "")
     try:
-        bc_img = render_barcode_image(ean, height_mm * 0.45, dpi=dpi)
-        # resize barcode so it fits approximately right half
-        max_bc_w = int(w * 0.48)
-        scale = min(1.0, max_bc_w / bc_img.width)
-        bc_w = int(bc_img.width * scale)
-        bc_h = int(bc_img.height * scale)
-        bc_img = bc_img.resize((bc_w, bc_h), resample=Image.LANCZOS)
-        bc_x = w - bc_w - padding
-        bc_y = h - bc_h - padding
-        label.paste(bc_img, (bc_x, bc_y), bc_img)
+        out = subprocess.run(["fc-match", "-f", "%{file}", pattern], capture_output=True, text=True, timeout=5)
+        path = out.stdout.strip()
+        return path if out.returncode == 0 and path and os.path.exists(path) else None
     except Exception:
-        # If barcode generation fails, draw placeholder box
-        draw.rectangle([w - int(w*0.48) - padding, h - int(h*0.35) - padding, w - padding, h - padding], outline=(0,0,0))
+        return None
+
+
+def text_width(text: str, font_path: Optional[str], size: float) -> float:
+    """Width of `text` at font `size` from cached per-glyph advances (kerning ignored)."""
+    advances = _GLYPH_ADVANCES.setdefault(font_path, {})
+    font = None
+    total = 0.0
+    for ch in text:
+        adv = advances.get(ch)
+        if adv is None:
+            if font is None:
+                font = load_font(font_path, METRICS_REF_SIZE)
+            adv = advances[ch] = float(font.getlength(ch))
+        total += adv
+    return total * float(size) / METRICS_REF_SIZE
+
+
+def _wrap_words(paragraphs: list, font_path: Optional[str], size: float, max_w: float) -> list:
+    lines = []
+    space = text_width(" ", font_path, size)
+    for para in paragraphs:
+        words = para.split()
+        if not words:
+            lines.append("")
+            continue
+        cur, cur_w = words[0], text_width(words[0], font_path, size)
+        for word in words[1:]:
+            w = text_width(word, font_path, size)
+            if cur_w + space + w <= max_w:
+                cur, cur_w = f"{cur} {word}", cur_w + space + w
+            else:
+                lines.append(cur)
+                cur, cur_w = word, w
+        lines.append(cur)
+    return lines
+
+
+def fit_text_lines(lines: list, font_path: Optional[str], size: float, box_w: float,
+                   box_h: Optional[float] = None, wrap: bool = False, line_height: float = 1.0,
+                   min_ratio: float = 0.2) -> tuple:
+    """
+    Fit text into a box (same units as `size`). Returns (lines, font_size).
+    Shrink: keep the lines, lower the size until the widest line and the line stack fit.
+    Wrap: word-wrap to box_w; if a box height is given, binary-search the largest size
+    (down to min_ratio × size) whose wrapped lines fit. Never grows the text.
+    """
+    lines = [str(l) for l in lines] or [""]
+    if box_w <= 0:
+        return lines, size
+
+    def _fits(ls, sz):
+        widest = max(text_width(l, font_path, sz) for l in ls)
+        return widest <= box_w * 1.0001 and (not box_h or len(ls) * sz * line_height <= box_h * 1.0001)
+
+    if not wrap:
+        widest_unit = max(text_width(l, font_path, 1.0) for l in lines)
+        new = size
+        if widest_unit > 0:
+            new = min(new, box_w / widest_unit)
+        if box_h:
+            new = min(new, box_h / (len(lines) * line_height))
+        return lines, max(new, size * min_ratio)
+
+    wrapped = _wrap_words(lines, font_path, size, box_w)
+    if _fits(wrapped, size):
+        return wrapped, size
+    lo, hi = size * min_ratio, size
+    best = (_wrap_words(lines, font_path, lo, box_w), lo)
+    for _ in range(12):
+        mid = (lo + hi) / 2.0
+        cand = _wrap_words(lines, font_path, mid, box_w)
+        if _fits(cand, mid):
+            best, lo = (cand, mid), mid
+        else:
+            hi = mid
+    return best
+
+
+# ---------------- Batch label rasteriser ----------------
+
+LABEL_FIELDS_DEFAULT = {"brand": "brand", "name": "name", "price": "price", "ean": "ean"}
+
+
+def _cell_text(value) -> str:
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value)
+
+
+def iter_label_arrays(records, fields: Optional[dict] = None, workers: Optional[int] = None,
+                      chunk: int = 64, transform=None, **label_kwargs) -> Iterable[np.ndarray]:
+    """
+    Render labels for a DataFrame or an iterable of dicts on a thread pool, yielding
+    RGB arrays in record order. `fields` maps label slots (brand/name/price/ean) to
+    record keys; label_kwargs go to render_label_array (width_mm, height_mm, dpi, font_path).
+    Records are submitted `chunk` at a time so memory stays bounded for long inputs.
+    `transform` (e.g. PNG encoding) runs on the worker thread on each array before it is yielded.
+    """
+    fields = {**LABEL_FIELDS_DEFAULT, **(fields or {})}
+    if hasattr(records, "to_dict") and hasattr(records, "columns"):
+        records = (row for row in records.to_dict("records"))
+    if "ean" in label_kwargs:
+        raise TypeError("ean comes from the records; map it with fields={'ean': <column>}")
+
+    def _one(rec):
+        arr = render_label_array(_cell_text(rec.get(fields["brand"])), _cell_text(rec.get(fields["name"])),
+                                 _cell_text(rec.get(fields["price"])), _ean_cell_to_str(rec.get(fields["ean"])),
+                                 **label_kwargs)
+        return transform(arr) if transform is not None else arr
+
+    with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 2))) as pool:
+        batch = []
+        for rec in records:
+            batch.append(rec)
+            if len(batch) >= chunk:
+                yield from pool.map(_one, batch)
+                batch = []
+        if batch:
+            yield from pool.map(_one, batch)
+
+
+def compose_label_sheets(label_arrays: Iterable[np.ndarray], cols: int, rows: int,
+                         gap_px: int = 0, margin_px: int = 0) -> Iterable[np.ndarray]:
+    """Step-and-repeat equally sized label arrays onto white RGB sheets (row-major), yielding each sheet."""
+    per_sheet = max(1, cols * rows)
+    sheet = None
+    n = 0
+    for arr in label_arrays:
+        if sheet is None:
+            lh, lw = arr.shape[:2]
+            sheet = np.full((2 * margin_px + rows * lh + (rows - 1) * gap_px,
+                             2 * margin_px + cols * lw + (cols - 1) * gap_px, 3), 255, dtype=np.uint8)
+        r, c = divmod(n, cols)
+        y = margin_px + r * (lh + gap_px)
+        x = margin_px + c * (lw + gap_px)
+        sheet[y:y + lh, x:x + lw] = arr[:lh, :lw, :3]
+        n += 1
+        if n == per_sheet:
+            yield sheet
+            sheet, n = None, 0
+    if sheet is not None:
+        yield sheet
+
+
+def composite_rgba(base: np.ndarray, patch: np.ndarray, x: int, y: int) -> np.ndarray:
+    """Alpha-composite an RGBA `patch` over a copy of RGBA `base` with its top-left at (x, y), clipped to base."""
+    out = base.copy()
+    h = min(patch.shape[0], base.shape[0] - y)
+    w = min(patch.shape[1], base.shape[1] - x)
+    if h <= 0 or w <= 0:
+        return out
+    src = patch[:h, :w].astype(np.float32) / 255.0
+    dst = out[y:y + h, x:x + w].astype(np.float32) / 255.0
+    sa, da = src[..., 3:4], dst[..., 3:4]
+    oa = sa + da * (1.0 - sa)
+    rgb = (src[..., :3] * sa + dst[..., :3] * da * (1.0 - sa)) / np.maximum(oa, 1e-6)
+    out[y:y + h, x:x + w] = np.clip(np.concatenate([rgb, oa], axis=-1) * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    return out
+
+
+def label_array_to_png(arr: np.ndarray, dpi: int = DPI_DEFAULT) -> bytes:
+    out = io.BytesIO()
+    # flat label artwork: zlib level 1 is ~2x faster than the default and only slightly larger
+    Image.fromarray(arr).save(out, format="PNG", dpi=(dpi, dpi), compress_level=1)
+    return out.getvalue()
+
+
+def render_labels_batch(records, output: str = "png", fields: Optional[dict] = None,
+                        sheet_grid: tuple = (3, 8), gap_px: int = 0, margin_px: int = 0,
+                        workers: Optional[int] = None, **label_kwargs) -> list:
+    """
+    Batch label raster API. Returns [(filename, png_bytes)]:
+    output="png" -> one label_00001.png per record; output="sheets" -> sheet_001.png
+    with sheet_grid=(cols, rows) labels each.
+    """
+    dpi = label_kwargs.get("dpi", DPI_DEFAULT)
+    if output == "png":
+        pngs = iter_label_arrays(records, fields=fields, workers=workers,
+                                 transform=lambda a: label_array_to_png(a, dpi), **label_kwargs)
+        return [(f"label_{i:05d}.png", png) for i, png in enumerate(pngs, start=1)]
+    if output == "sheets":
+        cols, rows = sheet_grid
+        labels = iter_label_arrays(records, fields=fields, workers=workers, **label_kwargs)
+        return [(f"sheet_{i:03d}.png", label_array_to_png(sh, dpi))
+                for i, sh in enumerate(compose_label_sheets(labels, cols, rows, gap_px, margin_px), start=1)]
+    raise ValueError(f"unknown output: {output}")
+
+
+# ---------------- Streaming raster writers ----------------
+# Used by the tiled high-DPI export: pixels arrive band by band (PNG) or tile by tile (TIFF)
+# and are compressed straight to the output file, so no full-size image is ever held.
+
+class StreamingPNGWriter:
+    """Row-streaming PNG encoder (8-bit RGB/RGBA). Feed rows top to bottom with write_rows()."""
+
+    def __init__(self, fh, width: int, height: int, channels: int = 3, dpi: Optional[float] = None, level: int = 6):
+        self.fh, self.width, self.height, self.channels = fh, int(width), int(height), int(channels)
+        self.rows_written = 0
+        self._z = zlib.compressobj(level)
+        fh.write(b"\x89PNG\r\n\x1a\n")
+        color_type = 6 if channels == 4 else 2
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, color_type, 0, 0, 0))
+        if dpi:
+            ppm = int(round(dpi / 0.0254))
+            self._chunk(b"pHYs", struct.pack(">IIB", ppm, ppm, 1))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.fh.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def write_rows(self, rows: np.ndarray):
+        n = rows.shape[0]
+        raw = np.zeros((n, 1 + self.width * self.channels), dtype=np.uint8)  # filter byte 0 (None) per row
+        raw[:, 1:] = rows[:, :self.width, :self.channels].reshape(n, -1)
+        data = self._z.compress(raw.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows_written += n
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG expects {self.height} rows, got {self.rows_written}")
+        self._chunk(b"IDAT", self._z.flush())
+        self._chunk(b"IEND", b"")
+
+
+class TiledTIFFWriter:
+    """
+    Tiled, deflate-compressed 8-bit RGB/RGBA TIFF. Tiles may be written in any order;
+    the IFD goes at the end. Switches to BigTIFF when the image could pass 4 GB.
+    """
+
+    def __init__(self, fh, width: int, height: int, tile: int = 512, channels: int = 3,
+                 dpi: Optional[float] = None, bigtiff: Optional[bool] = None, level: int = 6):
+        if tile % 16:
+            raise ValueError("TIFF tile size must be a multiple of 16")
+        self.fh, self.width, self.height, self.tile, self.channels = fh, int(width), int(height), int(tile), int(channels)
+        self.dpi, self.level = dpi, level
+        self.across = -(-self.width // self.tile)
+        self.down = -(-self.height // self.tile)
+        self.offsets = [0] * (self.across * self.down)
+        self.counts = [0] * (self.across * self.down)
+        self.big = bigtiff if bigtiff is not None else self.width * self.height * self.channels > 2**32 - 2**28
+        if self.big:
+            fh.write(b"II+\x00" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            fh.write(b"II*\x00" + struct.pack("<I", 0))
+
+    def write_tile(self, row: int, col: int, arr: np.ndarray):
+        """Write the tile at grid position (row, col); edge tiles are padded to full tile size."""
+        t = self.tile
+        if arr.shape[0] != t or arr.shape[1] != t:
+            padded = np.zeros((t, t, self.channels), dtype=np.uint8)
+            padded[:arr.shape[0], :arr.shape[1]] = arr[:, :, :self.channels]
+            arr = padded
+        data = zlib.compress(np.ascontiguousarray(arr[:, :, :self.channels]).tobytes(), self.level)
+        idx = row * self.across + col
+        self.offsets[idx] = self.fh.tell()
+        self.counts[idx] = len(data)
+        self.fh.write(data)
+
+    def close(self):
+        SHORT, LONG, RATIONAL, LONG8 = 3, 4, 5, 16
+        off_type = LONG8 if self.big else LONG
+        res = int(round(self.dpi or 72))
+        entries = [
+            (256, LONG, [self.width]), (257, LONG, [self.height]),
+            (258, SHORT, [8] * self.channels), (259, SHORT, [8]),  # Adobe deflate
+            (262, SHORT, [2]), (277, SHORT, [self.channels]),
+            (282, RATIONAL, [(res, 1)]), (283, RATIONAL, [(res, 1)]),
+            (284, SHORT, [1]), (296, SHORT, [2]),
+            (322, LONG, [self.tile]), (323, LONG, [self.tile]),
+            (324, off_type, self.offsets), (325, off_type, self.counts),
+        ]
+        if self.channels == 4:
+            entries.append((338, SHORT, [2]))  # unassociated alpha
+        fmt = {SHORT: "H", LONG: "I", LONG8: "Q"}
+        inline = 8 if self.big else 4
+
+        if self.fh.tell() % 2:
+            self.fh.write(b"\x00")
+        ifd_at = self.fh.tell()
+        ifd_len = (8 + 20 * len(entries) + 8) if self.big else (2 + 12 * len(entries) + 4)
+        extra_at = ifd_at + ifd_len
+        ifd = [struct.pack("<Q", len(entries)) if self.big else struct.pack("<H", len(entries))]
+        extra = []
+        for tag, typ, values in entries:
+            if typ == RATIONAL:
+                payload = b"".join(struct.pack("<II", n, d) for n, d in values)
+            else:
+                payload = struct.pack("<%d%s" % (len(values), fmt[typ]), *values)
+            if len(payload) <= inline:
+                value_field = payload.ljust(inline, b"\x00")
+            else:
+                value_field = struct.pack("<Q" if self.big else "<I", extra_at + sum(len(e) for e in extra))
+                extra.append(payload + (b"\x00" if len(payload) % 2 else b""))
+            ifd.append(struct.pack("<HHQ" if self.big else "<HHI", tag, typ, len(values)) + value_field)
+        ifd.append(struct.pack("<Q" if self.big else "<I", 0))
+        self.fh.write(b"".join(ifd) + b"".join(extra))
+        end = self.fh.tell()
+        self.fh.seek(8 if self.big else 4)
+        self.fh.write(struct.pack("<Q" if self.big else "<I", ifd_at))
+        self.fh.seek(end)
+
+
+# ---------------- Export memory governor ----------------
+
+def current_rss_bytes() -> int:
+    """
+    Resident set size of this process in bytes.
+    Reads /proc/self/statm on Linux; falls back to the getrusage peak elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        if resource is None:
+            return 0
+        # ru_maxrss is KiB on Linux (bytes on macOS, close enough for a budget check)
+        return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised when an export cannot stay inside its configured memory budget."""
+
+
+# RSS and tracemalloc are process-wide while governors are per export (one per Streamlit
+# session), so running governors are counted here: tracemalloc is started by the first one
+# that needs it and stopped by the last, and RSS only fails an export when it runs alone.
+_GOVERNOR_LOCK = threading.Lock()
+_GOVERNORS = {"active": 0, "tracing": 0, "own_tracemalloc": False}
+
+
+class ExportMemoryGovernor:
+    """
+    Keeps an export inside a memory budget (MB of process RSS).
+
+    The export loop calls hold() for every output it produces and checkpoint()
+    every `batch_size` records. When RSS gets close to the budget the governor
+    spills held outputs to a temp directory, halves the batch size and collects
+    garbage; if RSS is still over budget after that it raises MemoryBudgetExceeded.
+    While other exports run in the same process their memory cannot be told apart,
+    so the governor then still spills and shrinks batches but does not fail.
+    A budget of 0 disables enforcement but still records peak memory.
+    """
+
+    def __init__(self, budget_mb: float = 0.0, soft_ratio: float = 0.8,
+                 min_batch: int = 1, max_batch: int = 64):
+        self.budget_bytes = int(float(budget_mb or 0) * 1024 * 1024)
+        self.soft_ratio = soft_ratio
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_size = max_batch if not self.budget_bytes else max(min_batch, max_batch // 4)
+        self.spilling = False
+        self.spill_dir: Optional[Path] = None
+        self.spilled_files = 0
+        self.spilled_bytes = 0
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.peak_concurrent = 0
+        self._spill_seq = 0
+        self._registered = False
+        self._tracing = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def start(self):
+        with _GOVERNOR_LOCK:
+            if not self._registered:
+                self._registered = True
+                _GOVERNORS["active"] += 1
+                if self.enabled:
+                    self._tracing = True
+                    _GOVERNORS["tracing"] += 1
+                    if _GOVERNORS["tracing"] == 1 and not tracemalloc.is_tracing():
+                        tracemalloc.start()
+                        _GOVERNORS["own_tracemalloc"] = True
+        rss = self.sample()
+        if self.enabled and self._alone() and rss > self.budget_bytes:
+            raise MemoryBudgetExceeded(
+                f"process already uses {rss / 2**20:.0f} MB before export started; "
+                f"budget is {self.budget_bytes / 2**20:.0f} MB"
+            )
+        return self
+
+    @staticmethod
+    def _alone() -> bool:
+        return _GOVERNORS["active"] <= 1
+
+    def sample(self) -> int:
+        rss = current_rss_bytes()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_concurrent = max(self.peak_concurrent, _GOVERNORS["active"])
+        if tracemalloc.is_tracing():
+            _, traced_peak = tracemalloc.get_traced_memory()
+            self.peak_traced = max(self.peak_traced, traced_peak)
+        return rss
+
+    def spill_path(self, name: str) -> Path:
+        """Fresh path inside the spill directory (created on first use)."""
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="export_spill_"))
+        path = self.spill_dir / f"{self._spill_seq:06d}_{name}"
+        self._spill_seq += 1
+        return path
+
+    def hold(self, name: str, data):
+        """Return a (name, payload) entry; payload is a spilled Path once spilling has started."""
+        if not self.spilling or isinstance(data, Path):
+            return (name, data)
+        path = self.spill_path(name)
+        path.write_bytes(data)
+        # only outputs moved out of memory count as spilled, not files written to disk by design
+        self.spilled_files += 1
+        self.spilled_bytes += len(data)
+        return (name, path)
+
+    def spill(self, *collections: list):
+        """Move every in-memory payload of the given (name, payload) lists to disk, in place."""
+        self.spilling = True
+        for coll in collections:
+            for i, (name, data) in enumerate(coll):
+                if not isinstance(data, Path):
+                    coll[i] = self.hold(name, data)
+        gc.collect()
+
+    def checkpoint(self, *collections: list, where: str = ""):
+        """Sample memory and adapt: shrink batch and spill when close, fail when over."""
+        rss = self.sample()
+        if not self.enabled:
+            return
+        if rss >= self.budget_bytes * self.soft_ratio:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            self.spill(*collections)
+            rss = self.sample()
+            if rss > self.budget_bytes and self._alone():
+                raise MemoryBudgetExceeded(
+                    f"{rss / 2**20:.0f} MB in use{(' ' + where) if where else ''} after spilling "
+                    f"{self.spilled_files} file(s) to disk; budget is {self.budget_bytes / 2**20:.0f} MB. "
+                    "Raise the budget or export fewer rows / fewer formats per run."
+                )
+        elif rss < self.budget_bytes * self.soft_ratio * 0.5:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
+
+    def summary(self) -> dict:
+        return {
+            "peak_rss_mb": round(self.peak_rss / 2**20, 1),
+            "peak_traced_mb": round(self.peak_traced / 2**20, 1) if self.peak_traced else None,
+            "budget_mb": round(self.budget_bytes / 2**20, 1) if self.enabled else None,
+            "spilled_files": self.spilled_files,
+            "spilled_mb": round(self.spilled_bytes / 2**20, 1),
+            "batch_size": self.batch_size,
+            "concurrent_exports": self.peak_concurrent,
+        }
+
+    def close(self):
+        with _GOVERNOR_LOCK:
+            if self._registered:
+                self._registered = False
+                _GOVERNORS["active"] -= 1
+            if self._tracing:
+                self._tracing = False
+                _GOVERNORS["tracing"] -= 1
+                if _GOVERNORS["tracing"] == 0 and _GOVERNORS["own_tracemalloc"]:
+                    tracemalloc.stop()
+                    _GOVERNORS["own_tracemalloc"] = False
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+# ---------------- PDF optimisation (pikepdf) ----------------
+
+def _dedupe_pdf_streams(pdf, max_passes: int = 3) -> int:
+    """
+    Point every reference to a byte-identical stream (same dictionary + raw data)
+    at one copy; unreferenced duplicates are dropped when the PDF is saved.
+    Repeated because deduping e.g. SMasks can make their parent images identical.
+    """
+    import pikepdf
+
+    removed = 0
+    for _ in range(max_passes):
+        canonical = {}
+        replace = {}
+        for obj in pdf.objects:
+            if not isinstance(obj, pikepdf.Stream):
+                continue
+            try:
+                digest = hashlib.sha256(obj.stream_dict.unparse() + b"\0" + obj.read_raw_bytes()).digest()
+            except Exception:
+                continue
+            first = canonical.setdefault(digest, obj)
+            if first.objgen != obj.objgen:
+                replace[obj.objgen] = first
+        if not replace:
+            break
+        removed += len(replace)
+
+        def _swap(container):
+            if isinstance(container, pikepdf.Array):
+                items = enumerate(list(container))
+            elif isinstance(container, (pikepdf.Dictionary, pikepdf.Stream)):
+                items = [(k, container[k]) for k in list(container.keys())]
+            else:
+                return
+            for k, v in items:
+                if not isinstance(v, pikepdf.Object):
+                    continue
+                if v.is_indirect:
+                    if v.objgen in replace:
+                        container[k] = replace[v.objgen]
+                elif isinstance(v, (pikepdf.Array, pikepdf.Dictionary)):
+                    _swap(v)
+
+        for obj in pdf.objects:
+            if isinstance(obj, (pikepdf.Array, pikepdf.Dictionary, pikepdf.Stream)):
+                _swap(obj)
+        _swap(pdf.trailer)
+    return removed
+
+
+def optimise_pdf_bytes(data: bytes, linearize: bool = True) -> tuple:
+    """
+    Deduplicate identical streams, write compressed object streams and (optionally)
+    linearise for fast first-page display. Returns (pdf_bytes, info); the input is
+    returned unchanged if the optimised file would not be smaller.
+    Needs pikepdf (listed in requirements.txt); raises ImportError without it.
+    """
+    import pikepdf
+
+    t0 = time.perf_counter()
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        deduped = _dedupe_pdf_streams(pdf)
+        out = io.BytesIO()
+        pdf.save(out, compress_streams=True, recompress_flate=True,
+                 object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                 linearize=linearize)
+    result = out.getvalue()
+    kept = len(result) < len(data)
+    info = {
+        "before_bytes": len(data),
+        "after_bytes": len(result) if kept else len(data),
+        "deduped_streams": deduped,
+        "seconds": time.perf_counter() - t0,
+    }
+    return (result if kept else data), info
+
+
+# ---------------- N-up imposition ----------------
+
+SHEET_PRESETS_MM = {
+    "SRA3 (320×450 mm)": (320.0, 450.0),
+    "SRA4 (225×320 mm)": (225.0, 320.0),
+    "A3 (297×420 mm)": (297.0, 420.0),
+    "A4 (210×297 mm)": (210.0, 297.0),
+}
+
+PT_PER_MM = 72.0 / 25.4
+
+
+def compute_nup_layout(sheet_w_mm: float, sheet_h_mm: float, cell_w_mm: float, cell_h_mm: float,
+                       gap_mm: float = 0.0, bleed_mm: float = 0.0, margin_mm: float = 0.0) -> dict:
+    """
+    Step-and-repeat grid for cells of cell_w×cell_h (trim size) on a sheet.
+    Each cell occupies trim + 2×bleed; `gap_mm` separates neighbouring bleed boxes and
+    the grid is centred inside the margins. Returns cols, rows, per_sheet and the
+    trim-box top-left corner (mm, from the sheet's top-left) of every cell, row-major.
+    """
+    foot_w = cell_w_mm + 2 * bleed_mm
+    foot_h = cell_h_mm + 2 * bleed_mm
+    avail_w = sheet_w_mm - 2 * margin_mm
+    avail_h = sheet_h_mm - 2 * margin_mm
+    cols = int((avail_w + gap_mm) // (foot_w + gap_mm)) if foot_w > 0 else 0
+    rows = int((avail_h + gap_mm) // (foot_h + gap_mm)) if foot_h > 0 else 0
+    cols, rows = max(0, cols), max(0, rows)
+    used_w = cols * foot_w + max(0, cols - 1) * gap_mm
+    used_h = rows * foot_h + max(0, rows - 1) * gap_mm
+    x0 = margin_mm + (avail_w - used_w) / 2.0 + bleed_mm
+    y0 = margin_mm + (avail_h - used_h) / 2.0 + bleed_mm
+    cells = [(x0 + c * (foot_w + gap_mm), y0 + r * (foot_h + gap_mm)) for r in range(rows) for c in range(cols)]
+    return {"cols": cols, "rows": rows, "per_sheet": cols * rows, "cells": cells,
+            "sheet_w_mm": sheet_w_mm, "sheet_h_mm": sheet_h_mm,
+            "cell_w_mm": cell_w_mm, "cell_h_mm": cell_h_mm, "bleed_mm": bleed_mm}
+
+
+def merge_sheets_with_shared_layer(sheet_pdfs: list, layer_pdf: Optional[bytes], layout: dict,
+                                   cells_per_sheet: list, above_pdf: Optional[bytes] = None) -> bytes:
+    """
+    Concatenate one-page sheet PDFs (bytes or Paths) and draw the first page of `layer_pdf`
+    underneath, and of `above_pdf` on top of, every occupied cell (either may be None). Each
+    layer is copied in once as a Form XObject, so the shared artwork is stored once and
+    referenced per cell.
+    """
+    import pikepdf
+
+    # qpdf reads copied stream data lazily, so every source stays open until save()
+    with contextlib.ExitStack() as sources:
+        out = sources.enter_context(pikepdf.new())
+        forms = []  # (form, drawn underneath the sheet's own content)
+        for pdf, below in ((layer_pdf, True), (above_pdf, False)):
+            if pdf is not None:
+                layer = sources.enter_context(pikepdf.open(io.BytesIO(pdf)))
+                forms.append((out.copy_foreign(layer.pages[0].as_form_xobject()), below))
+        sheet_h_pt = layout["sheet_h_mm"] * PT_PER_MM
+        bleed = layout["bleed_mm"]
+        for src, n_cells in zip(sheet_pdfs, cells_per_sheet):
+            sheet = sources.enter_context(pikepdf.open(str(src) if isinstance(src, Path) else io.BytesIO(src)))
+            out.pages.extend(sheet.pages)
+            page = out.pages[-1]
+            for form, below in forms:
+                name = page.add_resource(form, pikepdf.Name.XObject, prefix="Shared")
+                ops = []
+                for x_mm, y_mm in layout["cells"][:n_cells]:
+                    # bleed box bottom-left in PDF space (origin bottom-left, y up)
+                    x_pt = (x_mm - bleed) * PT_PER_MM
+                    y_pt = sheet_h_pt - (y_mm + layout["cell_h_mm"] + bleed) * PT_PER_MM
+                    ops.append(f"q 1 0 0 1 {x_pt:.3f} {y_pt:.3f} cm {name} Do Q")
+                page.contents_add(pikepdf.Stream(out, "\n".join(ops).encode("ascii")), prepend=below)
+        buf = io.BytesIO()
+        out.save(buf, compress_streams=True)
+    return buf.getvalue()
+
+
+# ---------------- ZIP merge (raw entry copy) ----------------
+# Sharded exports write one partial ZIP per worker; the merge copies each entry's compressed
+# bytes as they are (no inflate/deflate) and writes a fresh central directory, with ZIP64
+# records once the archive passes 65535 entries or 4 GB.
+
+class RawZipWriter:
+    """Builds a ZIP from entries copied byte-for-byte out of other ZIP files."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.central = []
+
+    @staticmethod
+    def _dos_time(date_time) -> tuple:
+        y, mo, d, h, mi, sec = date_time
+        return (h << 11) | (mi << 5) | (sec // 2), ((max(y, 1980) - 1980) << 9) | (mo << 5) | d
+
+    def copy_entry(self, src_fh, info: zipfile.ZipInfo, chunk: int = 1 << 20):
+        """Append the entry `info` of the open source archive `src_fh`."""
+        src_fh.seek(info.header_offset)
+        head = src_fh.read(30)
+        if head[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f"bad local header for {info.filename}")
+        name_len, extra_len = struct.unpack("<HH", head[26:30])
+        src_fh.seek(info.header_offset + 30 + name_len + extra_len)
+
+        try:
+            name = info.filename.encode("ascii")
+            flags = info.flag_bits & ~0x0808
+        except UnicodeEncodeError:
+            name = info.filename.encode("utf-8")
+            flags = (info.flag_bits & ~0x0808) | 0x0800
+        mtime, mdate = self._dos_time(info.date_time)
+        offset = self.fh.tell()
+        big = info.file_size >= 0xFFFFFFFF or info.compress_size >= 0xFFFFFFFF
+        extra = struct.pack("<HHQQ", 1, 16, info.file_size, info.compress_size) if big else b""
+        self.fh.write(struct.pack("<IHHHHHIIIHH", 0x04034B50, 45 if big else 20, flags, info.compress_type,
+                                  mtime, mdate, info.CRC,
+                                  0xFFFFFFFF if big else info.compress_size, 0xFFFFFFFF if big else info.file_size,
+                                  len(name), len(extra)) + name + extra)
+        remaining = info.compress_size
+        while remaining:
+            data = src_fh.read(min(chunk, remaining))
+            if not data:
+                raise zipfile.BadZipFile(f"{info.filename} is truncated")
+            self.fh.write(data)
+            remaining -= len(data)
+        self.central.append((name, flags, info, mtime, mdate, offset))
 
-    return label
+    def close(self):
+        cd_offset = self.fh.tell()
+        for name, flags, info, mtime, mdate, offset in self.central:
+            z64 = [v for v in (info.file_size, info.compress_size, offset) if v >= 0xFFFFFFFF]
+            extra = struct.pack("<HH%dQ" % len(z64), 1, 8 * len(z64), *z64) if z64 else b""
+            version = 45 if z64 else 20
+            self.fh.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, (info.create_system << 8) | version, version,
+                                      flags, info.compress_type, mtime, mdate, info.CRC,
+                                      min(info.compress_size, 0xFFFFFFFF), min(info.file_size, 0xFFFFFFFF),
+                                      len(name), len(extra), 0, 0, info.internal_attr, info.external_attr,
+                                      min(offset, 0xFFFFFFFF)) + name + extra)
+        cd_size = self.fh.tell() - cd_offset
+        count = len(self.central)
+        if count >= 0xFFFF or cd_size >= 0xFFFFFFFF or cd_offset >= 0xFFFFFFFF:
+            z64_offset = self.fh.tell()
+            self.fh.write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self.fh.write(struct.pack("<IIQI", 0x07064B50, 0, z64_offset, 1))
+        self.fh.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                  min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF), 0))
 
 
 # ---------------- Integration notes (for app.py) ----------------